@@ -0,0 +1,78 @@
+"""
+Measure gateway throughput under a burst of POSTs for each audit backend.
+
+Run from the project root:
+
+    python benchmarks/audit.py [--requests N] [--threads N]
+
+"burst" is the time taken to serve the requests, "total" includes writing
+any records still queued at the end. NB this uses SQLite, which serialises
+all writes, so absolute numbers will differ from a production database.
+
+"""
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from utils import setup_django
+
+setup_django()
+
+from django.db import close_old_connections
+from django.test import RequestFactory
+
+from perimeter import forms
+from perimeter.audit import BufferedAuditBackend, SyncAuditBackend
+from perimeter.models import AccessToken, AccessTokenUse
+from perimeter.views import gateway
+
+
+def post(factory: RequestFactory, token: str) -> None:
+    request = factory.post("/perimeter/gateway/", {"token": token})
+    request.session = {}
+    response = gateway(request)
+    assert response.status_code == 302  # noqa: S101
+    close_old_connections()
+
+
+def run(backend_name: str, requests: int, threads: int) -> None:
+    backend = {
+        "sync": SyncAuditBackend,
+        "buffered": BufferedAuditBackend,
+    }[backend_name]()
+    forms.get_audit_backend = lambda: backend
+    token = AccessToken.objects.create_access_token().token
+    factory = RequestFactory()
+    AccessTokenUse.objects.all().delete()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        for _ in range(requests):
+            executor.submit(post, factory, token)
+    elapsed = time.perf_counter() - start
+    flushed = backend.flush()
+    # wait for any flush already in progress on the background thread
+    while AccessTokenUse.objects.count() < requests:
+        time.sleep(0.01)
+    total = time.perf_counter() - start
+    print(
+        f"{backend_name:<10}{requests / elapsed:>12.0f}{elapsed:>12.3f}"
+        f"{total:>12.3f}{flushed:>10}{AccessTokenUse.objects.count():>10}"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--threads", type=int, default=8)
+    args = parser.parse_args()
+    print(
+        f"{'backend':<10}{'req/s':>12}{'burst (s)':>12}"
+        f"{'total (s)':>12}{'flushed':>10}{'records':>10}"
+    )
+    for backend_name in ("sync", "buffered"):
+        run(backend_name, args.requests, args.threads)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+"""
+Compare the cost of caching AccessToken model instances vs CachedToken payloads.
+
+Run from the project root:
+
+    python benchmarks/cache_payload.py
+
+"""
+import pickle
+import timeit
+
+from utils import setup_django
+
+setup_django(database=False)
+
+from django.utils import timezone
+
+from perimeter.models import AccessToken, CachedToken
+
+NUMBER = 100_000
+
+
+def main() -> None:
+    now = timezone.now()
+    token = AccessToken(
+        pk=1,
+        token=AccessToken.random_token_value(),
+        created_by_id=1,
+        created_at=now,
+        updated_at=now,
+    )
+    payloads = {
+        "model": token,
+        "payload": CachedToken.from_token(token).to_payload(),
+    }
+    print(f"{'':<10}{'bytes':>8}{'dumps (µs)':>14}{'loads (µs)':>14}")
+    for name, value in payloads.items():
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        dumps = timeit.timeit(
+            lambda: pickle.dumps(value, pickle.HIGHEST_PROTOCOL),
+            number=NUMBER,
+        )
+        if name == "payload":
+            loads = timeit.timeit(
+                lambda: CachedToken.from_payload(pickle.loads(data)),
+                number=NUMBER,
+            )
+        else:
+            loads = timeit.timeit(lambda: pickle.loads(data), number=NUMBER)
+        print(
+            f"{name:<10}{len(data):>8}"
+            f"{dumps / NUMBER * 1e6:>14.2f}{loads / NUMBER * 1e6:>14.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
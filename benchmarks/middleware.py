@@ -0,0 +1,239 @@
+"""
+Benchmark the cost of PerimeterAccessMiddleware, and of the gateway view.
+
+Each case is run against each of the requested cache backends, and reports
+the median / 99th percentile time per request along with the number of
+database queries and cache calls per request.
+
+Run from the project root:
+
+    python benchmarks/middleware.py [--iterations N] [--cache locmem --cache file]
+
+Use --metrics to report to an InMemoryRegistry metrics sink rather than the
+default (no-op) sink, to measure the overhead of the instrumentation.
+
+The "redis" and "memcached" backends need a local server (and the redis /
+pymemcache packages) - set PERIMETER_BENCH_REDIS_URL or
+PERIMETER_BENCH_MEMCACHED_LOCATION if they are not on the default ports.
+The "file" backend is a stand-in for a networked cache that needs neither -
+every call does real I/O and (un)pickling.
+
+"""
+import argparse
+import functools
+import os
+import statistics
+import tempfile
+import time
+from typing import Any, Callable, Dict, List, Tuple
+from unittest import mock
+
+from utils import setup_django
+
+setup_django()
+
+from django.contrib.sessions.backends.db import SessionStore
+from django.contrib.sessions.middleware import SessionMiddleware
+from django.core.cache import cache, caches
+from django.db import connection
+from django.http import HttpResponse
+from django.test import RequestFactory, override_settings
+
+from perimeter import metrics
+from perimeter.cache import local_cache
+from perimeter.middleware import PerimeterAccessMiddleware
+from perimeter.models import AccessToken
+from perimeter.settings import PERIMETER_SESSION_KEY, get_gateway_path
+from perimeter.views import gateway
+
+CACHES = {
+    "locmem": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+    "file": {
+        "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+        "LOCATION": tempfile.mkdtemp(prefix="perimeter-bench-cache-"),
+    },
+    "redis": {
+        "BACKEND": "django.core.cache.backends.redis.RedisCache",
+        "LOCATION": os.environ.get(
+            "PERIMETER_BENCH_REDIS_URL", "redis://127.0.0.1:6379"
+        ),
+    },
+    "memcached": {
+        "BACKEND": "django.core.cache.backends.memcached.PyMemcacheCache",
+        "LOCATION": os.environ.get(
+            "PERIMETER_BENCH_MEMCACHED_LOCATION", "127.0.0.1:11211"
+        ),
+    },
+}
+
+CACHE_METHODS = (
+    "add",
+    "delete",
+    "delete_many",
+    "get",
+    "get_many",
+    "has_key",
+    "incr",
+    "set",
+    "set_many",
+    "touch",
+)
+
+factory = RequestFactory()
+middleware = PerimeterAccessMiddleware(get_response=lambda r: HttpResponse("OK"))
+
+
+class QueryCounter:
+    """Count database queries (using a connection execute wrapper)."""
+
+    def __init__(self) -> None:
+        self.count = 0
+
+    def __call__(self, execute: Callable, *args: Any) -> Any:
+        self.count += 1
+        return execute(*args)
+
+
+class CacheCallCounter:
+    """Count calls made to the default cache (unless paused)."""
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.paused = False
+        self._patches: List[Any] = []
+
+    def _wrap(self, func: Callable) -> Callable:
+        @functools.wraps(func)
+        def inner(*args: Any, **kwargs: Any) -> Any:
+            if not self.paused:
+                self.count += 1
+            return func(*args, **kwargs)
+
+        return inner
+
+    def __enter__(self) -> "CacheCallCounter":
+        backend = caches["default"]
+        for name in CACHE_METHODS:
+            patch = mock.patch.object(backend, name, self._wrap(getattr(backend, name)))
+            patch.start()
+            self._patches.append(patch)
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        for patch in self._patches:
+            patch.stop()
+
+
+def noop() -> None:
+    pass
+
+
+def clear_cache(token: str) -> None:
+    local_cache.clear()
+    cache.delete(AccessToken.get_cache_key(token))
+
+
+def bypassed() -> Any:
+    return middleware(factory.get(get_gateway_path()))
+
+
+def header_token(token: str) -> Any:
+    return middleware(factory.get("/", HTTP_X_PERIMETER_TOKEN=token))
+
+
+def session_token(session_key: str) -> Any:
+    request = factory.get("/")
+    request.COOKIES["sessionid"] = session_key
+    SessionMiddleware(get_response=lambda r: HttpResponse()).process_request(request)
+    return middleware(request)
+
+
+def gateway_post(payload: Dict[str, str], user_details: bool = False) -> Any:
+    request = factory.post(get_gateway_path(), payload)
+    request.session = {}
+    with mock.patch("perimeter.views.PERIMETER_REQUIRE_USER_DETAILS", user_details):
+        return gateway(request)
+
+
+def get_cases() -> List[Tuple[str, Callable, Callable]]:
+    """Return (name, setup, request) for each case - only request is timed."""
+    token = AccessToken.objects.create_access_token().token
+    session = SessionStore()
+    session[PERIMETER_SESSION_KEY] = token
+    session.save()
+    user_details = {"token": token, "email": "fred@example.com", "name": "Fred"}
+    return [
+        ("bypassed request", noop, bypassed),
+        ("header token (cache hit)", noop, functools.partial(header_token, token)),
+        (
+            "session token (cache hit)",
+            noop,
+            functools.partial(session_token, session.session_key),
+        ),
+        (
+            "header token (cache miss)",
+            functools.partial(clear_cache, token),
+            functools.partial(header_token, token),
+        ),
+        ("invalid token", noop, functools.partial(header_token, "invalid")),
+        ("gateway POST", noop, functools.partial(gateway_post, {"token": token})),
+        (
+            "gateway POST (user details)",
+            noop,
+            functools.partial(gateway_post, user_details, user_details=True),
+        ),
+    ]
+
+
+def run_case(setup: Callable, func: Callable, iterations: int) -> Dict[str, float]:
+    """Run func (preceded by an untimed setup) iterations times."""
+    timings = []
+    queries = QueryCounter()
+    with connection.execute_wrapper(queries), CacheCallCounter() as calls:
+        for _ in range(iterations):
+            calls.paused = True
+            setup()
+            calls.paused = False
+            start = time.perf_counter_ns()
+            func()
+            timings.append(time.perf_counter_ns() - start)
+    timings.sort()
+    return {
+        "p50": statistics.median(timings) / 1000,
+        "p99": timings[max(int(len(timings) * 0.99) - 1, 0)] / 1000,
+        "queries": queries.count / iterations,
+        "cache_calls": calls.count / iterations,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--iterations", type=int, default=1000)
+    parser.add_argument("--cache", action="append", choices=list(CACHES))
+    parser.add_argument("--metrics", action="store_true")
+    args = parser.parse_args()
+    if args.metrics:
+        metrics.sink = metrics.InMemoryRegistry()
+    print(
+        f"{'case':<30}{'cache':<10}{'p50 (µs)':>10}{'p99 (µs)':>10}"
+        f"{'queries':>10}{'cache calls':>13}"
+    )
+    for cache_name in args.cache or ["locmem", "file"]:
+        with override_settings(CACHES={"default": CACHES[cache_name]}):
+            cache.clear()
+            for name, setup, func in get_cases():
+                # warm up (fills caches, imports templates etc.)
+                setup()
+                func()
+                result = run_case(setup, func, args.iterations)
+                print(
+                    f"{name:<30}{cache_name:<10}{result['p50']:>10.1f}"
+                    f"{result['p99']:>10.1f}{result['queries']:>10.2f}"
+                    f"{result['cache_calls']:>13.2f}"
+                )
+
+
+if __name__ == "__main__":
+    main()
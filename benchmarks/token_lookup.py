@@ -0,0 +1,109 @@
+"""
+Compare token lookups with each PERIMETER_TOKEN_STORAGE mode.
+
+Reports the cost of hashing a token value, and the median / 99th percentile
+time of a cache hit and of a database lookup (cache miss) in each mode,
+against a table of --tokens tokens.
+
+Run from the project root:
+
+    python benchmarks/token_lookup.py [--iterations N] [--tokens N]
+
+"""
+import argparse
+import random
+import statistics
+import time
+import timeit
+from typing import Callable, Dict, List
+from unittest import mock
+
+from utils import setup_django
+
+setup_django()
+
+from django.core.cache import cache
+from django.test import override_settings
+from django.utils.crypto import salted_hmac
+
+from perimeter.cache import local_cache
+from perimeter.hashing import KEY_SALT, hash_token_value
+from perimeter.models import AccessToken
+
+MODES = ("plain", "dual", "hashed")
+
+# big enough to hold every token (the default is 300 entries)
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "OPTIONS": {"MAX_ENTRIES": 1_000_000},
+    }
+}
+
+
+def percentiles(func: Callable, setup: Callable, iterations: int) -> Dict[str, float]:
+    timings = []
+    for _ in range(iterations):
+        setup()
+        start = time.perf_counter_ns()
+        func()
+        timings.append(time.perf_counter_ns() - start)
+    timings.sort()
+    return {
+        "p50": statistics.median(timings) / 1000,
+        "p99": timings[max(int(len(timings) * 0.99) - 1, 0)] / 1000,
+    }
+
+
+@override_settings(CACHES=CACHES)
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--iterations", type=int, default=2000)
+    parser.add_argument("--tokens", type=int, default=10000)
+    args = parser.parse_args()
+
+    number = 100_000
+    hashing = timeit.timeit(lambda: hash_token_value("x" * 50), number=number)
+    salted = timeit.timeit(
+        lambda: salted_hmac(KEY_SALT, "x" * 50, algorithm="sha256").hexdigest(),
+        number=number,
+    )
+    print(f"hash_token_value: {hashing / number * 1e6:.2f}µs")
+    print(f"salted_hmac:      {salted / number * 1e6:.2f}µs")
+    print()
+    print(f"{'mode':<10}{'case':<12}{'p50 (µs)':>10}{'p99 (µs)':>10}")
+    for mode in MODES:
+        with mock.patch("perimeter.models.PERIMETER_TOKEN_STORAGE", mode):
+            AccessToken.objects.all().delete()
+            values: List[str] = [
+                t.token
+                for t in AccessToken.objects.bulk_create_tokens(
+                    args.tokens, warm_cache=True
+                )
+            ]
+
+            def lookup() -> None:
+                value = random.choice(values)  # noqa: S311
+                AccessToken.objects.get_access_token(value)
+
+            def clear() -> None:
+                local_cache.clear()
+                cache.clear()
+
+            # warm up
+            for _ in range(100):
+                lookup()
+            cases = {
+                "cache hit": percentiles(lookup, local_cache.clear, args.iterations),
+                "cache miss": percentiles(lookup, clear, args.iterations),
+            }
+            for case, result in cases.items():
+                print(
+                    f"{mode:<10}{case:<12}{result['p50']:>10.1f}{result['p99']:>10.1f}"
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,29 @@
+"""Shared set up for the benchmark scripts."""
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "tests.settings")
+
+
+def setup_django(database: bool = True) -> None:
+    """
+    Configure Django using the test settings.
+
+    If database is True, a throwaway SQLite database file is created and
+    migrated (a file rather than :memory: so that it can be shared by
+    background threads).
+
+    """
+    import django
+    from django.conf import settings
+
+    if database:
+        _, path = tempfile.mkstemp(prefix="perimeter-bench-", suffix=".sqlite3")
+        settings.DATABASES["default"]["NAME"] = path
+    django.setup()
+    if database:
+        from django.core.management import call_command
+
+        call_command("migrate", verbosity=0)
@@ -1,12 +1,65 @@
-from django.contrib.admin import ModelAdmin, site
+from typing import Any
 
-from .models import AccessToken
+from django.contrib.admin import ModelAdmin, display, site
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.functional import cached_property
+
+from .models import AccessToken, AccessTokenUse
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator that uses the planner's row estimate for unfiltered tables.
+
+    COUNT(*) on a table with millions of rows is a full scan (on PostgreSQL
+    at least), and the admin changelist runs one on every page. When the
+    whole table is being paged through, PostgreSQL's own estimate of the
+    number of rows (from pg_class.reltuples) is used instead; filtered
+    querysets, and other databases, are counted as normal.
+
+    """
+
+    @cached_property
+    def count(self) -> int:
+        estimate = self.estimate_count()
+        if estimate is not None:
+            return estimate
+        return super().count
+
+    def estimate_count(self) -> Any:
+        """Return the estimated number of rows, or None if not available."""
+        queryset = self.object_list
+        if not hasattr(queryset, "query") or queryset.query.where:
+            return None
+        connection = connections[queryset.db]
+        if connection.vendor != "postgresql":
+            return None
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT reltuples FROM pg_class WHERE relname = %s",
+                [queryset.model._meta.db_table],
+            )
+            row = cursor.fetchone()
+        # reltuples is -1 (or 0) for tables that have never been analyzed
+        if row is None or row[0] <= 0:
+            return None
+        return int(row[0])
 
 
 class AccessTokenAdmin(ModelAdmin):
     raw_id_fields = ("created_by",)
-    list_display = ("token", "expires_on", "is_active", "created_at", "created_by")
-    readonly_fields = ("created_at", "updated_at")
+    list_display = (
+        "token",
+        "expires_on",
+        "is_active",
+        "created_at",
+        "created_by",
+        "use_count",
+        "last_used_at",
+    )
+    list_select_related = ("created_by",)
+    readonly_fields = ("created_at", "updated_at", "use_count", "last_used_at")
 
     def formfield_for_foreignkey(self, db_field, request, **kwargs):
         """
@@ -24,15 +77,21 @@ class AccessTokenAdmin(ModelAdmin):
 site.register(AccessToken, AccessTokenAdmin)
 
 
-# class AccessTokenUseAdmin(ModelAdmin):
-#     list_display = ("token", "expires_on", "timestamp", "client_ip")
-#     readonly_fields = ("timestamp", "client_user_agent", "client_ip")
-#     raw_id_fields = ("token",)
-
-#     def expires_on(self, obj):
-#         return obj.token.expires_on
+class AccessTokenUseAdmin(ModelAdmin):
+    list_display = ("token", "expires_on", "timestamp", "user_email", "client_ip")
+    # token (and its expiry) are fetched in the same query as the records
+    list_select_related = ("token",)
+    readonly_fields = ("timestamp", "client_user_agent", "client_ip")
+    raw_id_fields = ("token",)
+    date_hierarchy = "timestamp"
+    ordering = ("-timestamp",)
+    paginator = EstimatedCountPaginator
+    # don't count the whole table just to show "(n total)" when filtering
+    show_full_result_count = False
 
-#     expires_on.short_description = "Token Expires"
+    @display(description="Token Expires", ordering="token__expires_on")
+    def expires_on(self, obj: AccessTokenUse) -> Any:
+        return obj.token.expires_on
 
 
-# site.register(AccessTokenUse, AccessTokenUseAdmin)
+site.register(AccessTokenUse, AccessTokenUseAdmin)
@@ -1,7 +1,56 @@
+import logging
+import threading
+import time
+from typing import Any
+
 from django.apps import AppConfig
+from django.core.signals import request_started
+from django.db import connections
+
+from .settings import PERIMETER_CACHE_WARM_ON_STARTUP
+
+logger = logging.getLogger(__name__)
+
+
+def warm_cache(**kwargs: Any) -> None:
+    """
+    Warm the token cache in a background thread (on the first request only).
+
+    This is run on the first request, rather than from ready(), so that it
+    only happens in processes that serve requests (not management commands),
+    and does not touch the database while apps are still loading.
+
+    """
+    from .models import AccessToken
+
+    request_started.disconnect(warm_cache)
+
+    def run() -> None:
+        start = time.monotonic()
+        try:
+            result = AccessToken.objects.warm_cache()
+        except Exception:
+            logger.exception("Error warming the perimeter cache.")
+        else:
+            if result is not None:
+                logger.info(
+                    "Warmed perimeter cache: %s of %s valid tokens cached in %.2fs",
+                    result[1],
+                    result[0],
+                    time.monotonic() - start,
+                )
+        finally:
+            # NB the thread's own connection - it would otherwise be left open
+            connections.close_all()
+
+    threading.Thread(target=run, name="perimeter-warm-cache", daemon=True).start()
 
 
 class PerimeterAppConfig(AppConfig):
     name = "perimeter"
     verbose_name = "Perimeter"
     default_auto_field = "django.db.models.AutoField"
+
+    def ready(self) -> None:
+        if PERIMETER_CACHE_WARM_ON_STARTUP:
+            request_started.connect(warm_cache)
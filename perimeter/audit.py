@@ -0,0 +1,221 @@
+"""
+Pluggable backends for recording token use.
+
+Every successful gateway POST records an AccessTokenUse. By default this is
+saved there and then (SyncAuditBackend), but when many people hit the
+gateway at once these inserts can contend on the database, so the
+BufferedAuditBackend queues them in memory and writes them in batches.
+
+The backend is set using the PERIMETER_AUDIT_BACKEND setting.
+
+"""
+from __future__ import annotations
+
+import atexit
+import collections
+import datetime
+import functools
+import logging
+import threading
+from typing import Deque, Dict, List, Optional, Tuple
+
+from django.db import (
+    DatabaseError,
+    InterfaceError,
+    OperationalError,
+    close_old_connections,
+    transaction,
+)
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .models import AccessToken, AccessTokenUse
+from .settings import (
+    PERIMETER_AUDIT_BACKEND,
+    PERIMETER_AUDIT_BATCH_SIZE,
+    PERIMETER_AUDIT_BUFFER_SIZE,
+    PERIMETER_AUDIT_FLUSH_INTERVAL,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class AuditBackend:
+    """Base class for audit backends."""
+
+    def record(self, token_use: AccessTokenUse) -> AccessTokenUse:
+        """Record an (unsaved) AccessTokenUse."""
+        raise NotImplementedError
+
+    def flush(self) -> int:
+        """Write any pending records, returning the number written."""
+        return 0
+
+
+def save_token_use(token_use: AccessTokenUse) -> AccessTokenUse:
+    """Save a single record, and update the token's usage stats."""
+    with transaction.atomic():
+        token_use.save()
+        AccessToken.objects.record_usage(token_use.token_id, token_use.timestamp)
+    return token_use
+
+
+class SyncAuditBackend(AuditBackend):
+    """Save each record as it is made."""
+
+    def record(self, token_use: AccessTokenUse) -> AccessTokenUse:
+        return save_token_use(token_use)
+
+
+class BufferedAuditBackend(AuditBackend):
+    """
+    Queue records in memory and write them in batches using bulk_create.
+
+    Records are flushed from a background thread whenever `batch_size`
+    records are queued, or every `flush_interval` seconds, and once more
+    when the process exits. If the queue reaches `max_size` (e.g. because
+    the database is unavailable) further records are saved synchronously.
+
+    If a batch cannot be written, its records are saved one at a time, so
+    that one bad record does not lose the rest - if the database is
+    unavailable, the records are put back on the queue to try again.
+
+    NB records returned from `record` are not saved (they have no pk) until
+    they have been flushed.
+
+    """
+
+    def __init__(
+        self,
+        max_size: int = PERIMETER_AUDIT_BUFFER_SIZE,
+        batch_size: int = PERIMETER_AUDIT_BATCH_SIZE,
+        flush_interval: int = PERIMETER_AUDIT_FLUSH_INTERVAL,
+    ) -> None:
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue: Deque[AccessTokenUse] = collections.deque()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._registered = False
+
+    def __len__(self) -> int:
+        return len(self._queue)
+
+    def record(self, token_use: AccessTokenUse) -> AccessTokenUse:
+        # timestamp is usually set in save(), which bulk_create does not call
+        token_use.timestamp = token_use.timestamp or timezone.now()
+        with self._lock:
+            queued = len(self._queue) < self.max_size
+            if queued:
+                self._queue.append(token_use)
+                size = len(self._queue)
+        if not queued:
+            logger.warning("Audit buffer is full, saving token use synchronously.")
+            return save_token_use(token_use)
+        self.start()
+        if size >= self.batch_size:
+            self._wakeup.set()
+        return token_use
+
+    def flush(self) -> int:
+        """
+        Write all queued records to the database.
+
+        Token usage stats are updated once per token (not once per record),
+        so a token shared by many users is only updated once per flush.
+        If the batch cannot be written, see `save_each`.
+
+        """
+        with self._lock:
+            batch: List[AccessTokenUse] = list(self._queue)
+            self._queue.clear()
+        if not batch:
+            return 0
+        usage: Dict[int, Tuple[int, datetime.datetime]] = {}
+        for token_use in batch:
+            count, last_used_at = usage.get(
+                token_use.token_id, (0, token_use.timestamp)
+            )
+            usage[token_use.token_id] = (
+                count + 1,
+                max(last_used_at, token_use.timestamp),
+            )
+        try:
+            with transaction.atomic():
+                AccessTokenUse.objects.bulk_create(batch, batch_size=self.batch_size)
+                for pk, (count, last_used_at) in usage.items():
+                    AccessToken.objects.record_usage(pk, last_used_at, count)
+        except DatabaseError:
+            logger.exception("Error writing token use audit records in bulk.")
+            return self.save_each(batch)
+        return len(batch)
+
+    def save_each(self, batch: List[AccessTokenUse]) -> int:
+        """
+        Save records one at a time, returning the number saved.
+
+        Records that cannot be saved are logged and dropped - unless the
+        database is unavailable, in which case the unsaved records are put
+        back at the front of the queue and the error is raised.
+
+        """
+        saved = 0
+        for index, token_use in enumerate(batch):
+            try:
+                save_token_use(token_use)
+            except (InterfaceError, OperationalError):
+                self.requeue(batch[index:])
+                raise
+            except DatabaseError:
+                logger.exception(
+                    "Error saving token use audit record (token %s), dropping it.",
+                    token_use.token_id,
+                )
+            else:
+                saved += 1
+        return saved
+
+    def requeue(self, batch: List[AccessTokenUse]) -> None:
+        """Put records back at the front of the queue, as far as there is room."""
+        with self._lock:
+            room = max(self.max_size - len(self._queue), 0)
+            self._queue.extendleft(reversed(batch[:room]))
+        if len(batch) > room:
+            logger.error(
+                "Audit buffer is full, dropping %s token use records.",
+                len(batch) - room,
+            )
+
+    def start(self) -> None:
+        """Start the background flush thread, if it is not already running."""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            # NB thread will not be alive in a process forked from the parent
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name="perimeter-audit", daemon=True
+                )
+                self._thread.start()
+            if not self._registered:
+                atexit.register(self.flush)
+                self._registered = True
+
+    def _run(self) -> None:
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Error flushing token use audit records.")
+            finally:
+                close_old_connections()
+
+
+@functools.lru_cache(maxsize=None)
+def get_audit_backend() -> AuditBackend:
+    """Return the (process-wide) audit backend set in PERIMETER_AUDIT_BACKEND."""
+    return import_string(PERIMETER_AUDIT_BACKEND)()
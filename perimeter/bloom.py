@@ -0,0 +1,276 @@
+"""
+Bloom filter of existing tokens.
+
+A large share of the token values that reach the middleware (probing
+traffic, stale cookies) do not exist at all. With PERIMETER_BLOOM_FILTER
+enabled each process keeps a Bloom filter of every AccessToken.token_hash,
+and a value whose hash is definitely not in the filter is rejected without
+any cache or database lookup.
+
+A Bloom filter can say "definitely not" or "maybe", so a false positive
+just means a normal lookup. False negatives are not possible - as long as
+the filter is current. Tokens created in this process are added to the
+filter straight away; tokens created elsewhere bump a generation counter in
+the cache, which each process checks (at most) every
+PERIMETER_BLOOM_REFRESH_INTERVAL seconds, rebuilding its filter (in a
+background thread) when the generation has changed. Deleted tokens are left
+in the filter (they are dropped at the next rebuild) - they are just false
+positives.
+
+"""
+from __future__ import annotations
+
+import functools
+import hashlib
+import logging
+import math
+import threading
+import time
+from typing import Any, Dict, Iterable, Optional
+
+from django.db import connections, transaction
+
+from .cache import bump_generation, get_generation
+from .hashing import hash_token_value
+from .settings import (
+    PERIMETER_BLOOM_CAPACITY,
+    PERIMETER_BLOOM_ERROR_RATE,
+    PERIMETER_BLOOM_FILTER,
+    PERIMETER_BLOOM_REFRESH_INTERVAL,
+    PERIMETER_CACHE_KEY_PREFIX,
+)
+
+logger = logging.getLogger(__name__)
+
+# cache key of the generation counter - bumped whenever tokens are created
+GENERATION_KEY = f"{PERIMETER_CACHE_KEY_PREFIX}:bloom:generation"
+
+
+class BloomFilter:
+    """
+    Fixed-size Bloom filter of strings.
+
+    The size (in bits) and number of hash functions are derived from the
+    expected number of values (`capacity`) and the acceptable false
+    positive rate (`error_rate`). Adding more than `capacity` values
+    raises the false positive rate - see `estimated_error_rate`.
+
+    """
+
+    def __init__(self, capacity: int, error_rate: float) -> None:
+        capacity = max(capacity, 1)
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.num_bits = max(int(-capacity * math.log(error_rate) / math.log(2) ** 2), 8)
+        self.num_hashes = max(int(round(self.num_bits / capacity * math.log(2))), 1)
+        self.count = 0
+        self._bits = bytearray((self.num_bits + 7) // 8)
+
+    def __len__(self) -> int:
+        return self.count
+
+    def _positions(self, value: str) -> Iterable[int]:
+        # double hashing - k positions from two 64-bit halves of one digest
+        digest = hashlib.blake2b(value.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.num_bits for i in range(self.num_hashes))
+
+    def add(self, value: str) -> None:
+        for position in self._positions(value):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, value: str) -> bool:
+        return all(
+            self._bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(value)
+        )
+
+    @property
+    def size_bytes(self) -> int:
+        return len(self._bits)
+
+    @property
+    def estimated_error_rate(self) -> float:
+        """Return the expected false positive rate, given the current count."""
+        return (
+            1 - math.exp(-self.num_hashes * self.count / self.num_bits)
+        ) ** self.num_hashes
+
+
+class TokenFilter:
+    """
+    Process-wide Bloom filter of token hashes, kept in step with the database.
+
+    The filter is built from the database the first time it is needed, and
+    rebuilt whenever the generation counter in the cache changes. Building
+    it means reading every token, so it is done in a background thread -
+    requests carry on with the old filter meanwhile, or, if there is none
+    yet, do not use a filter at all.
+
+    """
+
+    def __init__(
+        self,
+        enabled: bool,
+        capacity: int,
+        error_rate: float,
+        refresh_interval: int,
+    ) -> None:
+        self.enabled = enabled
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.refresh_interval = refresh_interval
+        self.rejects = 0
+        self._filter: Optional[BloomFilter] = None
+        self._generation: Optional[int] = None
+        self._checked_at = -math.inf
+        self._built_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_due(self) -> bool:
+        """Return True if the generation counter should be checked."""
+        return self.enabled and (
+            time.monotonic() - self._checked_at >= self.refresh_interval
+        )
+
+    def refresh_if_due(self) -> None:
+        """Rebuild the filter (in the background) if the generation has changed."""
+        if not self.is_due:
+            return
+        self._checked_at = time.monotonic()
+        generation = get_generation(GENERATION_KEY)
+        if self._filter is None or generation != self._generation:
+            self.build_in_background(generation)
+
+    def build_in_background(self, generation: Optional[int] = None) -> None:
+        """Build a new filter in a background thread (unless already building)."""
+        if self._lock.locked():
+            return
+
+        def run() -> None:
+            try:
+                self.build(generation)
+            except Exception:
+                logger.exception("Error building token Bloom filter.")
+            finally:
+                # NB the thread's own connection - it would otherwise be left open
+                connections.close_all()
+
+        threading.Thread(target=run, name="perimeter-bloom-build", daemon=True).start()
+
+    def build(self, generation: Optional[int] = None) -> None:
+        """Build a new filter from all the token hashes in the database."""
+        # NB imported here as models imports this module
+        from .models import AccessToken
+
+        if not self._lock.acquire(blocking=False):
+            # another thread is already building it
+            return
+        try:
+            if generation is None:
+                generation = get_generation(GENERATION_KEY)
+            start = time.monotonic()
+            bloom = BloomFilter(self.capacity, self.error_rate)
+            for token_hash, value in (
+                AccessToken.objects.order_by()
+                .values_list("token_hash", "token")
+                .iterator(chunk_size=10000)
+            ):
+                # NB tokens created before hashing was added may have no hash
+                bloom.add(token_hash or hash_token_value(value))
+            self._filter = bloom
+            self._generation = generation
+            self._built_at = time.time()
+            logger.info(
+                "Built token Bloom filter: %s tokens, %s bytes, in %.2fs",
+                bloom.count,
+                bloom.size_bytes,
+                time.monotonic() - start,
+            )
+            if bloom.count > bloom.capacity:
+                logger.warning(
+                    "Token Bloom filter is over capacity (%s > %s) - estimated "
+                    "false positive rate is %.4f, increase PERIMETER_BLOOM_CAPACITY.",
+                    bloom.count,
+                    bloom.capacity,
+                    bloom.estimated_error_rate,
+                )
+        finally:
+            self._lock.release()
+
+    def might_exist(self, value: str) -> bool:
+        """
+        Return False if value is definitely not a token hash.
+
+        This does no I/O - if the filter is disabled or has not been built
+        yet every value might exist.
+
+        """
+        bloom = self._filter
+        if not self.enabled or bloom is None or value in bloom:
+            return True
+        self.rejects += 1
+        return False
+
+    def add(self, *values: str) -> None:
+        """Add new token hashes, and tell other processes about them."""
+        if not self.enabled:
+            return
+        bloom = self._filter
+        if bloom is not None:
+            for value in values:
+                bloom.add(value)
+        # NB other processes must not rebuild until the token is committed
+        transaction.on_commit(functools.partial(self._bump_generation, bloom))
+
+    def _bump_generation(self, bloom: Optional[BloomFilter] = None) -> None:
+        # NB if the counter has been evicted it restarts from the current
+        # time (see new_generation), so it cannot come back round to a
+        # generation that some process has already built its filter at.
+        generation = bump_generation(GENERATION_KEY)
+        # if the filter the values were added to is still in use, and was up
+        # to date, it still is - if it has been replaced since (e.g. by a
+        # rebuild from before the values were committed), the next refresh
+        # rebuilds it.
+        if (
+            bloom is not None
+            and bloom is self._filter
+            and self._generation == generation - 1
+        ):
+            self._generation = generation
+
+    def reset(self) -> None:
+        """Discard the filter (it will be rebuilt when next needed)."""
+        self._filter = None
+        self._generation = None
+        self._checked_at = -math.inf
+        self.rejects = 0
+
+    def stats(self) -> Dict[str, Any]:
+        """Return the filter size, accuracy and number of values rejected."""
+        bloom = self._filter
+        return {
+            "enabled": self.enabled,
+            "built": bloom is not None,
+            "built_at": self._built_at,
+            "generation": self._generation,
+            "capacity": self.capacity,
+            "error_rate": self.error_rate,
+            "count": bloom.count if bloom else 0,
+            "size_bytes": bloom.size_bytes if bloom else 0,
+            "num_hashes": bloom.num_hashes if bloom else 0,
+            "estimated_error_rate": bloom.estimated_error_rate if bloom else 0.0,
+            "rejects": self.rejects,
+        }
+
+
+# the process-wide filter - disabled unless PERIMETER_BLOOM_FILTER is set
+token_filter = TokenFilter(
+    PERIMETER_BLOOM_FILTER,
+    PERIMETER_BLOOM_CAPACITY,
+    PERIMETER_BLOOM_ERROR_RATE,
+    PERIMETER_BLOOM_REFRESH_INTERVAL,
+)
@@ -0,0 +1,268 @@
+"""
+Process-local cache tier used in front of the Django cache.
+
+Each worker sees the same handful of tokens over and over, so keeping a
+small, short-lived copy in memory removes the network round trip (and the
+unpickling) from the hot path.
+
+Also home to the cache that Perimeter shares between processes (see
+PERIMETER_CACHE_ALIAS), the namespace that its keys are built in, and the
+generation counters that tell processes when their own copies of shared
+state are out of date.
+
+"""
+from __future__ import annotations
+
+import math
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+from django.core.cache import caches
+from django.utils.connection import ConnectionProxy
+
+from .settings import (
+    PERIMETER_CACHE_ALIAS,
+    PERIMETER_CACHE_GENERATION_INTERVAL,
+    PERIMETER_CACHE_KEY_PREFIX,
+    PERIMETER_LOCAL_CACHE_SIZE,
+    PERIMETER_LOCAL_CACHE_TIMEOUT,
+)
+
+# the (Django) cache used for everything that Perimeter stores - like
+# django.core.cache.cache, this is a proxy to the current thread's connection.
+cache: Any = ConnectionProxy(caches, PERIMETER_CACHE_ALIAS)
+
+
+class LocalCache:
+    """
+    Bounded, thread-safe LRU cache with a per-entry TTL.
+
+    Entries are evicted least-recently-used first once max_size is reached,
+    and are never kept for longer than `timeout` seconds. A max_size of 0
+    disables the cache - all lookups miss, and nothing is stored.
+
+    Hit / miss counters are kept so that the cache can be sized.
+
+    """
+
+    def __init__(self, max_size: int, timeout: int) -> None:
+        self.max_size = max_size
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict[str, Tuple[float, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0
+
+    def get(self, key: str) -> Any:
+        """Return the value stored against key, or None if missing / expired."""
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: str, value: Any, timeout: Optional[int] = None) -> None:
+        """
+        Store value against key.
+
+        The timeout is capped by the cache timeout - so passing in the
+        number of seconds until a token expires will never keep it for
+        longer than the cache allows. A timeout <= 0 removes the key.
+
+        """
+        if not self.enabled:
+            return
+        timeout = self.timeout if timeout is None else min(timeout, self.timeout)
+        if timeout <= 0:
+            self.delete(key)
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic() + timeout, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key: str) -> None:
+        """Remove key from the cache (no error if it does not exist)."""
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        """Remove all entries and reset the hit / miss counters."""
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> Dict[str, int]:
+        """Return current size and hit / miss counters."""
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self._data),
+            "max_size": self.max_size,
+        }
+
+
+# the process-wide token cache - disabled unless PERIMETER_LOCAL_CACHE_SIZE is set
+local_cache = LocalCache(PERIMETER_LOCAL_CACHE_SIZE, PERIMETER_LOCAL_CACHE_TIMEOUT)
+
+
+class KeyLocks:
+    """
+    Fixed-size pool of locks, shared out between keys by hash.
+
+    Used to make sure that only one thread at a time refills a given cache
+    key. Unrelated keys can occasionally share a lock (and so wait on each
+    other), but the pool never grows however many keys are seen.
+
+    """
+
+    def __init__(self, size: int = 64) -> None:
+        self._locks = [threading.Lock() for _ in range(size)]
+
+    def __call__(self, key: str) -> threading.Lock:
+        return self._locks[hash(key) % len(self._locks)]
+
+
+# locks held while refilling the token cache (see AccessTokenManager)
+fill_locks = KeyLocks()
+
+
+def new_generation() -> int:
+    """
+    Return the value that a new generation counter starts from.
+
+    Counters can be evicted, so rather than starting from 0 (or 1) a new
+    counter starts from the current time, in microseconds - so that it can
+    never come back round to a generation that an older counter reached
+    (that would take more than one bump per microsecond).
+
+    """
+    return time.time_ns() // 1000
+
+
+def get_generation(key: str) -> int:
+    """Return the current value of a generation counter, creating it if missing."""
+    generation = cache.get(key)
+    if generation is None:
+        generation = new_generation()
+        # if add fails, another process got there first.
+        if not cache.add(key, generation, None):
+            generation = cache.get(key) or generation
+    return generation
+
+
+async def aget_generation(key: str) -> int:
+    """Async version of get_generation."""
+    generation = await cache.aget(key)
+    if generation is None:
+        generation = new_generation()
+        if not await cache.aadd(key, generation, None):
+            generation = await cache.aget(key) or generation
+    return generation
+
+
+def bump_generation(key: str) -> int:
+    """Increment a generation counter (creating it if missing), returning it."""
+    try:
+        return cache.incr(key)
+    except ValueError:
+        # if add fails, another process got there first.
+        generation = new_generation()
+        if cache.add(key, generation, None):
+            return generation
+        return cache.incr(key)
+
+
+class CacheNamespace:
+    """
+    Versioned namespace for cache keys.
+
+    Every key is built from a prefix and a generation number that is kept
+    in the cache itself, so bumping the generation (a single incr) orphans
+    every key in the namespace at once - the old entries simply expire.
+
+    Reading the generation on every lookup would double the number of
+    cache round trips, so each process re-reads it at most every `interval`
+    seconds - and so can take that long to see an invalidation made by
+    another process. If the counter is evicted it is recreated from the
+    current time (see new_generation), so keys written in an earlier
+    generation are never used again.
+
+    """
+
+    def __init__(self, prefix: str, interval: int) -> None:
+        self.prefix = prefix
+        self.interval = interval
+        self.generation_key = f"{prefix}:generation"
+        self._generation = 0
+        self._checked_at = -math.inf
+
+    @property
+    def is_due(self) -> bool:
+        """Return True if the generation should be re-read from the cache."""
+        return time.monotonic() - self._checked_at >= self.interval
+
+    @property
+    def generation(self) -> int:
+        if self.is_due:
+            self._set_generation(get_generation(self.generation_key))
+        return self._generation
+
+    async def arefresh(self) -> None:
+        """Re-read the generation (if due) using the async cache API."""
+        if self.is_due:
+            self._set_generation(await aget_generation(self.generation_key))
+
+    def _set_generation(self, generation: int) -> None:
+        self._generation = generation
+        self._checked_at = time.monotonic()
+
+    def make_key(self, *parts: Any) -> str:
+        """Return a cache key, in the current generation, made up of parts."""
+        return self._make_key(self.generation, parts)
+
+    async def amake_key(self, *parts: Any) -> str:
+        """Async version of make_key - never blocks on the cache."""
+        await self.arefresh()
+        return self._make_key(self._generation, parts)
+
+    def _make_key(self, generation: int, parts: Tuple[Any, ...]) -> str:
+        return ":".join([self.prefix, str(generation), *map(str, parts)])
+
+    def invalidate(self) -> int:
+        """Invalidate every key in the namespace, returning the new generation."""
+        generation = bump_generation(self.generation_key)
+        if generation <= self._generation:
+            # the counter has been evicted - carry on from the last one seen,
+            # rather than reuse a generation that may still have entries.
+            generation = self._generation + 1
+            cache.set(self.generation_key, generation, None)
+        self._set_generation(generation)
+        return generation
+
+
+# the namespace that token cache keys are built in
+cache_keys = CacheNamespace(
+    PERIMETER_CACHE_KEY_PREFIX, PERIMETER_CACHE_GENERATION_INTERVAL
+)
@@ -1,16 +1,17 @@
 from __future__ import annotations
 
-from typing import TYPE_CHECKING
-
 from django import forms
 from django.core.exceptions import ValidationError
 from django.http import HttpRequest
 
-from .models import AccessToken
-from .settings import PERIMETER_SESSION_KEY
-
-if TYPE_CHECKING:
-    from .models import AccessTokenUse
+from .audit import get_audit_backend
+from .grants import sign_grant
+from .models import AccessToken, AccessTokenUse, CachedToken, EmptyToken
+from .settings import (
+    PERIMETER_GRANT_SESSION_KEY,
+    PERIMETER_SESSION_KEY,
+    PERIMETER_SIGNED_GRANTS,
+)
 
 
 class TokenGatewayForm(forms.Form):
@@ -18,28 +19,43 @@ class TokenGatewayForm(forms.Form):
 
     token = forms.CharField(required=True, max_length=100)
 
-    def clean_token(self) -> AccessToken:
-        """Validate the token against existing tokens."""
-        try:
-            _token = AccessToken.objects.get(token=self.cleaned_data.get("token"))
-            if _token.has_expired:
-                raise ValidationError("Token has expired", code="expired")
-            if not _token.is_active:
-                raise ValidationError("Token is inactive", code="invalid")
-        except AccessToken.DoesNotExist:
-            raise ValidationError("Token not found", code="invalid")
-        else:
-            self._token = _token
-            return _token
+    def clean_token(self) -> CachedToken:
+        """
+        Validate the token against existing tokens.
+
+        This uses the same cache-aware lookup as the middleware, so the
+        database is only hit if the token (or the fact that it does not
+        exist) is not already cached.
+
+        """
+        token_value = self.cleaned_data.get("token")
+        token = AccessToken.objects.get_access_token(token_value)
+        if isinstance(token, EmptyToken):
+            raise ValidationError("Token not found", code="not_found")
+        if token.has_expired:
+            raise ValidationError("Token has expired", code="expired")
+        if not token.is_active:
+            raise ValidationError("Token is inactive", code="inactive")
+        self._token = token
+        self._token_value = token_value
+        return token
 
     def save_token(self, request: HttpRequest) -> AccessTokenUse:
-        """Record use of the token."""
-        request.session[PERIMETER_SESSION_KEY] = self._token.token
-        return self._token.record(
-            user_email=self.cleaned_data.get("email"),
-            user_name=self.cleaned_data.get("name"),
-            client_ip=request.META.get("REMOTE_ADDR", "unknown"),
-            client_user_agent=request.META.get("HTTP_USER_AGENT", "unknown"),
+        """Record use of the token (using the PERIMETER_AUDIT_BACKEND)."""
+        request.session[PERIMETER_SESSION_KEY] = self._token_value
+        # any grant is for the previous token (see set_request_token)
+        request.session.pop(PERIMETER_GRANT_SESSION_KEY, None)
+        # NB grants do not carry the token scope, so scoped tokens get none
+        if PERIMETER_SIGNED_GRANTS and not self._token.is_scoped:
+            request.session[PERIMETER_GRANT_SESSION_KEY] = sign_grant(self._token)
+        return get_audit_backend().record(
+            AccessTokenUse(
+                token_id=self._token.pk,
+                user_email=self.cleaned_data.get("email"),
+                user_name=self.cleaned_data.get("name"),
+                client_ip=request.META.get("REMOTE_ADDR", "unknown"),
+                client_user_agent=request.META.get("HTTP_USER_AGENT", "unknown"),
+            )
         )
 
     def save(self, request: HttpRequest) -> AccessTokenUse:
@@ -0,0 +1,45 @@
+"""
+Signed, short-lived access grants.
+
+Once a token has been validated, a grant recording the token id and expiry
+date is signed (using `django.core.signing`) and stored in the session. As
+long as the grant is younger than PERIMETER_GRANT_REFRESH_INTERVAL the
+middleware can trust it without looking up the token - when it is older
+the token is re-checked, and the grant re-issued.
+
+"""
+from __future__ import annotations
+
+import datetime
+from typing import Optional
+
+from django.core import signing
+
+from .models import CachedToken
+from .settings import PERIMETER_GRANT_REFRESH_INTERVAL
+
+GRANT_SALT = "perimeter.grant"
+
+
+def sign_grant(token: CachedToken) -> str:
+    """Return a signed grant for a (valid) token."""
+    return signing.dumps([token.pk, token.expires_on.toordinal()], salt=GRANT_SALT)
+
+
+def verify_grant(grant: Optional[str]) -> bool:
+    """
+    Return True if the grant is authentic, fresh and unexpired.
+
+    A grant that has a bad signature, is older than the refresh interval,
+    or belongs to a token that has since expired, is not valid.
+
+    """
+    if not grant:
+        return False
+    try:
+        _, expires_on = signing.loads(
+            grant, salt=GRANT_SALT, max_age=PERIMETER_GRANT_REFRESH_INTERVAL
+        )
+    except (signing.BadSignature, TypeError, ValueError):
+        return False
+    return expires_on >= datetime.date.today().toordinal()
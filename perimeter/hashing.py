@@ -0,0 +1,42 @@
+"""
+Keyed hashing of token values.
+
+Token values are hashed using HMAC-SHA256, keyed on
+PERIMETER_TOKEN_HASH_SECRET (or SECRET_KEY), so that neither the cache nor -
+with PERIMETER_TOKEN_STORAGE = "hashed" - the database holds usable token
+values. Cache keys and the Bloom filter are built from the digest.
+
+NB unless PERIMETER_TOKEN_HASH_SECRET is set (which it must be with
+"hashed" storage), rotating SECRET_KEY changes every digest.
+
+Lookups by digest are equality lookups on a unique index, and the digest
+of a guess tells an attacker nothing about how close it is to a real
+token, so there is nothing to learn from how long a lookup takes.
+
+"""
+import functools
+import hashlib
+import hmac
+
+from django.conf import settings
+from django.utils.encoding import force_bytes
+
+from .settings import PERIMETER_TOKEN_HASH_SECRET
+
+# NB changing this (or the secret) changes every digest
+KEY_SALT = "perimeter.models.AccessToken.token"
+
+
+@functools.lru_cache(maxsize=None)
+def _get_hmac(secret: str) -> "hmac.HMAC":
+    # the same key derivation as django.utils.crypto.salted_hmac, but done
+    # once - each hash then only needs to copy the keyed HMAC object.
+    key = hashlib.sha256(force_bytes(KEY_SALT + secret)).digest()
+    return hmac.new(key, digestmod=hashlib.sha256)
+
+
+def hash_token_value(token_value: str) -> str:
+    """Return the HMAC-SHA256 hex digest of a token value."""
+    mac = _get_hmac(PERIMETER_TOKEN_HASH_SECRET or settings.SECRET_KEY).copy()
+    mac.update(force_bytes(token_value))
+    return mac.hexdigest()
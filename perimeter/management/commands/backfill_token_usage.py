@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""
+Management command to (re)calculate token usage stats from AccessTokenUse.
+
+NB use records deleted by purge_perimeter are not counted, so run this
+before purging (or not at all, once the stats are being kept up to date).
+
+"""
+from argparse import ArgumentParser
+from typing import Any
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Count, Max, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+from perimeter.models import AccessToken, AccessTokenUse
+
+
+class Command(BaseCommand):
+    help = "Recalculate token use counts and last used timestamps."  # noqa: A003
+
+    def add_arguments(self, parser: ArgumentParser) -> None:
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="Number of tokens to update at a time",
+        )
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        batch_size = options["batch_size"]
+        if batch_size < 1:
+            raise CommandError("--batch-size must be positive")
+        uses = (
+            AccessTokenUse.objects.filter(token=OuterRef("pk"))
+            .order_by()
+            .values("token")
+        )
+        use_count = Subquery(uses.annotate(count=Count("pk")).values("count"))
+        last_used_at = Subquery(uses.annotate(last=Max("timestamp")).values("last"))
+        last_pk = 0
+        updated = 0
+        while True:
+            pks = list(
+                AccessToken.objects.filter(pk__gt=last_pk)
+                .order_by("pk")
+                .values_list("pk", flat=True)[:batch_size]
+            )
+            if not pks:
+                break
+            # one UPDATE per batch - the subqueries use the (token, timestamp)
+            # index on AccessTokenUse.
+            updated += AccessToken.objects.filter(pk__in=pks).update(
+                use_count=Coalesce(use_count, Value(0)), last_used_at=last_used_at
+            )
+            last_pk = pks[-1]
+        self.stdout.write(f"Updated usage stats for {updated} tokens")
@@ -47,7 +47,7 @@ class Command(BaseCommand):
                 )
             )
         except IntegrityError:
-            access_token = AccessToken.objects.get(token=token)
+            access_token = AccessToken.objects.filter_token(token).get()
             if has_expires:
                 self.stdout.write("Extending existing token")
                 access_token.expires_on = expires_on
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""
+Management command to hash existing token values, and remove the plaintext.
+
+Tokens are hashed when they are saved, and existing tokens are hashed by
+migration 0009, so this is only needed for tokens inserted some other way
+(e.g. by an older release still running during a deploy), and to remove
+plaintext values once PERIMETER_TOKEN_STORAGE is "hashed".
+
+"""
+from argparse import ArgumentParser
+from typing import Any
+
+from django.core.management.base import BaseCommand, CommandError
+
+from perimeter.hashing import hash_token_value
+from perimeter.models import AccessToken
+from perimeter.settings import PERIMETER_TOKEN_STORAGE
+
+
+class Command(BaseCommand):
+    help = "Hash token values, optionally removing the plaintext."  # noqa: A003
+
+    def add_arguments(self, parser: ArgumentParser) -> None:
+        parser.add_argument(
+            "--clear-plaintext",
+            action="store_true",
+            help="Remove plaintext token values (once they have been hashed)",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="Number of tokens to update at a time",
+        )
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        batch_size = options["batch_size"]
+        if batch_size < 1:
+            raise CommandError("--batch-size must be positive")
+        hashed_only = PERIMETER_TOKEN_STORAGE == "hashed"  # noqa: S105
+        if options["clear_plaintext"] and not hashed_only:
+            raise CommandError(
+                'PERIMETER_TOKEN_STORAGE must be "hashed" to clear plaintext tokens'
+            )
+        tokens = AccessToken.objects.filter(
+            token_hash__isnull=True, token__isnull=False
+        ).order_by("pk")
+        hashed = 0
+        # NB bulk_update, not save(), so updated_at and the cache are left alone
+        while batch := list(tokens.only("pk", "token")[:batch_size]):
+            for token in batch:
+                token.token_hash = hash_token_value(token.token)
+            hashed += AccessToken.objects.bulk_update(batch, ["token_hash"])
+        self.stdout.write(f"Hashed {hashed} tokens")
+        if options["clear_plaintext"]:
+            cleared = self.clear_plaintext(batch_size)
+            self.stdout.write(f"Cleared {cleared} plaintext tokens")
+
+    def clear_plaintext(self, batch_size: int) -> int:
+        """Set token to NULL on all hashed tokens, returning the number updated."""
+        tokens = AccessToken.objects.filter(
+            token_hash__isnull=False, token__isnull=False
+        )
+        cleared = 0
+        while pks := list(
+            tokens.order_by("pk").values_list("pk", flat=True)[:batch_size]
+        ):
+            cleared += AccessToken.objects.filter(pk__in=pks).update(token=None)
+        return cleared
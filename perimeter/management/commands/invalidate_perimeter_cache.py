@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+"""Management command to invalidate every token in the Perimeter cache."""
+from typing import Any
+
+from django.core.management.base import BaseCommand
+
+from perimeter.cache import cache_keys
+from perimeter.settings import PERIMETER_CACHE_GENERATION_INTERVAL
+
+
+class Command(BaseCommand):
+    help = "Invalidate all cached tokens (without touching other cache keys)."  # noqa: A003
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        generation = cache_keys.invalidate()
+        self.stdout.write(
+            f"Invalidated cached tokens (generation {generation}) - other "
+            f"processes will see this within {PERIMETER_CACHE_GENERATION_INTERVAL}s"
+        )
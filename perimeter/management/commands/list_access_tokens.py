@@ -1,18 +1,113 @@
 # -*- coding: utf-8 -*-
 """Management command to list all active tokens."""
-from typing import Any
+import csv
+import datetime
+import json
+from argparse import ArgumentParser
+from typing import Any, Dict, Iterator
 
+from django.contrib.auth import get_user_model
 from django.core.management.base import BaseCommand
+from django.db.models import QuerySet
 
 from perimeter.models import AccessToken
 
+FIELDS = ("token", "is_active", "expires_on", "created_at", "created_by")
+
 
 class Command(BaseCommand):
     help = "List all active tokens."  # noqa: A003
 
+    def add_arguments(self, parser: ArgumentParser) -> None:
+        parser.add_argument(
+            "-f",
+            "--format",
+            choices=["text", "json", "csv"],
+            default="text",
+            help="Output format",
+        )
+        filters = parser.add_mutually_exclusive_group()
+        filters.add_argument(
+            "--valid-only",
+            action="store_true",
+            help="Only list tokens that are active and have not expired",
+        )
+        filters.add_argument(
+            "--expired-only",
+            action="store_true",
+            help="Only list tokens that have expired",
+        )
+        parser.add_argument(
+            "--created-by",
+            help="Only list tokens created by the user with this username",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=2000,
+            help="Number of rows to fetch from the database at a time",
+        )
+
+    def get_queryset(self, **options: Any) -> QuerySet:
+        """Return the (filtered) tokens, with only the columns we need."""
+        today = datetime.date.today()
+        tokens = AccessToken.objects.order_by("pk")
+        if options["valid_only"]:
+            tokens = tokens.filter(is_active=True, expires_on__gte=today)
+        if options["expired_only"]:
+            tokens = tokens.filter(expires_on__lt=today)
+        username_field = get_user_model().USERNAME_FIELD
+        if options["created_by"]:
+            tokens = tokens.filter(
+                **{f"created_by__{username_field}": options["created_by"]}
+            )
+        return tokens.values_list(
+            "token",
+            "is_active",
+            "expires_on",
+            "created_at",
+            f"created_by__{username_field}",
+        )
+
+    def get_rows(self, **options: Any) -> Iterator[Dict[str, Any]]:
+        """Stream tokens from the database, `chunk_size` rows at a time."""
+        for values in self.get_queryset(**options).iterator(
+            chunk_size=options["chunk_size"]
+        ):
+            yield dict(zip(FIELDS, values))
+
     def handle(self, *args: Any, **options: Any) -> None:
+        rows = self.get_rows(**options)
+        if options["format"] == "json":
+            self.write_json(rows)
+        elif options["format"] == "csv":
+            self.write_csv(rows)
+        else:
+            self.write_text(rows)
+
+    def write_text(self, rows: Iterator[Dict[str, Any]]) -> None:
+        today = datetime.date.today()
         self.stdout.write("Listing all tokens:")
-        for token in AccessToken.objects.all():
-            prefix = "- " if token.is_valid else "x "
-            suffix = " expired " if token.has_expired else " expires "
-            self.stdout.write(f"{prefix} {token} {suffix} {token.expires_on}")
+        for row in rows:
+            has_expired = row["expires_on"] < today
+            is_valid = row["is_active"] and not has_expired
+            prefix = "- " if is_valid else "x "
+            suffix = " expired " if has_expired else " expires "
+            # NB tokens stored as hashes (only) cannot be listed
+            token = row["token"] or "(hashed)"
+            self.stdout.write(f"{prefix} {token} {suffix} {row['expires_on']}")
+
+    def write_json(self, rows: Iterator[Dict[str, Any]]) -> None:
+        # written a row at a time (rather than using json.dump on a list),
+        # so that the whole table is never held in memory.
+        self.stdout.write("[", ending="")
+        for i, row in enumerate(rows):
+            if i:
+                self.stdout.write(",", ending="")
+            self.stdout.write(json.dumps(row, default=str), ending="")
+        self.stdout.write("]")
+
+    def write_csv(self, rows: Iterator[Dict[str, Any]]) -> None:
+        writer = csv.DictWriter(self.stdout, fieldnames=FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
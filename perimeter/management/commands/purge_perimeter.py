@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""Management command to delete expired tokens and old audit records."""
+import datetime
+import time
+from argparse import ArgumentParser
+from typing import Any, List
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import QuerySet
+from django.utils.timezone import now
+
+from perimeter.cache import cache, local_cache
+from perimeter.models import AccessToken, AccessTokenUse
+
+
+class Command(BaseCommand):
+    help = "Delete expired tokens and old token use records."  # noqa: A003
+
+    def add_arguments(self, parser: ArgumentParser) -> None:
+        parser.add_argument(
+            "--older-than",
+            type=int,
+            default=90,
+            help=(
+                "Delete tokens that expired, and token use records made, "
+                "more than this many days ago (default: 90)"
+            ),
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Report what would be deleted, without deleting anything",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="Max number of rows to delete at a time",
+        )
+        parser.add_argument(
+            "--sleep",
+            type=float,
+            default=0.1,
+            help="Seconds to pause between batches",
+        )
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        if options["older_than"] < 0 or options["batch_size"] < 1:
+            raise CommandError("--older-than and --batch-size must be positive")
+        self.batch_size = options["batch_size"]
+        self.sleep = options["sleep"]
+        cutoff = now() - datetime.timedelta(days=options["older_than"])
+        token_uses = AccessTokenUse.objects.filter(timestamp__lt=cutoff)
+        tokens = AccessToken.objects.filter(expires_on__lt=cutoff.date())
+        if options["dry_run"]:
+            self.stdout.write(
+                f"Would delete {token_uses.count()} token use records "
+                f"(made before {cutoff:%Y-%m-%d})"
+            )
+            self.stdout.write(
+                f"Would delete {tokens.count()} tokens "
+                f"(expired before {cutoff.date()})"
+            )
+            return
+        deleted = self.purge_token_uses(token_uses)
+        self.stdout.write(f"Deleted {deleted} token use records")
+        deleted = self.purge_tokens(tokens)
+        self.stdout.write(f"Deleted {deleted} tokens")
+
+    def get_batch(self, queryset: QuerySet, *fields: str) -> List[Any]:
+        """Return the next batch of rows to delete, in pk order."""
+        return list(queryset.order_by("pk").values_list(*fields)[: self.batch_size])
+
+    def get_pks(self, queryset: QuerySet) -> List[int]:
+        """Return the pks of the next batch of rows to delete."""
+        return [pk for pk, in self.get_batch(queryset, "pk")]
+
+    def pause(self) -> None:
+        # give other queries a chance to get at the table between batches
+        if self.sleep > 0:
+            time.sleep(self.sleep)
+
+    def purge_token_uses(self, queryset: QuerySet) -> int:
+        """Delete token use records in batches, returning the number deleted."""
+        total = 0
+        while pks := self.get_pks(queryset):
+            # AccessTokenUse has no signals or dependents, so this is a
+            # single DELETE ... WHERE id IN (...)
+            total += AccessTokenUse.objects.filter(pk__in=pks).delete()[0]
+            self.pause()
+        return total
+
+    def purge_tokens(self, queryset: QuerySet) -> int:
+        """
+        Delete tokens in batches, returning the number deleted.
+
+        A token's use records are deleted first (in batches of their own),
+        so that deleting the tokens does not cascade. Tokens are then
+        deleted without loading them or sending post_delete signals, and
+        removed from the cache with a single delete_many per batch.
+
+        """
+        total = 0
+        while batch := self.get_batch(queryset, "pk", "token_hash", "token"):
+            pks = [pk for pk, _, _ in batch]
+            self.purge_token_uses(AccessTokenUse.objects.filter(token_id__in=pks))
+            # NB re-apply the filter, in case a token has been extended since
+            total += queryset.filter(pk__in=pks)._raw_delete(queryset.db)
+            cache_keys = [
+                (
+                    AccessToken.get_hash_cache_key(token_hash)
+                    if token_hash
+                    else AccessToken.get_cache_key(token)
+                )
+                for _, token_hash, token in batch
+            ]
+            cache.delete_many(cache_keys)
+            for cache_key in cache_keys:
+                local_cache.delete(cache_key)
+            self.pause()
+        return total
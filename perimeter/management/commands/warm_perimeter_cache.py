@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+"""Management command to load all valid tokens into the cache."""
+import time
+from argparse import ArgumentParser
+from typing import Any
+
+from django.core.management.base import BaseCommand, CommandError
+
+from perimeter.models import AccessToken
+
+
+class Command(BaseCommand):
+    help = "Load all valid tokens into the cache."  # noqa: A003
+
+    def add_arguments(self, parser: ArgumentParser) -> None:
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=1000,
+            help="Number of tokens to read (and cache) at a time",
+        )
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        chunk_size = options["chunk_size"]
+        if chunk_size < 1:
+            raise CommandError("--chunk-size must be positive")
+        start = time.monotonic()
+        result = AccessToken.objects.warm_cache(chunk_size=chunk_size)
+        if result is None:
+            self.stdout.write("Cache is already being warmed by another process")
+            return
+        found, cached = result
+        self.stdout.write(
+            f"Cached {cached} of {found} valid tokens "
+            f"in {time.monotonic() - start:.2f}s"
+        )
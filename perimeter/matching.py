@@ -0,0 +1,104 @@
+"""
+Compiled request path (and host) matching.
+
+Rules are compiled once (e.g. when the middleware is created) so that
+matching a request path is cheap - a set lookup, a single `str.startswith`
+call across all prefixes, and a single alternation regex.
+
+Token scopes are compiled the same way - once per distinct scope, however
+many tokens share it or requests use it (see `compile_scope`).
+
+"""
+from __future__ import annotations
+
+import functools
+import re
+from typing import Iterable, Optional, Pattern, Tuple
+
+from django.http.request import split_domain_port
+
+
+class PathMatcher:
+    """
+    Match paths against exact paths, path prefixes and regex patterns.
+
+    Patterns are matched from the start of the path (as with `re.match`).
+
+    """
+
+    def __init__(
+        self,
+        paths: Iterable[str] = (),
+        prefixes: Iterable[str] = (),
+        patterns: Iterable[str] = (),
+    ) -> None:
+        self.paths = frozenset(paths)
+        # str.startswith accepts a tuple, which is checked in C - this beats
+        # walking a trie in Python for any realistic number of prefixes.
+        self.prefixes = tuple(sorted(set(prefixes)))
+        patterns = list(patterns)
+        self.pattern: Optional[Pattern] = (
+            re.compile("|".join(f"(?:{p})" for p in patterns)) if patterns else None
+        )
+
+    def __bool__(self) -> bool:
+        return bool(self.paths or self.prefixes or self.pattern)
+
+    def __call__(self, path: str) -> bool:
+        """Return True if the path matches any of the rules."""
+        if path in self.paths or path.startswith(self.prefixes):
+            return True
+        return self.pattern is not None and self.pattern.match(path) is not None
+
+
+class HostMatcher:
+    """
+    Match hosts against patterns, using the same rules as ALLOWED_HOSTS.
+
+    "example.com" matches exactly, ".example.com" matches example.com and
+    any subdomain of it, and "*" matches everything. Any port is ignored.
+
+    """
+
+    def __init__(self, patterns: Iterable[str] = ()) -> None:
+        patterns = {p.lower() for p in patterns}
+        self.match_all = "*" in patterns
+        self.hosts = frozenset(p[1:] if p.startswith(".") else p for p in patterns)
+        self.suffixes = tuple(sorted(p for p in patterns if p.startswith(".")))
+
+    def __bool__(self) -> bool:
+        return bool(self.match_all or self.hosts)
+
+    def __call__(self, host: str) -> bool:
+        """Return True if the host (which may include a port) matches."""
+        if self.match_all:
+            return True
+        domain, _ = split_domain_port(host)
+        return domain in self.hosts or domain.endswith(self.suffixes)
+
+
+class TokenScope:
+    """
+    The hosts and paths that a token grants access to.
+
+    A request is in scope if its host matches one of the host patterns and
+    its path starts with one of the path prefixes - an empty list of either
+    allows everything.
+
+    """
+
+    def __init__(self, hosts: Iterable[str] = (), paths: Iterable[str] = ()) -> None:
+        self.hosts = HostMatcher(hosts)
+        self.paths = PathMatcher(prefixes=paths)
+
+    def __call__(self, host: str, path: str) -> bool:
+        """Return True if a request to host / path is in scope."""
+        if self.paths and not self.paths(path):
+            return False
+        return not self.hosts or self.hosts(host)
+
+
+@functools.lru_cache(maxsize=1024)
+def compile_scope(hosts: Tuple[str, ...], paths: Tuple[str, ...]) -> TokenScope:
+    """Return the (cached) TokenScope for a set of host patterns / path prefixes."""
+    return TokenScope(hosts, paths)
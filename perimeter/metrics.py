@@ -0,0 +1,169 @@
+"""
+Instrumentation hooks for token validation.
+
+Perimeter reports what it is doing to a metrics sink - counters for each
+outcome of a request, and a histogram of the time taken to validate the
+token. The sink is set using the PERIMETER_METRICS_SINK setting; the
+default sink does nothing (and validation is not timed at all), and
+InMemoryRegistry keeps Prometheus-style metrics in process.
+
+Counters:
+
+    bloom_reject   token rejected by the Bloom filter (without a lookup)
+    bypass         request bypassed the perimeter
+    grant          request let through with a signed grant
+    cache_hit      token (or a cached miss) found in the local or Django cache
+    cache_miss     token not found in the cache, so looked up in the database
+    db_miss        token not found in the database
+    early_refresh  cached token refreshed from the database before going stale
+    expired        request made with an expired token
+    inactive       request made with an inactive token
+    out_of_scope   request outside the scope of its token
+    redirect       request redirected to the gateway
+    throttled      gateway POST rejected by the rate limit
+
+Histograms:
+
+    validation_seconds  time taken to look up and validate a token
+
+"""
+from __future__ import annotations
+
+import bisect
+import math
+import threading
+from collections import defaultdict
+from typing import Any, Dict, List, Sequence
+
+from django.utils.module_loading import import_string
+
+from .settings import PERIMETER_METRICS_SINK
+
+
+class MetricsSink:
+    """Metrics sink that does nothing - the default."""
+
+    # if False then values that are expensive to collect (e.g. timings)
+    # are not collected at all.
+    enabled = False
+
+    def increment(self, name: str, value: int = 1) -> None:
+        """Increment a counter."""
+
+    def observe(self, name: str, value: float) -> None:
+        """Record a value in a histogram."""
+
+
+class InMemoryRegistry(MetricsSink):
+    """
+    Prometheus-style registry of counters and histograms, held in memory.
+
+    Metrics are per-process. Use `collect` to get a snapshot of the current
+    values, or `render` to get them in the Prometheus text format (e.g. to
+    serve from a metrics view).
+
+    """
+
+    enabled = True
+
+    # histogram bucket upper bounds, in seconds
+    DEFAULT_BUCKETS = (
+        0.00005,
+        0.0001,
+        0.00025,
+        0.0005,
+        0.001,
+        0.0025,
+        0.005,
+        0.01,
+        0.025,
+        0.05,
+        0.1,
+        math.inf,
+    )
+
+    def __init__(self, buckets: Sequence[float] = DEFAULT_BUCKETS) -> None:
+        self.buckets = tuple(sorted(buckets))
+        if self.buckets[-1] != math.inf:
+            self.buckets += (math.inf,)
+        self._lock = threading.Lock()
+        self._counters: Dict[str, int] = defaultdict(int)
+        self._histograms: Dict[str, List[float]] = {}
+
+    def increment(self, name: str, value: int = 1) -> None:
+        with self._lock:
+            self._counters[name] += value
+
+    def observe(self, name: str, value: float) -> None:
+        # [bucket counts..., sum, count]
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = [0] * (len(self.buckets) + 2)
+            histogram[index] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    def reset(self) -> None:
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def collect(self) -> Dict[str, Any]:
+        """
+        Return a snapshot of all metrics.
+
+        Histogram buckets are cumulative (as in Prometheus) - each bucket
+        counts the observations less than or equal to its upper bound.
+
+        """
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {k: list(v) for k, v in self._histograms.items()}
+        return {
+            "counters": counters,
+            "histograms": {
+                name: {
+                    "buckets": dict(
+                        zip(
+                            self.buckets,
+                            _cumulative(values[: len(self.buckets)]),
+                        )
+                    ),
+                    "sum": values[-2],
+                    "count": values[-1],
+                }
+                for name, values in histograms.items()
+            },
+        }
+
+    def render(self, prefix: str = "perimeter_") -> str:
+        """Return all metrics in the Prometheus text exposition format."""
+        snapshot = self.collect()
+        lines = []
+        for name, value in sorted(snapshot["counters"].items()):
+            lines.append(f"# TYPE {prefix}{name}_total counter")
+            lines.append(f"{prefix}{name}_total {value}")
+        for name, histogram in sorted(snapshot["histograms"].items()):
+            lines.append(f"# TYPE {prefix}{name} histogram")
+            for bound, count in histogram["buckets"].items():
+                le = "+Inf" if bound == math.inf else repr(bound)
+                lines.append(f'{prefix}{name}_bucket{{le="{le}"}} {count}')
+            lines.append(f"{prefix}{name}_sum {histogram['sum']}")
+            lines.append(f"{prefix}{name}_count {histogram['count']}")
+        return "\n".join(lines) + "\n"
+
+
+def _cumulative(values: Sequence[float]) -> List[float]:
+    total: float = 0
+    result = []
+    for value in values:
+        total += value
+        result.append(total)
+    return result
+
+
+# the process-wide sink - use `metrics.sink.increment(...)` rather than
+# importing this directly, so that it can be replaced (e.g. in tests).
+sink: MetricsSink = import_string(PERIMETER_METRICS_SINK)()
@@ -4,58 +4,153 @@ Check all incoming requests for a valid token.
 See Perimeter docs for more details.
 
 """
+import inspect
+import time
 from typing import Any, Callable, Optional, Union
 from urllib.parse import urlencode
 
+from asgiref.sync import sync_to_async
 from django.core.exceptions import ImproperlyConfigured, MiddlewareNotUsed
 from django.http import HttpRequest, HttpResponse, HttpResponseRedirect
 from django.urls import reverse
 from django.utils.deprecation import MiddlewareMixin
 
-from .models import AccessToken, EmptyToken
+from . import metrics
+from .grants import sign_grant, verify_grant
+from .matching import PathMatcher
+from .models import AccessToken, CachedToken, EmptyToken
 from .settings import (
     HTTP_X_PERIMETER_TOKEN,
     PERIMETER_BYPASS_FUNCTION as bypass_perimeter,
+    PERIMETER_BYPASS_PATHS,
+    PERIMETER_BYPASS_PATTERNS,
+    PERIMETER_BYPASS_PREFIXES,
     PERIMETER_ENABLED,
+    PERIMETER_GRANT_SESSION_KEY,
     PERIMETER_SESSION_KEY,
+    PERIMETER_SIGNED_GRANTS,
 )
 
 
+def _check_session(request: HttpRequest) -> None:
+    if not hasattr(request, "session"):
+        raise ImproperlyConfigured(
+            "Missing session attribute - please check MIDDLEWARE_CLASSES for "
+            "'django.contrib.sessions.middleware.SessionMiddleware'."
+        )
+
+
 def check_middleware(func: Callable) -> Callable:
-    """Check a request arg has a Session attached."""
+    """Check a request arg has a Session attached (works on async functions)."""
+    if inspect.iscoroutinefunction(func):
+
+        async def ainner(request: HttpRequest, *args: Any) -> Any:
+            _check_session(request)
+            return await func(request, *args)
+
+        return ainner
 
-    # noqa: blank line to make black and flake8 play nicely
     def inner(request: HttpRequest, *args: Any) -> Optional[HttpResponse]:
-        if not hasattr(request, "session"):
-            raise ImproperlyConfigured(
-                "Missing session attribute - please check MIDDLEWARE_CLASSES for "
-                "'django.contrib.sessions.middleware.SessionMiddleware'."
-            )
+        _check_session(request)
         return func(request, *args)
 
     return inner
 
 
+def get_header_token(request: HttpRequest) -> Optional[str]:
+    """Extract token string from the X-Perimeter-Token HTTP header."""
+    return request.META.get(HTTP_X_PERIMETER_TOKEN, None)
+
+
+@check_middleware
+def get_session_value(request: HttpRequest, key: str) -> Any:
+    """
+    Return a value from the request.session.
+
+    NB this will load the session (a cache / database hit, depending on the
+    session backend) if it has not already been loaded.
+
+    """
+    return request.session.get(key, None)
+
+
 @check_middleware
+async def aget_session_value(request: HttpRequest, key: str) -> Any:
+    """Async version of get_session_value."""
+    session = request.session
+    if hasattr(session, "aget"):
+        # async session API (Django 5.1+)
+        return await session.aget(key, None)
+    # loading the session may hit the database, so must not run in the loop
+    return await sync_to_async(session.get)(key, None)
+
+
 def get_request_token(request: HttpRequest) -> Optional[str]:
-    """Extract token string from HTTP header or querystring."""
-    return request.META.get(HTTP_X_PERIMETER_TOKEN, None) or request.session.get(
-        PERIMETER_SESSION_KEY, None
+    """
+    Extract token string from HTTP header or session.
+
+    The session is only used (and so loaded) if the header is not set.
+
+    """
+    return get_header_token(request) or get_session_value(
+        request, PERIMETER_SESSION_KEY
+    )
+
+
+async def aget_request_token(request: HttpRequest) -> Optional[str]:
+    """Async version of get_request_token."""
+    return get_header_token(request) or await aget_session_value(
+        request, PERIMETER_SESSION_KEY
     )
 
 
 @check_middleware
 def set_request_token(request: HttpRequest, token_value: str) -> None:
-    """Set the request.session token value."""
+    """Set the request.session token value (and clear any existing grant)."""
     request.session[PERIMETER_SESSION_KEY] = token_value
+    request.session.pop(PERIMETER_GRANT_SESSION_KEY, None)
+
+
+def has_request_grant(request: HttpRequest) -> bool:
+    """
+    Return True if the request.session contains a valid signed grant.
 
+    Requests using the X-Perimeter-Token header are always checked against
+    the token itself, so they never have a grant (and never use the session).
 
-def get_access_token(request: HttpRequest) -> Union[AccessToken, EmptyToken]:
+    """
+    if get_header_token(request):
+        return False
+    return verify_grant(get_session_value(request, PERIMETER_GRANT_SESSION_KEY))
+
+
+async def ahas_request_grant(request: HttpRequest) -> bool:
+    """Async version of has_request_grant."""
+    if get_header_token(request):
+        return False
+    return verify_grant(await aget_session_value(request, PERIMETER_GRANT_SESSION_KEY))
+
+
+def set_request_grant(request: HttpRequest, token: CachedToken) -> None:
+    """Store a signed grant for a (valid) token in the request.session."""
+    if get_header_token(request):
+        return
+    _check_session(request)
+    request.session[PERIMETER_GRANT_SESSION_KEY] = sign_grant(token)
+
+
+def get_access_token(request: HttpRequest) -> Union[CachedToken, EmptyToken]:
     """Fetch the AccessToken from the request."""
     token_value = get_request_token(request)
     return AccessToken.objects.get_access_token(token_value)
 
 
+async def aget_access_token(request: HttpRequest) -> Union[CachedToken, EmptyToken]:
+    """Fetch the AccessToken from the request (async version)."""
+    token_value = await aget_request_token(request)
+    return await AccessToken.objects.aget_access_token(token_value)
+
+
 def get_redirect_url(request: HttpRequest) -> str:
     """Unpack request and extract a valid redirect url."""
     qstring = urlencode({"next": request.get_full_path()})
@@ -69,8 +164,30 @@ class PerimeterAccessMiddleware(MiddlewareMixin):
 
     This middleware will be disabled if the PERIMETER_ENABLED setting does not
     exist in django settings, or is False.
+
+    The middleware supports both sync (WSGI) and async (ASGI) stacks - when
+    the next handler is async the request is checked natively using the
+    async cache, ORM and session APIs, rather than in a thread.
+
+    Requests matching the PERIMETER_BYPASS_PATHS, PERIMETER_BYPASS_PREFIXES
+    or PERIMETER_BYPASS_PATTERNS settings (compiled once, when the middleware
+    is created) are let straight through.
+
+    If PERIMETER_SIGNED_GRANTS is True then a request carrying a valid
+    signed grant in its session is let through without looking up the
+    token at all - see `perimeter.grants`.
+
+    Tokens can be scoped to some hosts / path prefixes, in which case
+    requests outside the scope are sent to the gateway. The scope travels
+    with the cached token, so checking it costs no extra lookups.
+
+    The outcome of each request is reported to the metrics sink - see
+    `perimeter.metrics`.
     """
 
+    sync_capable = True
+    async_capable = True
+
     def __init__(self, *args: Any, **kwargs: Any) -> None:
         """
         Disable middleware if PERIMETER_ENABLED setting not True.
@@ -81,13 +198,73 @@ class PerimeterAccessMiddleware(MiddlewareMixin):
         if PERIMETER_ENABLED is False:
             raise MiddlewareNotUsed("Perimeter disabled")
         super().__init__(*args, **kwargs)
+        self.bypass_paths = PathMatcher(
+            paths=PERIMETER_BYPASS_PATHS,
+            prefixes=PERIMETER_BYPASS_PREFIXES,
+            patterns=PERIMETER_BYPASS_PATTERNS,
+        )
+
+    async def __acall__(self, request: HttpRequest) -> HttpResponse:
+        """Process an async request without handing off to a thread."""
+        response = await self.aprocess_request(request)
+        if response is None:
+            response = await self.get_response(request)
+        return response
 
     def process_request(self, request: HttpRequest) -> Optional[HttpResponseRedirect]:
         """Check user session for token."""
-        if bypass_perimeter(request):
+        if self.bypass_paths(request.path) or bypass_perimeter(request):
+            metrics.sink.increment("bypass")
+            return None
+
+        if PERIMETER_SIGNED_GRANTS and has_request_grant(request):
+            metrics.sink.increment("grant")
             return None
 
-        if get_access_token(request).is_valid:
+        if metrics.sink.enabled:
+            start = time.perf_counter()
+            token = get_access_token(request)
+            metrics.sink.observe("validation_seconds", time.perf_counter() - start)
+        else:
+            token = get_access_token(request)
+        return self.check_token(request, token)
+
+    async def aprocess_request(
+        self, request: HttpRequest
+    ) -> Optional[HttpResponseRedirect]:
+        """Check user session for token (async version)."""
+        if self.bypass_paths(request.path) or bypass_perimeter(request):
+            metrics.sink.increment("bypass")
+            return None
+
+        if PERIMETER_SIGNED_GRANTS and await ahas_request_grant(request):
+            metrics.sink.increment("grant")
+            return None
+
+        if metrics.sink.enabled:
+            start = time.perf_counter()
+            token = await aget_access_token(request)
+            metrics.sink.observe("validation_seconds", time.perf_counter() - start)
+        else:
+            token = await aget_access_token(request)
+        return self.check_token(request, token)
+
+    def check_token(
+        self, request: HttpRequest, token: Union[CachedToken, EmptyToken]
+    ) -> Optional[HttpResponseRedirect]:
+        """Return None if the token is valid (and in scope), else redirect."""
+        scope = token.scope if isinstance(token, CachedToken) else None
+        if token.is_valid and scope is None:
+            if PERIMETER_SIGNED_GRANTS and isinstance(token, CachedToken):
+                set_request_grant(request, token)
             return None
 
+        if token.is_valid and scope is not None:
+            # NB no grant - grants do not carry the scope
+            if scope(request.get_host(), request.path):
+                return None
+            metrics.sink.increment("out_of_scope")
+        elif isinstance(token, CachedToken):
+            metrics.sink.increment("inactive" if not token.is_active else "expired")
+        metrics.sink.increment("redirect")
         return HttpResponseRedirect(get_redirect_url(request))
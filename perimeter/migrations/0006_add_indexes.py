@@ -0,0 +1,24 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [("perimeter", "0005_auto_20180520_1037")]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="accesstoken",
+            index=models.Index(
+                fields=["expires_on", "is_active"], name="perimeter_token_expiry_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="accesstokenuse",
+            index=models.Index(
+                fields=["token", "timestamp"], name="perimeter_use_token_ts_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="accesstokenuse",
+            index=models.Index(fields=["timestamp"], name="perimeter_use_ts_idx"),
+        ),
+    ]
@@ -0,0 +1,18 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [("perimeter", "0006_add_indexes")]
+
+    operations = [
+        migrations.AddField(
+            model_name="accesstoken",
+            name="last_used_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="accesstoken",
+            name="use_count",
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,20 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [("perimeter", "0007_usage_stats")]
+
+    operations = [
+        migrations.AddField(
+            model_name="accesstoken",
+            name="token_hash",
+            field=models.CharField(
+                editable=False, max_length=64, null=True, unique=True
+            ),
+        ),
+        migrations.AlterField(
+            model_name="accesstoken",
+            name="token",
+            field=models.CharField(blank=True, max_length=50, null=True, unique=True),
+        ),
+    ]
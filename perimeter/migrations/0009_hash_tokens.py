@@ -0,0 +1,25 @@
+from django.db import migrations
+
+from perimeter.hashing import hash_token_value
+
+BATCH_SIZE = 1000
+
+
+def hash_tokens(apps, schema_editor):
+    """Set token_hash on all existing tokens."""
+    AccessToken = apps.get_model("perimeter", "AccessToken")
+    tokens = AccessToken.objects.using(schema_editor.connection.alias).filter(
+        token_hash__isnull=True, token__isnull=False
+    )
+    while batch := list(tokens.order_by("pk").only("pk", "token")[:BATCH_SIZE]):
+        for token in batch:
+            token.token_hash = hash_token_value(token.token)
+        AccessToken.objects.using(schema_editor.connection.alias).bulk_update(
+            batch, ["token_hash"]
+        )
+
+
+class Migration(migrations.Migration):
+    dependencies = [("perimeter", "0008_token_hash")]
+
+    operations = [migrations.RunPython(hash_tokens, migrations.RunPython.noop)]
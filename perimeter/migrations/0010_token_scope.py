@@ -0,0 +1,30 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [("perimeter", "0009_hash_tokens")]
+
+    operations = [
+        migrations.AddField(
+            model_name="accesstoken",
+            name="scope_hosts",
+            field=models.TextField(
+                blank=True,
+                help_text=(
+                    "Hosts the token can be used on, one per line - '.example.com' "
+                    "matches example.com and its subdomains. Blank for all hosts."
+                ),
+            ),
+        ),
+        migrations.AddField(
+            model_name="accesstoken",
+            name="scope_paths",
+            field=models.TextField(
+                blank=True,
+                help_text=(
+                    "Path prefixes the token can be used on, one per line - e.g. "
+                    "'/previews/acme/'. Blank for all paths."
+                ),
+            ),
+        ),
+    ]
@@ -1,17 +1,75 @@
 from __future__ import annotations
 
+import asyncio
 import datetime
+import functools
+import itertools
+import math
 import random
-from typing import Any, Type, Union
+import time
+from typing import Any, Dict, List, Optional, Tuple, Type, Union
 
+import django
+from asgiref.sync import sync_to_async
 from django.conf import settings
-from django.core.cache import cache
-from django.db import models
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, models, transaction
 from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 from django.utils import timezone
 
-from .settings import PERIMETER_DEFAULT_EXPIRY
+from . import metrics
+from .bloom import token_filter
+from .cache import cache, cache_keys, fill_locks, local_cache
+from .hashing import hash_token_value
+from .matching import TokenScope, compile_scope
+from .settings import (
+    PERIMETER_CACHE_EARLY_REFRESH,
+    PERIMETER_CACHE_INVALID_TIMEOUT,
+    PERIMETER_CACHE_KEY_PREFIX,
+    PERIMETER_CACHE_LOCK_TIMEOUT,
+    PERIMETER_CACHE_MAX_TIMEOUT,
+    PERIMETER_CACHE_MIN_TIMEOUT,
+    PERIMETER_CACHE_TIMEOUT_JITTER,
+    PERIMETER_DEFAULT_EXPIRY,
+    PERIMETER_NEGATIVE_CACHE_TIMEOUT,
+    PERIMETER_TOKEN_STORAGE,
+)
+
+# Cached in place of a token that does not exist - distinct from None, which
+# the cache returns for a missing key.
+TOKEN_NOT_FOUND = "perimeter.token-not-found"  # noqa: S105
+
+# AccessToken fields that are only updated using record_usage
+USAGE_FIELDS = ("use_count", "last_used_at")
+
+# Number of times to try inserting a batch of new tokens before giving up -
+# a clash between random token values is very unlikely, but not impossible.
+BULK_CREATE_ATTEMPTS = 3
+
+# How often, in seconds, to check the cache while another process refills it
+LOCK_POLL_INTERVAL = 0.05
+
+# Max time, in seconds, that a thread waits for another thread to refill the cache
+FILL_WAIT_TIMEOUT = 1
+
+# Max time, in seconds, that one process can hold the cache warm-up lock
+WARM_LOCK_TIMEOUT = 300
+
+# AccessToken fields that a CachedToken is made from (see CachedToken.from_values)
+CACHED_FIELDS = ("pk", "is_active", "expires_on", "scope_hosts", "scope_paths")
+
+# Async cache refills in progress, keyed on cache key (see _aload_access_token)
+_pending_fills: Dict[str, asyncio.Future] = {}
+
+
+def _fill_done(cache_key: str, task: asyncio.Future) -> None:
+    """Remove a finished refill from _pending_fills."""
+    if _pending_fills.get(cache_key) is task:
+        del _pending_fills[cache_key]
+    if not task.cancelled():
+        # mark any exception as retrieved, in case nobody is waiting
+        task.exception()
 
 
 def default_expiry() -> datetime.date:
@@ -19,6 +77,49 @@ def default_expiry() -> datetime.date:
     return (timezone.now() + datetime.timedelta(days=PERIMETER_DEFAULT_EXPIRY)).date()
 
 
+def seconds_until(date: datetime.date) -> int:
+    """Return the number of seconds until the start of date."""
+    expires_at = datetime.datetime.combine(date, datetime.time.min)
+    if settings.USE_TZ and timezone.is_naive(expires_at):
+        expires_at = timezone.make_aware(expires_at, timezone.get_current_timezone())
+    elif not settings.USE_TZ and timezone.is_aware(expires_at):
+        expires_at = timezone.make_naive(expires_at)
+    return int((expires_at - timezone.now()).total_seconds())
+
+
+def split_scope(value: Optional[str]) -> Tuple[str, ...]:
+    """Split a scope field (one host / path per line) into a tuple."""
+    return tuple(line.strip() for line in (value or "").splitlines() if line.strip())
+
+
+def get_cache_timeout(token: CachedToken) -> int:
+    """
+    Return the number of seconds for which to cache a token.
+
+    Valid tokens are cached until they expire, but for no less than
+    PERIMETER_CACHE_MIN_TIMEOUT and no more than PERIMETER_CACHE_MAX_TIMEOUT
+    seconds. Expired and inactive tokens are cached for the (short)
+    PERIMETER_CACHE_INVALID_TIMEOUT. Validity is always checked against the
+    cached expiry date, so caching a token past its expiry is safe.
+
+    The timeout is then shortened by a random amount (up to
+    PERIMETER_CACHE_TIMEOUT_JITTER percent), and is always at least one
+    second - backends disagree on what a zero or negative timeout means.
+
+    """
+    if token.is_valid:
+        timeout = min(
+            max(token.seconds_to_expiry, PERIMETER_CACHE_MIN_TIMEOUT),
+            PERIMETER_CACHE_MAX_TIMEOUT,
+        )
+    else:
+        timeout = PERIMETER_CACHE_INVALID_TIMEOUT
+    if PERIMETER_CACHE_TIMEOUT_JITTER > 0:
+        jitter = timeout * PERIMETER_CACHE_TIMEOUT_JITTER / 100
+        timeout -= int(jitter * random.random())  # noqa: S311
+    return max(timeout, 1)
+
+
 class EmptyToken(object):
     """
     Token-like object that will always return is_valid() == False.
@@ -33,6 +134,157 @@ class EmptyToken(object):
         return False
 
 
+class CachedToken:
+    """
+    Lightweight copy of an AccessToken, as stored in the cache.
+
+    This is what the middleware validates against - it carries just enough
+    to answer `is_valid`, and is stored in the cache as a small versioned
+    tuple of primitives (see `to_payload`) rather than as a pickled model
+    instance. The full AccessToken can be loaded from the database if it is
+    actually needed.
+
+    The payload also records when its cache entry goes stale (as a unix
+    timestamp), so that it can be refreshed early - see
+    PERIMETER_CACHE_EARLY_REFRESH - and the token's scope (host patterns
+    and path prefixes), which is compiled into a matcher the first time it
+    is used - see `scope`.
+
+    """
+
+    __slots__ = (
+        "pk",
+        "is_active",
+        "expires_on",
+        "stale_at",
+        "hosts",
+        "paths",
+        "_scope",
+    )
+
+    # bump this whenever the payload format changes - payloads with a
+    # different version are treated as cache misses.
+    VERSION = 3
+
+    def __init__(
+        self,
+        pk: int,
+        is_active: bool,
+        expires_on: datetime.date,
+        stale_at: int = 0,
+        hosts: Tuple[str, ...] = (),
+        paths: Tuple[str, ...] = (),
+    ) -> None:
+        self.pk = pk
+        self.is_active = is_active
+        self.expires_on = expires_on
+        self.stale_at = stale_at
+        self.hosts = hosts
+        self.paths = paths
+        self._scope: Optional[TokenScope] = None
+
+    def __repr__(self) -> str:
+        return "<CachedToken: %s (%s, %s)>" % (
+            self.pk,
+            "active" if self.is_active else "inactive",
+            self.expires_on,
+        )
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, CachedToken):
+            return NotImplemented
+        return (self.pk, self.is_active, self.expires_on, self.hosts, self.paths) == (
+            other.pk,
+            other.is_active,
+            other.expires_on,
+            other.hosts,
+            other.paths,
+        )
+
+    @classmethod
+    def from_token(cls, token: AccessToken) -> CachedToken:
+        return cls.from_values(
+            token.pk,
+            token.is_active,
+            token.expires_on,
+            token.scope_hosts,
+            token.scope_paths,
+        )
+
+    @classmethod
+    def from_values(
+        cls,
+        pk: int,
+        is_active: bool,
+        expires_on: datetime.date,
+        scope_hosts: str,
+        scope_paths: str,
+    ) -> CachedToken:
+        """Return CachedToken from AccessToken field values (see CACHED_FIELDS)."""
+        return cls(
+            pk,
+            is_active,
+            expires_on,
+            hosts=split_scope(scope_hosts),
+            paths=split_scope(scope_paths),
+        )
+
+    @classmethod
+    def from_payload(cls, payload: Any) -> Optional[CachedToken]:
+        """Return CachedToken from a cache payload, or None if it's not valid."""
+        if not isinstance(payload, tuple) or payload[0] != cls.VERSION:
+            return None
+        _, pk, is_active, expires_on, stale_at, hosts, paths = payload
+        return cls(
+            pk, is_active, datetime.date.fromordinal(expires_on), stale_at, hosts, paths
+        )
+
+    def to_payload(
+        self,
+    ) -> Tuple[int, int, bool, int, int, Tuple[str, ...], Tuple[str, ...]]:
+        """Return the compact representation stored in the cache."""
+        return (
+            self.VERSION,
+            self.pk,
+            self.is_active,
+            self.expires_on.toordinal(),
+            self.stale_at,
+            self.hosts,
+            self.paths,
+        )
+
+    @property
+    def is_scoped(self) -> bool:
+        """Return True if the token is limited to some hosts / paths."""
+        return bool(self.hosts or self.paths)
+
+    @property
+    def scope(self) -> Optional[TokenScope]:
+        """Return the compiled scope matcher, or None if the token is unscoped."""
+        if self._scope is None and self.is_scoped:
+            self._scope = compile_scope(self.hosts, self.paths)
+        return self._scope
+
+    @property
+    def seconds_to_expiry(self) -> int:
+        """Return the number of seconds till expiry (used for caching)."""
+        return seconds_until(self.expires_on)
+
+    @property
+    def has_expired(self) -> bool:
+        """Return True if the token has passed expiry date."""
+        return self.expires_on < datetime.date.today()
+
+    @property
+    def is_valid(self) -> bool:
+        """Return True if the token is active and has not expired."""
+        return self.is_active and not self.has_expired
+
+    def get_access_token(self) -> AccessToken:
+        """Load the full AccessToken object from the database."""
+        return AccessToken.objects.get(pk=self.pk)
+
+
 class AccessTokenManager(models.Manager):
     """Custom model manager for AccessTokens."""
 
@@ -46,47 +298,528 @@ class AccessTokenManager(models.Manager):
         kwargs["expires_on"] = kwargs.get("expires_on", default_expiry())
         return AccessToken(**kwargs).save()
 
-    def get_access_token(self, token_value: str) -> Union[AccessToken, EmptyToken]:
+    def bulk_create_tokens(
+        self,
+        count: int,
+        expires_on: Optional[datetime.date] = None,
+        created_by: Optional[Any] = None,
+        batch_size: int = 1000,
+        warm_cache: bool = False,
+    ) -> List[AccessToken]:
+        """
+        Create `count` new AccessTokens with random token values.
+
+        Tokens are inserted using bulk_create, `batch_size` at a time, so
+        save() is not called and no post_save signals are sent. If a batch
+        clashes with an existing token value it is regenerated and retried
+        (up to BULK_CREATE_ATTEMPTS times).
+
+        If `warm_cache` is True the new tokens are added to the Django cache
+        using set_many (one call per batch) - this needs a database that
+        returns primary keys from bulk inserts (e.g. PostgreSQL, SQLite).
+
+        """
+        expires_on = expires_on or default_expiry()
+        tokens: List[AccessToken] = []
+        while len(tokens) < count:
+            size = min(batch_size, count - len(tokens))
+            batch = self._bulk_create_batch(size, expires_on, created_by)
+            if warm_cache:
+                self._warm_cache(batch)
+            token_filter.add(*[token.token_hash for token in batch])
+            tokens.extend(batch)
+        return tokens
+
+    def _bulk_create_batch(
+        self, size: int, expires_on: datetime.date, created_by: Optional[Any]
+    ) -> List[AccessToken]:
+        """Insert a single batch of new tokens, retrying on a clash."""
+        for attempt in range(1, BULK_CREATE_ATTEMPTS + 1):
+            timestamp = timezone.now()
+            values = {AccessToken.random_token_value() for _ in range(size)}
+            while len(values) < size:
+                values.add(AccessToken.random_token_value())
+            # NB the values are returned even if they are not stored
+            store_value = PERIMETER_TOKEN_STORAGE != "hashed"  # noqa: S105
+            batch = [
+                AccessToken(
+                    token=value if store_value else None,
+                    token_hash=hash_token_value(value),
+                    expires_on=expires_on,
+                    created_by=created_by,
+                    created_at=timestamp,
+                    updated_at=timestamp,
+                )
+                for value in values
+            ]
+            try:
+                with transaction.atomic(using=self.db):
+                    self.bulk_create(batch)
+            except IntegrityError:
+                if attempt == BULK_CREATE_ATTEMPTS:
+                    raise
+            else:
+                for token, value in zip(batch, values):
+                    token.token = value
+                return batch
+        return []  # pragma: no cover
+
+    def _warm_cache(self, tokens: List[AccessToken]) -> None:
+        """Add new tokens to the Django cache."""
+        if not tokens or tokens[0].pk is None:
+            return
+        self._cache_set_many(
+            {token.cache_key: CachedToken.from_token(token) for token in tokens}
+        )
+
+    def _cache_set_many(self, tokens: Dict[str, CachedToken]) -> None:
+        """
+        Store tokens in the Django cache, using one set_many per expiry date.
+
+        Tokens that expire on the same date share a timeout (and so a single
+        set_many call) - the random jitter is applied per call, so tokens
+        cached in separate calls still drop out of the cache at different
+        times.
+
+        """
+        by_expiry: Dict[datetime.date, Dict[str, CachedToken]] = {}
+        for cache_key, token in tokens.items():
+            by_expiry.setdefault(token.expires_on, {})[cache_key] = token
+        for group in by_expiry.values():
+            timeout = get_cache_timeout(next(iter(group.values())))
+            stale_at = int(time.time()) + timeout
+            for token in group.values():
+                token.stale_at = stale_at
+            cache.set_many(
+                {key: token.to_payload() for key, token in group.items()}, timeout
+            )
+
+    def warm_cache(self, chunk_size: int = 1000) -> Optional[Tuple[int, int]]:
+        """
+        Load every valid token into the Django cache.
+
+        The ids of valid tokens are streamed from the database `chunk_size`
+        at a time, and each chunk is re-read just before it is cached - so
+        that a token deleted or deactivated while the cache is being warmed
+        is not cached as valid. Each chunk then costs one get_many, plus a
+        set_many per expiry date for the tokens that are missing from the
+        cache - tokens that are already cached are left alone, so that an
+        entry refreshed since the token was read is never overwritten.
+
+        Only one process at a time can warm the cache - returns None,
+        without doing anything, if another process is already doing it,
+        otherwise the number of valid tokens found and the number cached.
+
+        """
+        lock_key = f"{PERIMETER_CACHE_KEY_PREFIX}:warm.lock"
+        if not cache.add(lock_key, 1, WARM_LOCK_TIMEOUT):
+            return None
+        found = cached = 0
+        try:
+            pks = (
+                self.filter(is_active=True, expires_on__gte=datetime.date.today())
+                .order_by()
+                .values_list("pk", flat=True)
+                .iterator(chunk_size=chunk_size)
+            )
+            while chunk := list(itertools.islice(pks, chunk_size)):
+                chunk_found, chunk_cached = self._warm_chunk(chunk)
+                found += chunk_found
+                cached += chunk_cached
+        finally:
+            cache.delete(lock_key)
+        return found, cached
+
+    def _warm_chunk(self, pks: List[int]) -> Tuple[int, int]:
+        """Cache the tokens in pks that are (still) valid and not cached already."""
+        rows = self.filter(
+            pk__in=pks, is_active=True, expires_on__gte=datetime.date.today()
+        ).values_list(*CACHED_FIELDS, "token_hash", "token")
+        tokens = {}
+        for *values, token_hash, token_value in rows:
+            if token_hash or token_value:
+                cache_key = AccessToken.get_hash_cache_key(
+                    token_hash or hash_token_value(token_value)
+                )
+                tokens[cache_key] = CachedToken.from_values(*values)
+        found = len(tokens)
+        for cache_key in cache.get_many(list(tokens)):
+            del tokens[cache_key]
+        self._cache_set_many(tokens)
+        return found, len(tokens)
+
+    def filter_token(
+        self, token_value: str, token_hash: Optional[str] = None
+    ) -> models.QuerySet:
+        """
+        Return a queryset that matches the token with this value.
+
+        This is a single equality lookup on a unique index, on either the
+        value or its hash depending on PERIMETER_TOKEN_STORAGE - except for
+        "dual", which ORs the two (so that tokens not yet hashed can still
+        be found), and so uses both indexes.
+
+        """
+        if PERIMETER_TOKEN_STORAGE == "plain":  # noqa: S105
+            return self.filter(token=token_value)
+        token_hash = token_hash or hash_token_value(token_value)
+        if PERIMETER_TOKEN_STORAGE == "hashed":  # noqa: S105
+            return self.filter(token_hash=token_hash)
+        return self.filter(
+            models.Q(token_hash=token_hash) | models.Q(token=token_value)
+        )
+
+    def record_usage(
+        self, pk: int, last_used_at: datetime.datetime, count: int = 1
+    ) -> None:
         """
-        Fetch an AccessToken, return EmptyToken if not found.
+        Update a token's usage stats.
 
-        This method is cache-aware, and will check the cache first,
-        re-filling it if empty.
+        This is a single UPDATE using F() expressions, so concurrent uses
+        of the same token are never lost.
+
+        """
+        self.filter(pk=pk).update(
+            use_count=models.F("use_count") + count, last_used_at=last_used_at
+        )
+
+    def get_access_token(
+        self, token_value: Optional[str]
+    ) -> Union[CachedToken, EmptyToken]:
+        """
+        Fetch a CachedToken, return EmptyToken if not found.
+
+        This method is cache-aware, and will check the in-process cache
+        first, then the Django cache, re-filling both if empty. If the
+        PERIMETER_NEGATIVE_CACHE_TIMEOUT setting is set then unknown token
+        values are cached too, so that repeated requests with a bogus token
+        do not hit the database.
+
+        When a token is missing from the cache only one thread per process
+        reloads it (see `_load_access_token`). If PERIMETER_BLOOM_FILTER is
+        set then values that are definitely not tokens are rejected before
+        any of this (see perimeter.bloom).
 
         """
         if not token_value:
             return EmptyToken()
-        cache_key = AccessToken.get_cache_key(token_value)
-        token = cache.get(cache_key)
+        token_hash = hash_token_value(token_value)
+        token_filter.refresh_if_due()
+        if not token_filter.might_exist(token_hash):
+            metrics.sink.increment("bloom_reject")
+            return EmptyToken()
+        cache_key = AccessToken.get_hash_cache_key(token_hash)
+        token = local_cache.get(cache_key)
         if token is None:
-            try:
-                token = self.get(token=token_value)
-                cache.set(token.cache_key, token, token.seconds_to_expiry)
-                return token
-            except AccessToken.DoesNotExist:
-                return EmptyToken()
+            token = self._decode(cache.get(cache_key))
+            if token is None or self._should_refresh(token):
+                token = self._load_access_token(token_value, cache_key, token)
+            else:
+                metrics.sink.increment("cache_hit")
+            self._set_local(cache_key, token)
+        else:
+            metrics.sink.increment("cache_hit")
+        if token == TOKEN_NOT_FOUND:
+            return EmptyToken()
+        return token
+
+    async def aget_access_token(
+        self, token_value: Optional[str]
+    ) -> Union[CachedToken, EmptyToken]:
+        """
+        Fetch a CachedToken, return EmptyToken if not found (async version).
+
+        Uses the async cache and ORM APIs, so that an async middleware does
+        not need to hand off to a thread to check the token. In-process
+        cache hits do not need to await anything at all.
+
+        """
+        if django.VERSION < (4, 1):
+            # async cache / ORM methods are not available
+            return await sync_to_async(self.get_access_token)(token_value)
+        if not token_value:
+            return EmptyToken()
+        if token_filter.is_due:
+            await sync_to_async(token_filter.refresh_if_due)()
+        token_hash = hash_token_value(token_value)
+        if not token_filter.might_exist(token_hash):
+            metrics.sink.increment("bloom_reject")
+            return EmptyToken()
+        cache_key = await AccessToken.aget_hash_cache_key(token_hash)
+        token = local_cache.get(cache_key)
+        if token is None:
+            token = self._decode(await cache.aget(cache_key))
+            if token is None or self._should_refresh(token):
+                token = await self._aload_access_token(token_value, cache_key, token)
+            else:
+                metrics.sink.increment("cache_hit")
+            self._set_local(cache_key, token)
         else:
+            metrics.sink.increment("cache_hit")
+        if token == TOKEN_NOT_FOUND:
+            return EmptyToken()
+        return token
+
+    def _decode(self, value: Any) -> Union[CachedToken, str, None]:
+        """Convert a cached value into a CachedToken / TOKEN_NOT_FOUND."""
+        if value == TOKEN_NOT_FOUND:
+            return TOKEN_NOT_FOUND
+        return CachedToken.from_payload(value)
+
+    def _set_local(self, cache_key: str, token: Union[CachedToken, str]) -> None:
+        """Store token (or TOKEN_NOT_FOUND) in the in-process cache."""
+        if isinstance(token, CachedToken):
+            local_cache.set(cache_key, token, get_cache_timeout(token))
+        else:
+            local_cache.set(cache_key, token, PERIMETER_NEGATIVE_CACHE_TIMEOUT)
+
+    def _should_refresh(self, token: Union[CachedToken, str]) -> bool:
+        """
+        Return True if a cached token should be refreshed before it goes stale.
+
+        This is the "XFetch" algorithm - the chance of a refresh rises
+        exponentially as the entry nears expiry, so that (on average) one
+        request refreshes a hot token shortly before it drops out of the
+        cache, rather than every request missing at once when it does.
+
+        """
+        if PERIMETER_CACHE_EARLY_REFRESH <= 0 or not isinstance(token, CachedToken):
+            return False
+        if not token.stale_at:
+            return False
+        remaining = token.stale_at - time.time()
+        # NB 1 - random() is in (0, 1], so the log is never undefined
+        return remaining < -PERIMETER_CACHE_EARLY_REFRESH * math.log(
+            1 - random.random()  # noqa: S311
+        )
+
+    def _load_access_token(
+        self, token_value: str, cache_key: str, stale: Union[CachedToken, str, None]
+    ) -> Union[CachedToken, str]:
+        """
+        Reload a token into the cache, one thread per process at a time.
+
+        Threads that find another thread already reloading the token wait
+        (for up to FILL_WAIT_TIMEOUT seconds) for it to finish and then use
+        the value it cached - or, if this is an early refresh (and so
+        `stale` is the token still in the cache), just carry on with the
+        stale token.
+
+        If nothing was cached (e.g. an unknown token, with negative caching
+        off), or the wait timed out, the waiting threads go to the database
+        themselves - without taking the lock, so that they are not queued
+        up behind each other (or behind unrelated keys sharing the lock).
+
+        """
+        lock = fill_locks(cache_key)
+        if lock.acquire(blocking=False):
+            try:
+                return self._fill_cache(token_value, cache_key, stale)
+            finally:
+                lock.release()
+        if stale is not None:
+            metrics.sink.increment("cache_hit")
+            return stale
+        if lock.acquire(timeout=FILL_WAIT_TIMEOUT):
+            lock.release()
+        token = self._decode(cache.get(cache_key))
+        if token is not None:
+            metrics.sink.increment("cache_hit")
             return token
+        return self._fill_cache(token_value, cache_key, stale)
+
+    def _fill_cache(
+        self, token_value: str, cache_key: str, stale: Union[CachedToken, str, None]
+    ) -> Union[CachedToken, str]:
+        """Fetch token from the database, holding the distributed lock if set."""
+        lock_key = None
+        if PERIMETER_CACHE_LOCK_TIMEOUT > 0:
+            lock_key = f"{cache_key}.lock"
+            if not cache.add(lock_key, 1, PERIMETER_CACHE_LOCK_TIMEOUT):
+                # another process is refilling the cache
+                token = stale or self._wait_for_cache(cache_key, lock_key)
+                if token is not None:
+                    metrics.sink.increment("cache_hit")
+                    return token
+                lock_key = None
+        metrics.sink.increment("cache_miss" if stale is None else "early_refresh")
+        try:
+            return self._fetch_access_token(token_value, cache_key)
+        finally:
+            if lock_key:
+                cache.delete(lock_key)
+
+    def _wait_for_cache(
+        self, cache_key: str, lock_key: str
+    ) -> Union[CachedToken, str, None]:
+        """Wait until the cache is refilled, or the lock released / timed out."""
+        deadline = time.monotonic() + PERIMETER_CACHE_LOCK_TIMEOUT
+        while time.monotonic() < deadline:
+            time.sleep(LOCK_POLL_INTERVAL)
+            values = cache.get_many([cache_key, lock_key])
+            token = self._decode(values.get(cache_key))
+            if token is not None or lock_key not in values:
+                return token
+        return None
+
+    def _cache_set(self, cache_key: str, token: CachedToken) -> None:
+        """Store token in the Django cache (see get_cache_timeout)."""
+        timeout = get_cache_timeout(token)
+        token.stale_at = int(time.time()) + timeout
+        cache.set(cache_key, token.to_payload(), timeout)
+
+    def _fetch_access_token(
+        self, token_value: str, cache_key: str
+    ) -> Union[CachedToken, str]:
+        """Fetch token from the database and cache it (or TOKEN_NOT_FOUND)."""
+        try:
+            values = self.filter_token(token_value).values_list(*CACHED_FIELDS).get()
+        except AccessToken.DoesNotExist:
+            metrics.sink.increment("db_miss")
+            if PERIMETER_NEGATIVE_CACHE_TIMEOUT > 0:
+                cache.set(cache_key, TOKEN_NOT_FOUND, PERIMETER_NEGATIVE_CACHE_TIMEOUT)
+            return TOKEN_NOT_FOUND
+        token = CachedToken.from_values(*values)
+        self._cache_set(cache_key, token)
+        return token
+
+    async def _aload_access_token(
+        self, token_value: str, cache_key: str, stale: Union[CachedToken, str, None]
+    ) -> Union[CachedToken, str]:
+        """
+        Async version of _load_access_token.
+
+        Coroutines on the same event loop share a single in-flight refill
+        (rather than a lock), so only one of them hits the database. The
+        refill runs as a task of its own, so cancelling the coroutine that
+        started it (e.g. when a client disconnects) does not cancel it for
+        the others.
+
+        """
+        loop = asyncio.get_running_loop()
+        pending = _pending_fills.get(cache_key)
+        if pending is not None and pending.get_loop() is loop:
+            metrics.sink.increment("cache_hit")
+            if stale is not None:
+                return stale
+            return await asyncio.shield(pending)
+        task = _pending_fills[cache_key] = asyncio.ensure_future(
+            self._afill_cache(token_value, cache_key, stale)
+        )
+        task.add_done_callback(functools.partial(_fill_done, cache_key))
+        return await asyncio.shield(task)
+
+    async def _afill_cache(
+        self, token_value: str, cache_key: str, stale: Union[CachedToken, str, None]
+    ) -> Union[CachedToken, str]:
+        """Async version of _fill_cache."""
+        lock_key = None
+        if PERIMETER_CACHE_LOCK_TIMEOUT > 0:
+            lock_key = f"{cache_key}.lock"
+            if not await cache.aadd(lock_key, 1, PERIMETER_CACHE_LOCK_TIMEOUT):
+                token = stale or await self._await_cache(cache_key, lock_key)
+                if token is not None:
+                    metrics.sink.increment("cache_hit")
+                    return token
+                lock_key = None
+        metrics.sink.increment("cache_miss" if stale is None else "early_refresh")
+        try:
+            return await self._afetch_access_token(token_value, cache_key)
+        finally:
+            if lock_key:
+                await cache.adelete(lock_key)
+
+    async def _await_cache(
+        self, cache_key: str, lock_key: str
+    ) -> Union[CachedToken, str, None]:
+        """Async version of _wait_for_cache."""
+        deadline = time.monotonic() + PERIMETER_CACHE_LOCK_TIMEOUT
+        while time.monotonic() < deadline:
+            await asyncio.sleep(LOCK_POLL_INTERVAL)
+            values = await cache.aget_many([cache_key, lock_key])
+            token = self._decode(values.get(cache_key))
+            if token is not None or lock_key not in values:
+                return token
+        return None
+
+    async def _acache_set(self, cache_key: str, token: CachedToken) -> None:
+        """Async version of _cache_set."""
+        timeout = get_cache_timeout(token)
+        token.stale_at = int(time.time()) + timeout
+        await cache.aset(cache_key, token.to_payload(), timeout)
+
+    async def _afetch_access_token(
+        self, token_value: str, cache_key: str
+    ) -> Union[CachedToken, str]:
+        """Async version of _fetch_access_token."""
+        try:
+            values = (
+                await self.filter_token(token_value).values_list(*CACHED_FIELDS).aget()
+            )
+        except AccessToken.DoesNotExist:
+            metrics.sink.increment("db_miss")
+            if PERIMETER_NEGATIVE_CACHE_TIMEOUT > 0:
+                await cache.aset(
+                    cache_key, TOKEN_NOT_FOUND, PERIMETER_NEGATIVE_CACHE_TIMEOUT
+                )
+            return TOKEN_NOT_FOUND
+        token = CachedToken.from_values(*values)
+        await self._acache_set(cache_key, token)
+        return token
 
 
 class AccessToken(models.Model):
     """A token that allows a user entry to the site via Perimeter."""
 
-    token = models.CharField(max_length=50, unique=True)
+    # NB null when PERIMETER_TOKEN_STORAGE = "hashed" - only the hash is kept
+    token = models.CharField(max_length=50, unique=True, null=True, blank=True)
+    # HMAC-SHA256 of the token value (see perimeter.hashing)
+    token_hash = models.CharField(max_length=64, unique=True, null=True, editable=False)
     is_active = models.BooleanField(default=True)
     # NB pass in a callable, not the result of the callable, see:
     # http://stackoverflow.com/a/29549675/45698
     expires_on = models.DateField(default=default_expiry)
+    # optional scope - if set, the token only grants access to these hosts /
+    # paths (see perimeter.matching.TokenScope)
+    scope_hosts = models.TextField(
+        blank=True,
+        help_text=(
+            "Hosts the token can be used on, one per line - '.example.com' "
+            "matches example.com and its subdomains. Blank for all hosts."
+        ),
+    )
+    scope_paths = models.TextField(
+        blank=True,
+        help_text=(
+            "Path prefixes the token can be used on, one per line - e.g. "
+            "'/previews/acme/'. Blank for all paths."
+        ),
+    )
     created_by = models.ForeignKey(
         settings.AUTH_USER_MODEL, on_delete=models.CASCADE, null=True
     )
     created_at = models.DateTimeField()
     updated_at = models.DateTimeField()
+    # usage stats - denormalised from AccessTokenUse, and only ever updated
+    # using F() expressions (see AccessTokenManager.record_usage).
+    use_count = models.PositiveIntegerField(default=0)
+    last_used_at = models.DateTimeField(null=True, blank=True)
 
     objects = AccessTokenManager()
 
+    class Meta:
+        indexes = [
+            # expiry first, so that it serves both "which tokens are live"
+            # (expires_on >= today AND is_active) and expired token queries
+            models.Index(
+                fields=["expires_on", "is_active"], name="perimeter_token_expiry_idx"
+            ),
+        ]
+
     def __str__(self) -> str:
-        return self.token
+        if self.token is None and self.token_hash:
+            return "hashed:%s" % self.token_hash[:12]
+        return str(self.token)
 
     @classmethod
     def random_token_value(cls) -> str:
@@ -104,30 +837,69 @@ class AccessToken(models.Model):
 
     @classmethod
     def get_cache_key(cls, token_value: str) -> str:
-        return "%s.%s-%s" % (cls.__module__, cls.__name__, token_value)
+        return cls.get_hash_cache_key(hash_token_value(token_value))
+
+    @classmethod
+    def get_hash_cache_key(cls, token_hash: str) -> str:
+        # NB keyed on the hash, so that the cache never holds token values,
+        # and on the payload version, so that releases with different
+        # payloads do not keep overwriting each other's entries.
+        return cache_keys.make_key(f"token.v{CachedToken.VERSION}", token_hash)
+
+    @classmethod
+    async def aget_hash_cache_key(cls, token_hash: str) -> str:
+        """Async version of get_hash_cache_key."""
+        return await cache_keys.amake_key(f"token.v{CachedToken.VERSION}", token_hash)
+
+    def clean(self) -> None:
+        if not (self.token or self.token_hash):
+            raise ValidationError({"token": "Token value is required."})
+        if any(not path.startswith("/") for path in split_scope(self.scope_paths)):
+            raise ValidationError({"scope_paths": "Paths must start with '/'."})
 
     def save(self, *args: Any, **kwargs: Any) -> AccessToken:
         self.updated_at = timezone.now()
         self.created_at = self.created_at or self.updated_at
-        super(AccessToken, self).save(*args, **kwargs)
+        # NB "" would clash with other blank tokens on the unique index
+        self.token = self.token or None
+        # NB read by on_save_access_token, to spot a changed token value
+        self._previous_token_hash = self.token_hash
+        if self.token:
+            self.token_hash = hash_token_value(self.token)
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None and "token" in update_fields:
+            # the hash is derived from the value, so is saved along with it
+            kwargs["update_fields"] = {*update_fields, "token_hash"}
+        if not (self._state.adding or args or "update_fields" in kwargs):
+            # never overwrite the usage stats with (possibly stale) values
+            kwargs["update_fields"] = [
+                f.name
+                for f in self._meta.concrete_fields
+                if not f.primary_key and f.name not in USAGE_FIELDS
+            ]
+        if PERIMETER_TOKEN_STORAGE == "hashed" and self.token:  # noqa: S105
+            # only the hash is stored - this instance keeps the value, so
+            # that it can be handed out, but it cannot be read back.
+            token_value, self.token = self.token, None
+            try:
+                super(AccessToken, self).save(*args, **kwargs)
+            finally:
+                self.token = token_value
+        else:
+            super(AccessToken, self).save(*args, **kwargs)
         return self
 
     @property
     def cache_key(self) -> str:
-        """Return object cache key (from get `get_cache_key`)."""
-        return AccessToken.get_cache_key(self.token)
+        """Return object cache key (from get `get_hash_cache_key`)."""
+        return AccessToken.get_hash_cache_key(
+            self.token_hash or hash_token_value(self.token)
+        )
 
     @property
     def seconds_to_expiry(self) -> int:
         """Return the number of seconds till expiry (used for caching)."""
-        expires_at = datetime.datetime.combine(self.expires_on, datetime.time.min)
-        if settings.USE_TZ and timezone.is_naive(expires_at):
-            expires_at = timezone.make_aware(
-                expires_at, timezone.get_current_timezone()
-            )
-        elif not settings.USE_TZ and timezone.is_aware(expires_at):
-            expires_at = timezone.make_naive(expires_at)
-        return int((expires_at - timezone.now()).total_seconds())
+        return seconds_until(self.expires_on)
 
     @property
     def has_expired(self) -> bool:
@@ -155,6 +927,7 @@ class AccessToken(models.Model):
             client_user_agent=client_user_agent,
         )
         atu.save()
+        AccessToken.objects.record_usage(self.pk, atu.timestamp)
         return atu
 
 
@@ -162,8 +935,17 @@ class AccessToken(models.Model):
 def on_save_access_token(
     sender: Type[AccessToken], instance: AccessToken, **kwargs: Any
 ) -> None:
-    """Update saved object in cache if is_valid, else delete."""
-    cache.set(instance.cache_key, instance, instance.seconds_to_expiry)
+    """Update saved object in cache (replacing any TOKEN_NOT_FOUND entry)."""
+    AccessToken.objects._cache_set(instance.cache_key, CachedToken.from_token(instance))
+    previous_hash = getattr(instance, "_previous_token_hash", instance.token_hash)
+    if kwargs.get("created") or previous_hash != instance.token_hash:
+        token_filter.add(instance.token_hash)
+    if previous_hash and previous_hash != instance.token_hash:
+        # the token value has been changed - the old value must stop working
+        previous_key = AccessToken.get_hash_cache_key(previous_hash)
+        cache.delete(previous_key)
+        local_cache.delete(previous_key)
+    local_cache.delete(instance.cache_key)
 
 
 @receiver(post_delete, sender=AccessToken)
@@ -172,6 +954,7 @@ def on_delete_access_token(
 ) -> None:
     """Remove deleted object from cache."""
     cache.delete(instance.cache_key)
+    local_cache.delete(instance.cache_key)
 
 
 class AccessTokenUse(models.Model):
@@ -188,8 +971,16 @@ class AccessTokenUse(models.Model):
     client_user_agent = models.TextField(verbose_name="Client User Agent", blank=True)
     timestamp = models.DateTimeField()
 
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["token", "timestamp"], name="perimeter_use_token_ts_idx"
+            ),
+            models.Index(fields=["timestamp"], name="perimeter_use_ts_idx"),
+        ]
+
     def __str__(self) -> str:
-        return "'%s' used %s" % (self.token.token, self.timestamp)
+        return "'%s' used %s" % (self.token, self.timestamp)
 
     def save(self, *args: Any, **kwargs: Any) -> AccessTokenUse:
         """Set the timestamp and save the object."""
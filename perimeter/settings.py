@@ -1,10 +1,38 @@
+import functools
 from os import environ
 
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
 from django.urls import reverse
 
 CAST_AS_BOOL = lambda x: x in (True, "true", "True")  # noqa: E731
 CAST_AS_INT = lambda x: int(x)  # noqa: E731
+CAST_AS_FLOAT = lambda x: float(x)  # noqa: E731
+# env vars can contain comma-separated lists
+CAST_AS_LIST = lambda x: x.split(",") if isinstance(x, str) else list(x)  # noqa: E731
+
+# valid values of PERIMETER_TOKEN_STORAGE
+TOKEN_STORAGE_MODES = ("plain", "dual", "hashed")
+
+
+def CAST_AS_TOKEN_STORAGE(value):
+    """Return value if it is a valid PERIMETER_TOKEN_STORAGE mode."""
+    if value not in TOKEN_STORAGE_MODES:
+        raise ImproperlyConfigured(
+            f"PERIMETER_TOKEN_STORAGE must be one of {TOKEN_STORAGE_MODES}, "
+            f"not {value!r}."
+        )
+    return value
+
+
+def check_token_hash_secret(storage, secret):
+    """Raise ImproperlyConfigured if only hashes are stored, keyed on SECRET_KEY."""
+    hashed_only = storage == "hashed"  # noqa: S105
+    if hashed_only and not secret:
+        raise ImproperlyConfigured(
+            "PERIMETER_TOKEN_HASH_SECRET must be set if "
+            'PERIMETER_TOKEN_STORAGE is "hashed".'
+        )
 
 
 def get_setting(setting_name, default_value, cast_func=lambda x: x):
@@ -38,6 +66,14 @@ PERIMETER_SESSION_KEY = get_setting("PERIMETER_SESSION_KEY", "perimeter")
 PERIMETER_DEFAULT_EXPIRY = get_setting(
     "PERIMETER_DEFAULT_EXPIRY", 7, cast_func=CAST_AS_INT
 )
+
+
+@functools.lru_cache(maxsize=None)
+def get_gateway_path() -> str:
+    """Return the (cached) path of the gateway page."""
+    return reverse("perimeter:gateway")
+
+
 # function used to bypass the perimter - must be function that takes request
 # as only arg.
 # NB we don't use get_setting here - you can't put a function into an env var
@@ -45,9 +81,166 @@ PERIMETER_BYPASS_FUNCTION = getattr(
     settings,
     "PERIMETER_BYPASS_FUNCTION",
     # default function is to restrict everything except the gateway page itself
-    lambda r: r.path == reverse("perimeter:gateway"),
+    lambda r: r.path == get_gateway_path(),
+)
+# Paths, path prefixes and regex patterns that bypass the perimeter. These are
+# compiled once, and checked before PERIMETER_BYPASS_FUNCTION (and before the
+# session is touched) - use them for health checks, static files, webhooks etc.
+PERIMETER_BYPASS_PATHS = get_setting(
+    "PERIMETER_BYPASS_PATHS", [], cast_func=CAST_AS_LIST
+)
+PERIMETER_BYPASS_PREFIXES = get_setting(
+    "PERIMETER_BYPASS_PREFIXES", [], cast_func=CAST_AS_LIST
+)
+PERIMETER_BYPASS_PATTERNS = get_setting(
+    "PERIMETER_BYPASS_PATTERNS", [], cast_func=CAST_AS_LIST
 )
 # If True, then ask for user details on the gateway form
 PERIMETER_REQUIRE_USER_DETAILS = get_setting(
     "PERIMETER_REQUIRE_USER_DETAILS", False, cast_func=CAST_AS_BOOL
 )
+# Size of the in-process token cache that sits in front of the Django cache;
+# 0 (the default) disables it.
+PERIMETER_LOCAL_CACHE_SIZE = get_setting(
+    "PERIMETER_LOCAL_CACHE_SIZE", 0, cast_func=CAST_AS_INT
+)
+# Max time, in seconds, that a token is held in the in-process cache. Changes
+# made in other processes can take this long to be seen, so keep it short.
+PERIMETER_LOCAL_CACHE_TIMEOUT = get_setting(
+    "PERIMETER_LOCAL_CACHE_TIMEOUT", 10, cast_func=CAST_AS_INT
+)
+# Time, in seconds, to cache the fact that a token value does not exist, so
+# that repeated requests with an unknown token do not each hit the database;
+# 0 (the default) disables negative caching.
+PERIMETER_NEGATIVE_CACHE_TIMEOUT = get_setting(
+    "PERIMETER_NEGATIVE_CACHE_TIMEOUT", 0, cast_func=CAST_AS_INT
+)
+# If True, a signed, short-lived grant is stored in the session once a token
+# has been validated, and requests carrying a valid grant skip the token
+# lookup altogether (see PERIMETER_GRANT_REFRESH_INTERVAL).
+PERIMETER_SIGNED_GRANTS = get_setting(
+    "PERIMETER_SIGNED_GRANTS", False, cast_func=CAST_AS_BOOL
+)
+# Time, in seconds, for which a signed grant is trusted before the token is
+# re-checked - this is the max time it takes for a token revocation to apply.
+PERIMETER_GRANT_REFRESH_INTERVAL = get_setting(
+    "PERIMETER_GRANT_REFRESH_INTERVAL", 300, cast_func=CAST_AS_INT
+)
+# request.session key used to store the signed grant
+PERIMETER_GRANT_SESSION_KEY = get_setting(
+    "PERIMETER_GRANT_SESSION_KEY", "perimeter_grant"
+)
+# Backend used to record token use (AccessTokenUse) from the gateway form -
+# "perimeter.audit.SyncAuditBackend" saves each record as it is made,
+# "perimeter.audit.BufferedAuditBackend" queues records in memory and writes
+# them in batches from a background thread.
+PERIMETER_AUDIT_BACKEND = get_setting(
+    "PERIMETER_AUDIT_BACKEND", "perimeter.audit.SyncAuditBackend"
+)
+# Max number of records held in memory by the buffered backend - once full,
+# records are saved synchronously.
+PERIMETER_AUDIT_BUFFER_SIZE = get_setting(
+    "PERIMETER_AUDIT_BUFFER_SIZE", 10000, cast_func=CAST_AS_INT
+)
+# Number of queued records that triggers a flush (and the bulk_create batch size)
+PERIMETER_AUDIT_BATCH_SIZE = get_setting(
+    "PERIMETER_AUDIT_BATCH_SIZE", 100, cast_func=CAST_AS_INT
+)
+# Max time, in seconds, that a record is held in memory before being flushed
+PERIMETER_AUDIT_FLUSH_INTERVAL = get_setting(
+    "PERIMETER_AUDIT_FLUSH_INTERVAL", 5, cast_func=CAST_AS_INT
+)
+# Sink that Perimeter reports metrics to - "perimeter.metrics.MetricsSink"
+# does nothing, "perimeter.metrics.InMemoryRegistry" keeps Prometheus-style
+# counters and histograms in process.
+PERIMETER_METRICS_SINK = get_setting(
+    "PERIMETER_METRICS_SINK", "perimeter.metrics.MetricsSink"
+)
+# Max number of gateway POSTs allowed from a single client in each
+# PERIMETER_GATEWAY_RATE_WINDOW - further POSTs get a 429. 0 disables throttling.
+PERIMETER_GATEWAY_RATE_LIMIT = get_setting(
+    "PERIMETER_GATEWAY_RATE_LIMIT", 0, cast_func=CAST_AS_INT
+)
+# Length, in seconds, of the gateway throttling window
+PERIMETER_GATEWAY_RATE_WINDOW = get_setting(
+    "PERIMETER_GATEWAY_RATE_WINDOW", 60, cast_func=CAST_AS_INT
+)
+# if True, gateway POSTs are also throttled per session (as well as per IP)
+PERIMETER_GATEWAY_RATE_LIMIT_SESSION = get_setting(
+    "PERIMETER_GATEWAY_RATE_LIMIT_SESSION", False, cast_func=CAST_AS_BOOL
+)
+# Alias (in CACHES) of the cache that Perimeter uses - e.g. to keep tokens on
+# a small dedicated cache rather than the (busy) default one.
+PERIMETER_CACHE_ALIAS = get_setting("PERIMETER_CACHE_ALIAS", "default")
+# Prefix for every cache key that Perimeter uses
+PERIMETER_CACHE_KEY_PREFIX = get_setting("PERIMETER_CACHE_KEY_PREFIX", "perimeter")
+# Max time, in seconds, before a process sees that the cache has been
+# invalidated (see perimeter.cache.CacheNamespace) - 0 checks on every lookup.
+PERIMETER_CACHE_GENERATION_INTERVAL = get_setting(
+    "PERIMETER_CACHE_GENERATION_INTERVAL", 10, cast_func=CAST_AS_INT
+)
+# if True, each web process loads all valid tokens into the cache (in the
+# background) when it handles its first request - see warm_perimeter_cache.
+PERIMETER_CACHE_WARM_ON_STARTUP = get_setting(
+    "PERIMETER_CACHE_WARM_ON_STARTUP", False, cast_func=CAST_AS_BOOL
+)
+# if > 0, a process that finds a token missing from the cache takes a lock
+# (using cache.add) while it reloads it, and other processes wait (up to this
+# number of seconds) for it to be refilled rather than all hitting the database
+PERIMETER_CACHE_LOCK_TIMEOUT = get_setting(
+    "PERIMETER_CACHE_LOCK_TIMEOUT", 0, cast_func=CAST_AS_INT
+)
+# if > 0, cached tokens are refreshed early, with a probability that rises as
+# the cache entry nears expiry - larger values refresh earlier. 0 disables.
+PERIMETER_CACHE_EARLY_REFRESH = get_setting(
+    "PERIMETER_CACHE_EARLY_REFRESH", 0, cast_func=CAST_AS_INT
+)
+# Bounds, in seconds, on how long a valid token is cached - by default tokens
+# are cached until they expire, which for far-future tokens could be months.
+PERIMETER_CACHE_MIN_TIMEOUT = get_setting(
+    "PERIMETER_CACHE_MIN_TIMEOUT", 60, cast_func=CAST_AS_INT
+)
+PERIMETER_CACHE_MAX_TIMEOUT = get_setting(
+    "PERIMETER_CACHE_MAX_TIMEOUT", 86400, cast_func=CAST_AS_INT
+)
+# Time, in seconds, to cache an expired or inactive token
+PERIMETER_CACHE_INVALID_TIMEOUT = get_setting(
+    "PERIMETER_CACHE_INVALID_TIMEOUT", 60, cast_func=CAST_AS_INT
+)
+# Max percentage by which cache timeouts are randomly shortened, so that
+# tokens created together do not all drop out of the cache together
+PERIMETER_CACHE_TIMEOUT_JITTER = get_setting(
+    "PERIMETER_CACHE_TIMEOUT_JITTER", 10, cast_func=CAST_AS_INT
+)
+# if True, each process keeps a Bloom filter of all token values, and rejects
+# values that are definitely not tokens without any cache or database lookup.
+PERIMETER_BLOOM_FILTER = get_setting(
+    "PERIMETER_BLOOM_FILTER", False, cast_func=CAST_AS_BOOL
+)
+# Number of tokens the Bloom filter is sized for, and the acceptable false
+# positive rate at that size - together these set its memory footprint
+# (about 1.2MB for the default million tokens at 1%).
+PERIMETER_BLOOM_CAPACITY = get_setting(
+    "PERIMETER_BLOOM_CAPACITY", 1000000, cast_func=CAST_AS_INT
+)
+PERIMETER_BLOOM_ERROR_RATE = get_setting(
+    "PERIMETER_BLOOM_ERROR_RATE", 0.01, cast_func=CAST_AS_FLOAT
+)
+# Max time, in seconds, before a process picks up tokens created elsewhere
+# (by rebuilding its Bloom filter)
+PERIMETER_BLOOM_REFRESH_INTERVAL = get_setting(
+    "PERIMETER_BLOOM_REFRESH_INTERVAL", 10, cast_func=CAST_AS_INT
+)
+# How token values are stored and looked up:
+# "plain" - stored in plaintext (and hashed), looked up by value
+# "dual" - stored in plaintext (and hashed), looked up by hash, falling back
+#   to the value for tokens that have not been hashed yet
+# "hashed" - only the hash is stored, and tokens are looked up by hash
+PERIMETER_TOKEN_STORAGE = get_setting(
+    "PERIMETER_TOKEN_STORAGE", "plain", cast_func=CAST_AS_TOKEN_STORAGE
+)
+# Key used to hash token values - defaults to SECRET_KEY. NB changing this
+# invalidates every hashed token, so it is required if only hashes are stored
+# (otherwise rotating SECRET_KEY would silently lock out every token).
+PERIMETER_TOKEN_HASH_SECRET = get_setting("PERIMETER_TOKEN_HASH_SECRET", None)
+check_token_hash_secret(PERIMETER_TOKEN_STORAGE, PERIMETER_TOKEN_HASH_SECRET)
@@ -0,0 +1,77 @@
+"""
+Throttling of gateway POSTs.
+
+Every failed guess at a token costs a lookup, so the gateway view limits the
+number of POSTs a client can make. Each client gets a fixed-window counter in
+the cache, keyed by IP address (and, optionally, session) and by the
+current window - so counting a request is a single atomic `incr`, and old
+windows simply expire.
+
+Throttling is disabled unless PERIMETER_GATEWAY_RATE_LIMIT is set.
+
+"""
+from __future__ import annotations
+
+import math
+import time
+from typing import List
+
+from django.http import HttpRequest
+
+from . import metrics
+from .cache import cache
+from .settings import (
+    PERIMETER_CACHE_KEY_PREFIX,
+    PERIMETER_GATEWAY_RATE_LIMIT,
+    PERIMETER_GATEWAY_RATE_LIMIT_SESSION,
+    PERIMETER_GATEWAY_RATE_WINDOW,
+)
+
+CACHE_KEY_PREFIX = f"{PERIMETER_CACHE_KEY_PREFIX}:throttle"
+
+
+def get_throttle_keys(request: HttpRequest, window: int) -> List[str]:
+    """Return the cache keys used to count requests in the given window."""
+    keys = [f"{CACHE_KEY_PREFIX}:ip:{request.META.get('REMOTE_ADDR', 'unknown')}"]
+    if PERIMETER_GATEWAY_RATE_LIMIT_SESSION:
+        # NB session_key does not load the session, and is None for new sessions
+        session_key = getattr(getattr(request, "session", None), "session_key", None)
+        if session_key:
+            keys.append(f"{CACHE_KEY_PREFIX}:session:{session_key}")
+    return [f"{key}:{window}" for key in keys]
+
+
+def _incr(key: str, timeout: int) -> int:
+    """Increment the counter stored at key, creating it if it does not exist."""
+    try:
+        return cache.incr(key)
+    except ValueError:
+        # first request in the window - if add fails another request got
+        # there first, and the counter now exists.
+        if cache.add(key, 1, timeout):
+            return 1
+        return cache.incr(key)
+
+
+def throttle(request: HttpRequest) -> int:
+    """
+    Count a gateway request, and return the number of seconds to wait.
+
+    Returns 0 if the request is allowed (or throttling is disabled),
+    otherwise the number of seconds until the current window ends - which
+    is the value to use in the Retry-After header.
+
+    """
+    if PERIMETER_GATEWAY_RATE_LIMIT <= 0:
+        return 0
+    now = time.time()
+    window = int(now // PERIMETER_GATEWAY_RATE_WINDOW)
+    counts = [
+        _incr(key, PERIMETER_GATEWAY_RATE_WINDOW)
+        for key in get_throttle_keys(request, window)
+    ]
+    if max(counts) <= PERIMETER_GATEWAY_RATE_LIMIT:
+        return 0
+    metrics.sink.increment("throttled")
+    window_ends = (window + 1) * PERIMETER_GATEWAY_RATE_WINDOW
+    return max(math.ceil(window_ends - now), 1)
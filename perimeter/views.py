@@ -8,6 +8,7 @@ from django.urls import Resolver404, resolve, reverse
 
 from .forms import TokenGatewayForm, UserGatewayForm
 from .settings import PERIMETER_REQUIRE_USER_DETAILS
+from .throttling import throttle
 
 
 def resolve_return_url(return_url: str) -> str:
@@ -43,6 +44,9 @@ def gateway(
     When the PerimeterAccessMiddleware catches an unvalidated
     user request they will redirect to this page.
 
+    POSTs are throttled (see PERIMETER_GATEWAY_RATE_LIMIT) before the
+    token is looked up - clients that exceed the limit get a 429.
+
     """
     # the form to use is based on whether we want user details or not.
     klass = UserGatewayForm if PERIMETER_REQUIRE_USER_DETAILS else TokenGatewayForm
@@ -51,6 +55,11 @@ def gateway(
         form = klass()
 
     elif request.method == "POST":
+        retry_after = throttle(request)
+        if retry_after:
+            response = HttpResponse("Too many requests", status=429)
+            response["Retry-After"] = str(retry_after)
+            return response
         form = klass(request.POST)
         if form.is_valid():
             form.save(request)
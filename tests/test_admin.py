@@ -0,0 +1,85 @@
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils.timezone import now
+
+from perimeter.admin import EstimatedCountPaginator
+from perimeter.models import AccessToken, AccessTokenUse
+
+
+class AdminTests(TestCase):
+    def setUp(self):
+        user = get_user_model().objects.create_superuser(
+            username="admin", email="admin@example.com", password="secret"  # noqa: S106
+        )
+        self.client.force_login(user)
+        self.user = user
+        self.token = AccessToken.objects.create_access_token(created_by=user)
+
+    def get(self, url):
+        return self.client.get(url, HTTP_X_PERIMETER_TOKEN=self.token.token)
+
+    def create_uses(self, count):
+        tokens = AccessToken.objects.bulk_create_tokens(count, created_by=self.user)
+        AccessTokenUse.objects.bulk_create(
+            AccessTokenUse(token=token, timestamp=now()) for token in tokens
+        )
+
+    def assertQueriesConstant(self, url, create_rows):
+        """Check the number of queries does not grow with the number of rows."""
+        create_rows(1)
+        with CaptureQueriesContext(connection) as before:
+            self.assertEqual(self.get(url).status_code, 200)
+        create_rows(10)
+        with CaptureQueriesContext(connection) as after:
+            self.assertEqual(self.get(url).status_code, 200)
+        self.assertEqual(len(before), len(after))
+
+    def test_access_token_changelist(self):
+        url = reverse("admin:perimeter_accesstoken_changelist")
+        self.assertQueriesConstant(url, self.create_uses)
+
+    def test_access_token_use_changelist(self):
+        url = reverse("admin:perimeter_accesstokenuse_changelist")
+        self.assertQueriesConstant(url, self.create_uses)
+        response = self.get(url)
+        self.assertContains(response, "Token Expires")
+        # date hierarchy drill down
+        self.assertEqual(
+            self.get(f"{url}?timestamp__year={now().year}").status_code, 200
+        )
+
+
+class EstimatedCountPaginatorTests(TestCase):
+    def setUp(self):
+        token = AccessToken.objects.create_access_token()
+        AccessTokenUse.objects.bulk_create(
+            AccessTokenUse(token=token, timestamp=now()) for _ in range(3)
+        )
+
+    def test_count(self):
+        """Test the exact count is used if there is no estimate."""
+        paginator = EstimatedCountPaginator(AccessTokenUse.objects.order_by("pk"), 2)
+        self.assertIsNone(paginator.estimate_count())
+        self.assertEqual(paginator.count, 3)
+        self.assertEqual(paginator.num_pages, 2)
+
+    def test_estimated_count(self):
+        with mock.patch.object(
+            EstimatedCountPaginator, "estimate_count", return_value=1000
+        ):
+            paginator = EstimatedCountPaginator(AccessTokenUse.objects.order_by("pk"), 2)
+            self.assertEqual(paginator.count, 1000)
+            self.assertEqual(paginator.num_pages, 500)
+
+    def test_filtered(self):
+        """Test filtered querysets are always counted."""
+        queryset = AccessTokenUse.objects.filter(client_ip="").order_by("pk")
+        paginator = EstimatedCountPaginator(queryset, 2)
+        with mock.patch.object(connection, "vendor", "postgresql"):
+            self.assertIsNone(paginator.estimate_count())
+        self.assertEqual(paginator.count, 3)
@@ -0,0 +1,43 @@
+from unittest import mock
+
+from django.core.cache import cache
+from django.core.signals import request_started
+from django.test import TestCase
+
+from perimeter.apps import warm_cache
+from perimeter.models import AccessToken
+
+
+class SyncThread:
+    """Stand-in for threading.Thread that runs its target on start()."""
+
+    def __init__(self, target, **kwargs):
+        self.target = target
+
+    def start(self):
+        self.target()
+
+
+@mock.patch("perimeter.apps.connections", mock.Mock())
+@mock.patch("perimeter.apps.threading.Thread", SyncThread)
+class WarmCacheOnStartupTests(TestCase):
+    def setUp(self):
+        self.token = AccessToken.objects.create_access_token()
+        cache.clear()
+
+    def test_warm_cache(self):
+        request_started.connect(warm_cache)
+        with self.assertLogs("perimeter.apps", "INFO") as logs:
+            request_started.send(sender=None)
+        self.assertIn("1 of 1 valid tokens cached", logs.output[0])
+        self.assertIsNotNone(cache.get(self.token.cache_key))
+        # only the first request
+        with mock.patch.object(AccessToken.objects, "warm_cache") as mock_warm:
+            request_started.send(sender=None)
+        mock_warm.assert_not_called()
+
+    def test_error(self):
+        with mock.patch.object(
+            AccessToken.objects, "warm_cache", side_effect=Exception("oops")
+        ), self.assertLogs("perimeter.apps", "ERROR"):
+            warm_cache()
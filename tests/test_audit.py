@@ -0,0 +1,147 @@
+from unittest import mock
+
+from django.db import DataError, OperationalError
+from django.test import TestCase
+
+from perimeter import audit
+from perimeter.audit import (
+    AuditBackend,
+    BufferedAuditBackend,
+    SyncAuditBackend,
+    get_audit_backend,
+)
+from perimeter.models import AccessToken, AccessTokenUse
+
+
+class SyncAuditBackendTests(TestCase):
+    def test_record(self):
+        token = AccessToken.objects.create_access_token()
+        atu = SyncAuditBackend().record(AccessTokenUse(token=token))
+        self.assertEqual(atu, AccessTokenUse.objects.get())
+        token.refresh_from_db()
+        self.assertEqual(token.use_count, 1)
+        self.assertEqual(token.last_used_at, atu.timestamp)
+        self.assertEqual(SyncAuditBackend().flush(), 0)
+
+
+@mock.patch.object(BufferedAuditBackend, "start")
+class BufferedAuditBackendTests(TestCase):
+    def setUp(self):
+        self.token = AccessToken.objects.create_access_token()
+        self.backend = BufferedAuditBackend(
+            max_size=10, batch_size=5, flush_interval=60
+        )
+
+    def test_record(self, mock_start):
+        atu = self.backend.record(AccessTokenUse(token=self.token))
+        mock_start.assert_called_once()
+        self.assertIsNone(atu.pk)
+        self.assertIsNotNone(atu.timestamp)
+        self.assertEqual(len(self.backend), 1)
+        self.assertFalse(AccessTokenUse.objects.exists())
+
+    def test_flush(self, mock_start):
+        records = [
+            self.backend.record(AccessTokenUse(token=self.token, client_ip="1.2.3.4"))
+            for _ in range(3)
+        ]
+        # one insert, and one usage stats update for the token (in a savepoint)
+        with self.assertNumQueries(4):
+            self.assertEqual(self.backend.flush(), 3)
+        self.token.refresh_from_db()
+        self.assertEqual(self.token.use_count, 3)
+        self.assertEqual(self.token.last_used_at, records[-1].timestamp)
+        self.assertEqual(len(self.backend), 0)
+        self.assertEqual(
+            AccessTokenUse.objects.filter(
+                token=self.token, client_ip="1.2.3.4"
+            ).count(),
+            3,
+        )
+        with self.assertNumQueries(0):
+            self.assertEqual(self.backend.flush(), 0)
+
+    @mock.patch.object(AccessTokenUse.objects, "bulk_create", side_effect=DataError)
+    def test_flush_error(self, mock_bulk_create, mock_start):
+        """Test a batch that cannot be written is saved one record at a time."""
+        for client_ip in ("1.2.3.4", "bad", "5.6.7.8"):
+            self.backend.record(AccessTokenUse(token=self.token, client_ip=client_ip))
+        save_token_use = audit.save_token_use
+
+        def _save_token_use(token_use):
+            if token_use.client_ip == "bad":
+                raise DataError
+            return save_token_use(token_use)
+
+        with mock.patch("perimeter.audit.save_token_use", _save_token_use):
+            with self.assertLogs("perimeter.audit", "ERROR") as logs:
+                self.assertEqual(self.backend.flush(), 2)
+        self.assertEqual(len(logs.output), 2)
+        self.assertEqual(len(self.backend), 0)
+        self.assertEqual(AccessTokenUse.objects.count(), 2)
+        self.token.refresh_from_db()
+        self.assertEqual(self.token.use_count, 2)
+
+    @mock.patch("perimeter.audit.save_token_use", side_effect=OperationalError)
+    @mock.patch.object(
+        AccessTokenUse.objects, "bulk_create", side_effect=OperationalError
+    )
+    def test_flush_database_unavailable(
+        self, mock_bulk_create, mock_save_token_use, mock_start
+    ):
+        """Test records are put back on the queue if the database is down."""
+        records = [
+            self.backend.record(AccessTokenUse(token=self.token)) for _ in range(5)
+        ]
+        with self.assertLogs("perimeter.audit", "ERROR"):
+            with self.assertRaises(OperationalError):
+                self.backend.flush()
+        self.assertEqual(list(self.backend._queue), records)
+        self.assertFalse(AccessTokenUse.objects.exists())
+
+    def test_requeue_full(self, mock_start):
+        records = [AccessTokenUse(token=self.token) for _ in range(12)]
+        for token_use in records[:4]:
+            self.backend.record(token_use)
+        with self.assertLogs("perimeter.audit", "ERROR"):
+            self.backend.requeue(records[4:])
+        self.assertEqual(list(self.backend._queue), records[4:10] + records[:4])
+
+    def test_batch_size_wakes_thread(self, mock_start):
+        for _ in range(4):
+            self.backend.record(AccessTokenUse(token=self.token))
+        self.assertFalse(self.backend._wakeup.is_set())
+        self.backend.record(AccessTokenUse(token=self.token))
+        self.assertTrue(self.backend._wakeup.is_set())
+
+    def test_buffer_full(self, mock_start):
+        """Once the buffer is full, records are saved synchronously."""
+        for _ in range(10):
+            self.backend.record(AccessTokenUse(token=self.token))
+        atu = self.backend.record(AccessTokenUse(token=self.token))
+        self.assertIsNotNone(atu.pk)
+        self.assertEqual(len(self.backend), 10)
+        self.assertEqual(AccessTokenUse.objects.count(), 1)
+
+
+class AuditBackendTests(TestCase):
+    def setUp(self):
+        get_audit_backend.cache_clear()
+
+    def tearDown(self):
+        get_audit_backend.cache_clear()
+
+    def test_base_backend(self):
+        self.assertRaises(NotImplementedError, AuditBackend().record, None)
+
+    def test_get_audit_backend_default(self):
+        backend = get_audit_backend()
+        self.assertIsInstance(backend, SyncAuditBackend)
+        self.assertIs(get_audit_backend(), backend)
+
+    @mock.patch(
+        "perimeter.audit.PERIMETER_AUDIT_BACKEND",
+        "perimeter.audit.BufferedAuditBackend",
+    )
+    def test_get_audit_backend(self):
+        self.assertIsInstance(get_audit_backend(), BufferedAuditBackend)
@@ -0,0 +1,199 @@
+from unittest import mock
+
+from django.core.cache import cache
+from django.test import SimpleTestCase, TestCase
+
+from perimeter.bloom import GENERATION_KEY, BloomFilter, TokenFilter
+from perimeter.cache import bump_generation, get_generation
+from perimeter.hashing import hash_token_value
+from perimeter.models import AccessToken, CachedToken, EmptyToken
+
+from .test_apps import SyncThread
+
+
+class BloomFilterTests(SimpleTestCase):
+    def test_sizing(self):
+        bloom = BloomFilter(capacity=1000, error_rate=0.01)
+        # ~9.6 bits and 7 hashes per value for a 1% error rate
+        self.assertEqual(bloom.num_bits, 9585)
+        self.assertEqual(bloom.num_hashes, 7)
+        self.assertEqual(bloom.size_bytes, 1199)
+
+    def test_no_false_negatives(self):
+        bloom = BloomFilter(capacity=1000, error_rate=0.01)
+        values = [f"token-{i}" for i in range(1000)]
+        for value in values:
+            bloom.add(value)
+        self.assertEqual(len(bloom), 1000)
+        self.assertTrue(all(value in bloom for value in values))
+
+    def test_error_rate(self):
+        bloom = BloomFilter(capacity=1000, error_rate=0.01)
+        for i in range(1000):
+            bloom.add(f"token-{i}")
+        self.assertAlmostEqual(bloom.estimated_error_rate, 0.01, places=3)
+        false_positives = sum(f"other-{i}" in bloom for i in range(10000))
+        self.assertLess(false_positives, 200)
+        # over capacity, the error rate goes up
+        for i in range(1000, 2000):
+            bloom.add(f"token-{i}")
+        self.assertGreater(bloom.estimated_error_rate, 0.1)
+
+
+@mock.patch("perimeter.bloom.connections", mock.Mock())
+@mock.patch("perimeter.bloom.threading.Thread", SyncThread)
+class TokenFilterTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.token = AccessToken.objects.create_access_token()
+        self.token_filter = TokenFilter(
+            enabled=True, capacity=1000, error_rate=0.01, refresh_interval=10
+        )
+        patcher = mock.patch("perimeter.models.token_filter", self.token_filter)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_disabled(self):
+        token_filter = TokenFilter(False, 1000, 0.01, 10)
+        self.assertFalse(token_filter.is_due)
+        token_filter.refresh_if_due()
+        self.assertTrue(token_filter.might_exist("bogus"))
+        self.assertFalse(token_filter.stats()["built"])
+
+    def test_build(self):
+        # not built yet, so everything might exist
+        self.assertTrue(self.token_filter.might_exist("bogus"))
+        with self.assertNumQueries(1):
+            self.token_filter.refresh_if_due()
+        self.assertTrue(self.token_filter.might_exist(self.token.token_hash))
+        self.assertFalse(self.token_filter.might_exist("bogus"))
+        stats = self.token_filter.stats()
+        self.assertTrue(stats["built"])
+        self.assertEqual(stats["count"], 1)
+        self.assertEqual(stats["rejects"], 1)
+        self.assertEqual(stats["size_bytes"], 1199)
+        # not due again for another 10s
+        self.assertFalse(self.token_filter.is_due)
+
+    def test_build_in_background(self):
+        with mock.patch("perimeter.bloom.threading.Thread") as mock_thread:
+            with self.assertNumQueries(0):
+                self.token_filter.refresh_if_due()
+        mock_thread.return_value.start.assert_called_once_with()
+        self.assertFalse(self.token_filter.stats()["built"])
+
+    def test_build_error(self):
+        with mock.patch.object(BloomFilter, "add", side_effect=Exception("boom")):
+            with self.assertLogs("perimeter.bloom", "ERROR"):
+                self.token_filter.refresh_if_due()
+        self.assertFalse(self.token_filter.stats()["built"])
+
+    def test_get_access_token(self):
+        self.token_filter.refresh_if_due()
+        with self.assertNumQueries(0), mock.patch("perimeter.models.cache") as m:
+            self.assertIsInstance(
+                AccessToken.objects.get_access_token("bogus"), EmptyToken
+            )
+            m.get.assert_not_called()
+        self.assertEqual(
+            AccessToken.objects.get_access_token(self.token.token),
+            CachedToken.from_token(self.token),
+        )
+
+    async def test_aget_access_token(self):
+        token = await AccessToken.objects.aget_access_token("bogus")
+        self.assertIsInstance(token, EmptyToken)
+        self.assertTrue(self.token_filter.stats()["built"])
+        self.assertEqual(self.token_filter.rejects, 1)
+
+    def test_new_token(self):
+        """Test tokens created in this process are added straight away."""
+        bump_generation(GENERATION_KEY)
+        self.token_filter.refresh_if_due()
+        generation = get_generation(GENERATION_KEY)
+        with self.captureOnCommitCallbacks(execute=True):
+            token = AccessToken.objects.create_access_token()
+        self.assertTrue(self.token_filter.might_exist(token.token_hash))
+        # ...and other processes are told to rebuild
+        self.assertEqual(get_generation(GENERATION_KEY), generation + 1)
+        # but this one is up to date, so does not need to
+        self.assertEqual(self.token_filter.stats()["generation"], generation + 1)
+
+    def test_new_token_filter_replaced(self):
+        """Test a filter replaced before the token is committed is rebuilt."""
+        bump_generation(GENERATION_KEY)
+        self.token_filter.refresh_if_due()
+        with self.captureOnCommitCallbacks(execute=True):
+            token = AccessToken.objects.create_access_token()
+            # a rebuild, from before the token was committed, finishes
+            self.token_filter._filter = BloomFilter(1000, 0.01)
+        self.assertNotEqual(
+            self.token_filter.stats()["generation"], get_generation(GENERATION_KEY)
+        )
+        with mock.patch("perimeter.bloom.time.monotonic", return_value=10**9):
+            self.token_filter.refresh_if_due()
+        self.assertTrue(self.token_filter.might_exist(token.token_hash))
+
+    def test_new_token_not_built(self):
+        """Test a token created before the filter is built is not lost."""
+        with self.captureOnCommitCallbacks(execute=True):
+            token = AccessToken.objects.create_access_token()
+        self.token_filter.refresh_if_due()
+        self.assertTrue(self.token_filter.might_exist(token.token_hash))
+
+    def test_changed_token_value(self):
+        """Test a token whose value is changed is found by its new value."""
+        bump_generation(GENERATION_KEY)
+        self.token_filter.refresh_if_due()
+        generation = get_generation(GENERATION_KEY)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.token.token = "newvalue"
+            self.token.save()
+        self.assertTrue(self.token_filter.might_exist(hash_token_value("newvalue")))
+        self.assertEqual(get_generation(GENERATION_KEY), generation + 1)
+        self.assertEqual(
+            AccessToken.objects.get_access_token("newvalue"),
+            CachedToken.from_token(self.token),
+        )
+        # saving without changing the value is not news
+        with self.captureOnCommitCallbacks(execute=True):
+            self.token.save()
+        self.assertEqual(get_generation(GENERATION_KEY), generation + 1)
+
+    def test_bulk_created_tokens(self):
+        self.token_filter.refresh_if_due()
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            tokens = AccessToken.objects.bulk_create_tokens(5, batch_size=10)
+        self.assertEqual(len(callbacks), 1)
+        self.assertTrue(
+            all(self.token_filter.might_exist(t.token_hash) for t in tokens)
+        )
+
+    def test_rebuild(self):
+        """Test tokens created by another process are picked up."""
+        self.token_filter.refresh_if_due()
+        # NB no token_hash - as if created before hashing was added
+        AccessToken.objects.bulk_create(
+            [
+                AccessToken(
+                    token="other",
+                    created_at=self.token.created_at,
+                    updated_at=self.token.updated_at,
+                )
+            ]
+        )
+        bump_generation(GENERATION_KEY)
+        self.assertFalse(self.token_filter.might_exist(hash_token_value("other")))
+        with mock.patch("perimeter.bloom.time.monotonic", return_value=10**9):
+            self.token_filter.refresh_if_due()
+        self.assertTrue(self.token_filter.might_exist(hash_token_value("other")))
+
+    def test_evicted_generation(self):
+        """Test a counter recreated after eviction does not repeat a generation."""
+        self.token_filter._bump_generation()
+        self.token_filter.refresh_if_due()
+        generation = self.token_filter.stats()["generation"]
+        cache.clear()
+        # a token created by another process, after the counter was evicted
+        TokenFilter(True, 1000, 0.01, 10)._bump_generation()
+        self.assertGreater(get_generation(GENERATION_KEY), generation)
@@ -0,0 +1,191 @@
+from unittest import mock
+
+from django.core.cache import cache as default_cache, caches
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils.connection import ConnectionProxy
+
+from perimeter.cache import CacheNamespace, LocalCache, bump_generation, cache_keys
+from perimeter.models import AccessToken, CachedToken
+
+CACHES = {
+    "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+    "perimeter": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "perimeter",
+    },
+}
+
+
+class LocalCacheTests(SimpleTestCase):
+    def test_disabled(self):
+        cache = LocalCache(max_size=0, timeout=60)
+        self.assertFalse(cache.enabled)
+        cache.set("foo", "bar")
+        self.assertIsNone(cache.get("foo"))
+        self.assertEqual(len(cache), 0)
+        # disabled cache lookups are not counted
+        self.assertEqual(cache.stats()["misses"], 0)
+
+    def test_get_set(self):
+        cache = LocalCache(max_size=10, timeout=60)
+        self.assertIsNone(cache.get("foo"))
+        cache.set("foo", "bar")
+        self.assertEqual(cache.get("foo"), "bar")
+        self.assertEqual(
+            cache.stats(), {"hits": 1, "misses": 1, "size": 1, "max_size": 10}
+        )
+
+    def test_delete(self):
+        cache = LocalCache(max_size=10, timeout=60)
+        cache.set("foo", "bar")
+        cache.delete("foo")
+        self.assertIsNone(cache.get("foo"))
+        # deleting a missing key is a no-op
+        cache.delete("foo")
+
+    def test_clear(self):
+        cache = LocalCache(max_size=10, timeout=60)
+        cache.set("foo", "bar")
+        cache.get("foo")
+        cache.clear()
+        self.assertEqual(
+            cache.stats(), {"hits": 0, "misses": 0, "size": 0, "max_size": 10}
+        )
+
+    def test_lru_eviction(self):
+        cache = LocalCache(max_size=2, timeout=60)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        # touch "a" so that "b" is the least recently used
+        cache.get("a")
+        cache.set("c", 3)
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.get("c"), 3)
+
+    @mock.patch("perimeter.cache.time.monotonic")
+    def test_ttl(self, mock_monotonic):
+        mock_monotonic.return_value = 1000
+        cache = LocalCache(max_size=10, timeout=60)
+        cache.set("foo", "bar")
+        mock_monotonic.return_value = 1059
+        self.assertEqual(cache.get("foo"), "bar")
+        mock_monotonic.return_value = 1060
+        self.assertIsNone(cache.get("foo"))
+        self.assertEqual(len(cache), 0)
+
+    @mock.patch("perimeter.cache.time.monotonic")
+    def test_ttl_capped(self, mock_monotonic):
+        """Per-entry timeout can be shorter, but not longer, than the default."""
+        mock_monotonic.return_value = 1000
+        cache = LocalCache(max_size=10, timeout=60)
+        cache.set("short", 1, timeout=10)
+        cache.set("long", 2, timeout=3600)
+        mock_monotonic.return_value = 1010
+        self.assertIsNone(cache.get("short"))
+        self.assertEqual(cache.get("long"), 2)
+        mock_monotonic.return_value = 1060
+        self.assertIsNone(cache.get("long"))
+
+    def test_set_negative_timeout(self):
+        cache = LocalCache(max_size=10, timeout=60)
+        cache.set("foo", "bar")
+        cache.set("foo", "baz", timeout=-1)
+        self.assertIsNone(cache.get("foo"))
+
+
+class CacheNamespaceTests(SimpleTestCase):
+    def setUp(self):
+        default_cache.clear()
+
+    @mock.patch("perimeter.cache.new_generation", lambda: 100)
+    @mock.patch("perimeter.cache.time.monotonic")
+    def test_make_key(self, mock_monotonic):
+        mock_monotonic.return_value = 1000
+        namespace = CacheNamespace("test", interval=10)
+        self.assertEqual(namespace.make_key("token", 1), "test:100:token:1")
+        # invalidated in this process - seen immediately
+        self.assertEqual(namespace.invalidate(), 101)
+        self.assertEqual(namespace.make_key("token", 1), "test:101:token:1")
+        # invalidated elsewhere - seen once the interval has passed
+        bump_generation("test:generation")
+        with mock.patch("perimeter.cache.get_generation") as mock_get:
+            self.assertEqual(namespace.make_key("token", 1), "test:101:token:1")
+            mock_get.assert_not_called()
+        mock_monotonic.return_value = 1010
+        self.assertEqual(namespace.make_key("token", 1), "test:102:token:1")
+
+    def test_evicted(self):
+        """Test a generation is not reused if the counter is evicted."""
+        namespace = CacheNamespace("test", interval=0)
+        generation = namespace.generation
+        self.assertGreater(generation, 0)
+        default_cache.clear()
+        # recreated by a reader...
+        self.assertGreater(namespace.generation, generation)
+        generation = namespace.generation
+        default_cache.clear()
+        # ...or by an invalidation
+        self.assertGreater(namespace.invalidate(), generation)
+
+    def test_invalidate_evicted(self):
+        """Test invalidate never goes backwards (e.g. if clocks disagree)."""
+        namespace = CacheNamespace("test", interval=10)
+        generation = namespace.invalidate()
+        default_cache.clear()
+        with mock.patch("perimeter.cache.new_generation", return_value=1):
+            self.assertEqual(namespace.invalidate(), generation + 1)
+        self.assertEqual(default_cache.get("test:generation"), generation + 1)
+
+    async def test_arefresh(self):
+        namespace = CacheNamespace("test", interval=0)
+        await default_cache.aset("test:generation", 5)
+        await namespace.arefresh()
+        self.assertEqual(namespace.make_key("x"), "test:5:x")
+
+    async def test_amake_key(self):
+        namespace = CacheNamespace("test", interval=0)
+        await default_cache.aset("test:generation", 5)
+        with mock.patch("perimeter.cache.get_generation") as mock_get:
+            self.assertEqual(await namespace.amake_key("x", 1), "test:5:x:1")
+        mock_get.assert_not_called()
+
+
+@override_settings(CACHES=CACHES)
+class CacheAliasTests(TestCase):
+    def test_alias(self):
+        """Test tokens are only cached in the cache set by PERIMETER_CACHE_ALIAS."""
+        with mock.patch("perimeter.models.cache", ConnectionProxy(caches, "perimeter")):
+            token = AccessToken.objects.create_access_token()
+            self.assertEqual(
+                AccessToken.objects.get_access_token(token.token),
+                CachedToken.from_token(token),
+            )
+        self.assertIsNotNone(caches["perimeter"].get(token.cache_key))
+        self.assertIsNone(caches["default"].get(token.cache_key))
+
+    def test_invalidate(self):
+        token = AccessToken.objects.create_access_token()
+        cache_key = token.cache_key
+        self.assertTrue(cache_key.startswith("perimeter:"))
+        self.assertIn(token.token_hash, cache_key)
+        default_cache.set("other", 1)
+        cache_keys.invalidate()
+        self.assertNotEqual(token.cache_key, cache_key)
+        self.assertIsNone(default_cache.get(token.cache_key))
+        # other keys are left alone
+        self.assertEqual(default_cache.get("other"), 1)
+        with self.assertNumQueries(1):
+            AccessToken.objects.get_access_token(token.token)
+
+    @mock.patch("perimeter.models.cache_keys.interval", 0)
+    def test_invalidate_evicted(self):
+        """Test entries from before an invalidation are not used again."""
+        default_cache.clear()
+        token = AccessToken.objects.create_access_token()
+        cache_keys.invalidate()
+        token.is_active = False
+        token.save()
+        default_cache.delete(cache_keys.generation_key)
+        self.assertFalse(AccessToken.objects.get_access_token(token.token).is_valid)
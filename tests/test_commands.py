@@ -0,0 +1,253 @@
+import csv
+import io
+import json
+import os
+import tempfile
+from datetime import date, timedelta
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase
+from django.utils.timezone import now
+
+from perimeter.hashing import hash_token_value
+from perimeter.models import AccessToken, AccessTokenUse
+
+
+class CreateAccessTokensTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_stdout(self):
+        out = io.StringIO()
+        call_command("create_access_tokens", count=5, batch_size=2, stdout=out)
+        rows = list(csv.reader(io.StringIO(out.getvalue())))
+        self.assertEqual(rows[0], ["token", "expires_on"])
+        self.assertEqual(len(rows), 6)
+        self.assertEqual(
+            {r[0] for r in rows[1:]},
+            set(AccessToken.objects.values_list("token", flat=True)),
+        )
+
+    def test_output_file(self):
+        user = get_user_model().objects.create_user(username="fred")
+        path = os.path.join(tempfile.mkdtemp(), "tokens.csv")
+        out = io.StringIO()
+        call_command(
+            "create_access_tokens",
+            count=3,
+            expires=1,
+            output=path,
+            created_by="fred",
+            stdout=out,
+        )
+        self.assertIn("Created 3 tokens", out.getvalue())
+        with open(path) as f:
+            self.assertEqual(len(list(csv.reader(f))), 4)
+        self.assertEqual(AccessToken.objects.filter(created_by=user).count(), 3)
+
+    def test_invalid_args(self):
+        with self.assertRaises(CommandError):
+            call_command("create_access_tokens", count=0)
+        with self.assertRaises(CommandError):
+            call_command("create_access_tokens", count=1, created_by="nobody")
+
+
+class ListAccessTokensTests(TestCase):
+    def setUp(self):
+        today = date.today()
+        self.user = get_user_model().objects.create_user(username="fred")
+        self.valid = AccessToken.objects.create_access_token(
+            token="valid", created_by=self.user
+        )
+        self.inactive = AccessToken.objects.create_access_token(
+            token="inactive", is_active=False
+        )
+        self.expired = AccessToken.objects.create_access_token(
+            token="expired", expires_on=today - timedelta(days=1)
+        )
+
+    def list_tokens(self, **options):
+        out = io.StringIO()
+        call_command("list_access_tokens", stdout=out, **options)
+        return out.getvalue()
+
+    def test_text(self):
+        lines = self.list_tokens().splitlines()
+        self.assertEqual(lines[0], "Listing all tokens:")
+        self.assertEqual(len(lines), 4)
+        self.assertTrue(lines[1].startswith("-  valid  expires "))
+        self.assertTrue(lines[2].startswith("x  inactive  expires "))
+        self.assertTrue(lines[3].startswith("x  expired  expired "))
+
+    def test_json(self):
+        rows = json.loads(self.list_tokens(format="json"))
+        self.assertEqual([r["token"] for r in rows], ["valid", "inactive", "expired"])
+        self.assertEqual(rows[0]["created_by"], "fred")
+        self.assertEqual(rows[0]["expires_on"], str(self.valid.expires_on))
+        self.assertEqual(
+            json.loads(self.list_tokens(format="json", chunk_size=1)), rows
+        )
+        AccessToken.objects.all().delete()
+        self.assertEqual(json.loads(self.list_tokens(format="json")), [])
+
+    def test_csv(self):
+        rows = list(csv.DictReader(io.StringIO(self.list_tokens(format="csv"))))
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(rows[1]["token"], "inactive")
+        self.assertEqual(rows[1]["is_active"], "False")
+
+    def test_filters(self):
+        def tokens(**options):
+            return [
+                r["token"]
+                for r in json.loads(self.list_tokens(format="json", **options))
+            ]
+
+        self.assertEqual(tokens(valid_only=True), ["valid"])
+        self.assertEqual(tokens(expired_only=True), ["expired"])
+        self.assertEqual(tokens(created_by="fred"), ["valid"])
+        self.assertEqual(tokens(created_by="fred", expired_only=True), [])
+        # one query, however many rows
+        with self.assertNumQueries(1):
+            self.list_tokens(format="csv")
+
+
+class PurgePerimeterTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        today = date.today()
+        self.old = AccessToken.objects.create_access_token(
+            token="old", expires_on=today - timedelta(days=100)
+        )
+        self.recent = AccessToken.objects.create_access_token(
+            token="recent", expires_on=today - timedelta(days=1)
+        )
+        for token in (self.old, self.recent):
+            token.record("fred@example.com", "Fred")
+        # an old record of a token that has not expired
+        AccessTokenUse(token=self.recent, timestamp=now() - timedelta(days=100)).save()
+
+    def purge(self, **options):
+        out = io.StringIO()
+        call_command("purge_perimeter", stdout=out, sleep=0, **options)
+        return out.getvalue()
+
+    def test_dry_run(self):
+        out = self.purge(dry_run=True)
+        self.assertIn("Would delete 1 token use records", out)
+        self.assertIn("Would delete 1 tokens", out)
+        self.assertEqual(AccessToken.objects.count(), 2)
+        self.assertEqual(AccessTokenUse.objects.count(), 3)
+
+    def test_purge(self):
+        self.assertIsNotNone(cache.get(self.old.cache_key))
+        out = self.purge(batch_size=1)
+        self.assertIn("Deleted 1 token use records", out)
+        self.assertIn("Deleted 1 tokens", out)
+        self.assertEqual(list(AccessToken.objects.all()), [self.recent])
+        self.assertEqual(AccessTokenUse.objects.get().token, self.recent)
+        self.assertIsNone(cache.get(self.old.cache_key))
+        self.assertIsNotNone(cache.get(self.recent.cache_key))
+
+    def test_purge_older_than(self):
+        self.purge(older_than=0)
+        self.assertFalse(AccessToken.objects.exists())
+        self.assertFalse(AccessTokenUse.objects.exists())
+
+    def test_invalid_args(self):
+        with self.assertRaises(CommandError):
+            self.purge(batch_size=0)
+
+
+class BackfillTokenUsageTests(TestCase):
+    def test_backfill(self):
+        used = AccessToken.objects.create_access_token()
+        unused = AccessToken.objects.create_access_token()
+        timestamps = [now() - timedelta(days=i) for i in range(3)]
+        AccessTokenUse.objects.bulk_create(
+            AccessTokenUse(token=used, timestamp=ts) for ts in timestamps
+        )
+        AccessToken.objects.filter(pk=unused.pk).update(use_count=5)
+        out = io.StringIO()
+        call_command("backfill_token_usage", batch_size=1, stdout=out)
+        self.assertIn("Updated usage stats for 2 tokens", out.getvalue())
+        used.refresh_from_db()
+        unused.refresh_from_db()
+        self.assertEqual(used.use_count, 3)
+        self.assertEqual(used.last_used_at, timestamps[0])
+        self.assertEqual(unused.use_count, 0)
+        self.assertIsNone(unused.last_used_at)
+
+
+class HashAccessTokensTests(TestCase):
+    def setUp(self):
+        self.hashed = AccessToken.objects.create_access_token(token="x")
+        self.unhashed = AccessToken.objects.bulk_create(
+            [AccessToken(token="y", created_at=now(), updated_at=now())]
+        )[0]
+
+    def test_hash(self):
+        out = io.StringIO()
+        call_command("hash_access_tokens", batch_size=1, stdout=out)
+        self.assertIn("Hashed 1 tokens", out.getvalue())
+        self.unhashed.refresh_from_db()
+        self.assertEqual(self.unhashed.token_hash, hash_token_value("y"))
+        self.assertEqual(self.unhashed.token, "y")
+
+    def test_clear_plaintext(self):
+        with self.assertRaises(CommandError):
+            call_command("hash_access_tokens", clear_plaintext=True)
+        out = io.StringIO()
+        with mock.patch(
+            "perimeter.management.commands.hash_access_tokens.PERIMETER_TOKEN_STORAGE",
+            "hashed",
+        ):
+            call_command("hash_access_tokens", clear_plaintext=True, stdout=out)
+        self.assertIn("Cleared 2 plaintext tokens", out.getvalue())
+        self.assertFalse(AccessToken.objects.filter(token__isnull=False).exists())
+        self.assertEqual(
+            set(AccessToken.objects.values_list("token_hash", flat=True)),
+            {hash_token_value("x"), hash_token_value("y")},
+        )
+        out = io.StringIO()
+        call_command("list_access_tokens", stdout=out)
+        self.assertIn("(hashed)", out.getvalue())
+
+    def test_invalid_args(self):
+        with self.assertRaises(CommandError):
+            call_command("hash_access_tokens", batch_size=0)
+
+
+class InvalidatePerimeterCacheTests(TestCase):
+    def test_invalidate(self):
+        token = AccessToken.objects.create_access_token()
+        cache_key = token.cache_key
+        out = io.StringIO()
+        call_command("invalidate_perimeter_cache", stdout=out)
+        self.assertIn("Invalidated cached tokens", out.getvalue())
+        self.assertNotEqual(token.cache_key, cache_key)
+
+
+class WarmPerimeterCacheTests(TestCase):
+    def test_warm(self):
+        token = AccessToken.objects.create_access_token()
+        cache.clear()
+        out = io.StringIO()
+        call_command("warm_perimeter_cache", chunk_size=1, stdout=out)
+        self.assertIn("Cached 1 of 1 valid tokens", out.getvalue())
+        self.assertIsNotNone(cache.get(token.cache_key))
+
+    def test_locked(self):
+        cache.add("perimeter:warm.lock", 1)
+        out = io.StringIO()
+        call_command("warm_perimeter_cache", stdout=out)
+        self.assertIn("already being warmed", out.getvalue())
+        cache.clear()
+
+    def test_invalid_args(self):
+        with self.assertRaises(CommandError):
+            call_command("warm_perimeter_cache", chunk_size=0)
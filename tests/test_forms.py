@@ -1,11 +1,15 @@
 import datetime
+from unittest import mock
 
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
 from django.test import RequestFactory, TestCase
 from django.utils.timezone import now
 
 from perimeter.forms import TokenGatewayForm, UserGatewayForm
-from perimeter.models import AccessToken, AccessTokenUse
+from perimeter.grants import sign_grant, verify_grant
+from perimeter.models import AccessToken, AccessTokenUse, CachedToken
+from perimeter.settings import PERIMETER_GRANT_SESSION_KEY, PERIMETER_SESSION_KEY
 
 YESTERDAY = now().date() - datetime.timedelta(days=1)
 
@@ -24,6 +28,7 @@ class BaseGatewayFormTests(TestCase):
         return form
 
     def setUp(self):
+        cache.clear()
         self.factory = RequestFactory()
         self.payload = {"token": "test"}
         self.token = AccessToken(token="test").save()
@@ -33,7 +38,7 @@ class TokenGatewayFormTests(BaseGatewayFormTests):
     def test_post_valid_token(self):
         form = self.get_form(TokenGatewayForm, self.payload)
         self.assertTrue(form.is_valid())
-        self.assertEqual(form._token, self.token)
+        self.assertEqual(form._token, CachedToken.from_token(self.token))
         # test with user info missing
         payload = {"token": self.payload["token"]}
         form = self.get_form(TokenGatewayForm, payload)
@@ -44,6 +49,7 @@ class TokenGatewayFormTests(BaseGatewayFormTests):
         self.token.is_active = False
         self.token.save(update_fields=["is_active"])
         self.assertFalse(form.is_valid())
+        self.assertTrue(form.has_error("token", code="inactive"))
         self.assertRaises(ValidationError, form.clean_token)
 
     def test_clean_expired_token(self):
@@ -51,14 +57,32 @@ class TokenGatewayFormTests(BaseGatewayFormTests):
         self.token.expires_on = YESTERDAY
         self.token.save(update_fields=["expires_on"])
         self.assertFalse(form.is_valid())
+        self.assertTrue(form.has_error("token", code="expired"))
         self.assertRaises(ValidationError, form.clean_token)
 
     def test_no_matching_token(self):
         form = self.get_form(TokenGatewayForm, self.payload)
         AccessToken.objects.all().delete()
         self.assertFalse(form.is_valid())
+        self.assertTrue(form.has_error("token", code="not_found"))
         self.assertRaises(ValidationError, form.clean_token)
 
+    def test_clean_token_uses_cache(self):
+        # first lookup caches the token, so the second needs no query
+        self.assertTrue(self.get_form(TokenGatewayForm, self.payload).is_valid())
+        with self.assertNumQueries(0):
+            form = self.get_form(TokenGatewayForm, self.payload)
+            self.assertTrue(form.is_valid())
+
+    @mock.patch("perimeter.models.PERIMETER_NEGATIVE_CACHE_TIMEOUT", 60)
+    def test_clean_token_negative_cache(self):
+        payload = {"token": "bogus"}
+        self.assertFalse(self.get_form(TokenGatewayForm, payload).is_valid())
+        with self.assertNumQueries(0):
+            form = self.get_form(TokenGatewayForm, payload)
+            self.assertFalse(form.is_valid())
+            self.assertTrue(form.has_error("token", code="not_found"))
+
     def test_save(self):
         request = self.get_request(self.payload)
         form = self.get_form(TokenGatewayForm, self.payload)
@@ -70,6 +94,55 @@ class TokenGatewayFormTests(BaseGatewayFormTests):
         self.assertEqual(au.token, self.token)
         self.assertEqual(au.client_ip, "127.0.0.1")
         self.assertEqual(au.client_user_agent, "test_agent")
+        self.assertNotIn(PERIMETER_GRANT_SESSION_KEY, request.session)
+
+    @mock.patch("perimeter.forms.get_audit_backend")
+    def test_save_audit_backend(self, mock_get_audit_backend):
+        request = self.get_request(self.payload)
+        form = self.get_form(TokenGatewayForm, self.payload)
+        self.assertTrue(form.is_valid())
+        au = form.save(request)
+        mock_record = mock_get_audit_backend.return_value.record
+        self.assertEqual(au, mock_record.return_value)
+        atu = mock_record.call_args[0][0]
+        self.assertIsNone(atu.pk)
+        self.assertEqual(atu.token, self.token)
+        self.assertEqual(atu.client_ip, "127.0.0.1")
+
+    @mock.patch("perimeter.forms.PERIMETER_SIGNED_GRANTS", True)
+    def test_save_signed_grant(self):
+        request = self.get_request(self.payload)
+        form = self.get_form(TokenGatewayForm, self.payload)
+        self.assertTrue(form.is_valid())
+        form.save(request)
+        self.assertEqual(request.session[PERIMETER_SESSION_KEY], "test")
+        self.assertTrue(verify_grant(request.session[PERIMETER_GRANT_SESSION_KEY]))
+
+    @mock.patch("perimeter.forms.PERIMETER_SIGNED_GRANTS", True)
+    def test_save_scoped_token_no_grant(self):
+        self.token.scope_paths = "/reports/"
+        self.token.save()
+        request = self.get_request(self.payload)
+        form = self.get_form(TokenGatewayForm, self.payload)
+        self.assertTrue(form.is_valid())
+        form.save(request)
+        self.assertEqual(request.session[PERIMETER_SESSION_KEY], "test")
+        self.assertNotIn(PERIMETER_GRANT_SESSION_KEY, request.session)
+
+    @mock.patch("perimeter.forms.PERIMETER_SIGNED_GRANTS", True)
+    def test_save_switch_to_scoped_token(self):
+        """Test a grant for a previous token is not kept for a scoped one."""
+        request = self.get_request(self.payload)
+        request.session[PERIMETER_GRANT_SESSION_KEY] = sign_grant(
+            CachedToken.from_token(AccessToken.objects.create_access_token())
+        )
+        self.token.scope_paths = "/reports/"
+        self.token.save()
+        form = self.get_form(TokenGatewayForm, self.payload)
+        self.assertTrue(form.is_valid())
+        form.save(request)
+        self.assertEqual(request.session[PERIMETER_SESSION_KEY], "test")
+        self.assertNotIn(PERIMETER_GRANT_SESSION_KEY, request.session)
 
 
 class UserGatewayFormTests(BaseGatewayFormTests):
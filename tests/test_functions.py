@@ -1,8 +1,17 @@
 from os import environ
 
+from django.core.exceptions import ImproperlyConfigured
 from django.test import TestCase
 
-from perimeter.settings import CAST_AS_BOOL, CAST_AS_INT, get_setting
+from perimeter.settings import (
+    CAST_AS_BOOL,
+    CAST_AS_INT,
+    CAST_AS_LIST,
+    CAST_AS_TOKEN_STORAGE,
+    check_token_hash_secret,
+    get_gateway_path,
+    get_setting,
+)
 
 
 class SettingsTests(TestCase):
@@ -16,6 +25,29 @@ class SettingsTests(TestCase):
         self.assertFalse(CAST_AS_BOOL(None))
         self.assertFalse(CAST_AS_BOOL("1"))
 
+    def test_cast_as_list(self):
+        self.assertEqual(CAST_AS_LIST("/a/"), ["/a/"])
+        self.assertEqual(CAST_AS_LIST("/a/,/b/"), ["/a/", "/b/"])
+        self.assertEqual(CAST_AS_LIST(["/a/", "/b/"]), ["/a/", "/b/"])
+        self.assertEqual(CAST_AS_LIST(("/a/",)), ["/a/"])
+        self.assertEqual(CAST_AS_LIST([]), [])
+
+    def test_cast_as_token_storage(self):
+        for mode in ("plain", "dual", "hashed"):
+            self.assertEqual(CAST_AS_TOKEN_STORAGE(mode), mode)
+        with self.assertRaises(ImproperlyConfigured):
+            CAST_AS_TOKEN_STORAGE("hash")
+
+    def test_check_token_hash_secret(self):
+        check_token_hash_secret("plain", None)
+        check_token_hash_secret("dual", None)
+        check_token_hash_secret("hashed", "secret")
+        with self.assertRaises(ImproperlyConfigured):
+            check_token_hash_secret("hashed", None)
+
+    def test_get_gateway_path(self):
+        self.assertEqual(get_gateway_path(), "/perimeter/gateway/")
+
     def test_get_settings(self):
         with self.settings(TEST_SETTING=True):
             self.assertTrue(get_setting("TEST_SETTING", False))
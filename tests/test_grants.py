@@ -0,0 +1,46 @@
+from datetime import timedelta
+from unittest import mock
+
+from django.core import signing
+from django.test import SimpleTestCase
+from django.utils.timezone import now
+
+from perimeter.grants import GRANT_SALT, sign_grant, verify_grant
+from perimeter.models import CachedToken
+
+TODAY = now().date()
+YESTERDAY = TODAY - timedelta(days=1)
+
+
+class GrantTests(SimpleTestCase):
+    def test_sign_grant(self):
+        grant = sign_grant(CachedToken(1, True, TODAY))
+        self.assertEqual(signing.loads(grant, salt=GRANT_SALT), [1, TODAY.toordinal()])
+
+    def test_verify_grant(self):
+        self.assertTrue(verify_grant(sign_grant(CachedToken(1, True, TODAY))))
+
+    def test_verify_grant_empty(self):
+        self.assertFalse(verify_grant(None))
+        self.assertFalse(verify_grant(""))
+
+    def test_verify_grant_bad_signature(self):
+        grant = sign_grant(CachedToken(1, True, TODAY))
+        self.assertFalse(verify_grant(grant[:-1]))
+        # signed with a different salt
+        self.assertFalse(verify_grant(signing.dumps([1, TODAY.toordinal()])))
+
+    def test_verify_grant_malformed(self):
+        self.assertFalse(verify_grant(signing.dumps("foo", salt=GRANT_SALT)))
+
+    def test_verify_grant_expired_token(self):
+        self.assertFalse(verify_grant(sign_grant(CachedToken(1, True, YESTERDAY))))
+
+    @mock.patch("perimeter.grants.PERIMETER_GRANT_REFRESH_INTERVAL", 300)
+    def test_verify_grant_refresh_interval(self):
+        grant = sign_grant(CachedToken(1, True, TODAY))
+        with mock.patch("django.core.signing.time.time") as mock_time:
+            mock_time.return_value = now().timestamp() + 299
+            self.assertTrue(verify_grant(grant))
+            mock_time.return_value = now().timestamp() + 301
+            self.assertFalse(verify_grant(grant))
@@ -0,0 +1,29 @@
+from unittest import mock
+
+from django.test import SimpleTestCase
+from django.utils.crypto import salted_hmac
+
+from perimeter.hashing import KEY_SALT, hash_token_value
+
+
+class HashTokenValueTests(SimpleTestCase):
+    def test_hash_token_value(self):
+        digest = hash_token_value("x")
+        self.assertEqual(len(digest), 64)
+        self.assertEqual(digest, hash_token_value("x"))
+        self.assertNotEqual(digest, hash_token_value("y"))
+        # the same as Django's own salted_hmac
+        self.assertEqual(
+            digest, salted_hmac(KEY_SALT, "x", algorithm="sha256").hexdigest()
+        )
+
+    def test_secret(self):
+        digest = hash_token_value("x")
+        with mock.patch("perimeter.hashing.PERIMETER_TOKEN_HASH_SECRET", "secret"):
+            self.assertNotEqual(hash_token_value("x"), digest)
+            self.assertEqual(
+                hash_token_value("x"),
+                salted_hmac(
+                    KEY_SALT, "x", secret="secret", algorithm="sha256"  # noqa: S106
+                ).hexdigest(),
+            )
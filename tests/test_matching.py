@@ -0,0 +1,98 @@
+from django.test import SimpleTestCase
+
+from perimeter.matching import HostMatcher, PathMatcher, TokenScope, compile_scope
+
+
+class PathMatcherTests(SimpleTestCase):
+    def test_empty(self):
+        matcher = PathMatcher()
+        self.assertFalse(matcher)
+        self.assertFalse(matcher("/"))
+        self.assertFalse(matcher(""))
+
+    def test_paths(self):
+        matcher = PathMatcher(paths=["/health/", "/robots.txt"])
+        self.assertTrue(matcher)
+        self.assertTrue(matcher("/health/"))
+        self.assertTrue(matcher("/robots.txt"))
+        self.assertFalse(matcher("/health/x"))
+        self.assertFalse(matcher("/health"))
+
+    def test_prefixes(self):
+        matcher = PathMatcher(prefixes=["/static/", "/media/", "/static/"])
+        self.assertEqual(matcher.prefixes, ("/media/", "/static/"))
+        self.assertTrue(matcher("/static/"))
+        self.assertTrue(matcher("/static/css/site.css"))
+        self.assertTrue(matcher("/media/x.png"))
+        self.assertFalse(matcher("/statics/"))
+        self.assertFalse(matcher("/x/static/"))
+
+    def test_patterns(self):
+        matcher = PathMatcher(patterns=[r"/webhooks/\w+/$", r"/api/v\d+/status"])
+        self.assertTrue(matcher("/webhooks/stripe/"))
+        self.assertTrue(matcher("/api/v2/status/"))
+        self.assertFalse(matcher("/webhooks/stripe/x"))
+        # patterns are anchored to the start of the path
+        self.assertFalse(matcher("/x/api/v2/status"))
+
+    def test_combined(self):
+        matcher = PathMatcher(
+            paths=["/health/"], prefixes=["/static/"], patterns=[r"/hooks/"]
+        )
+        self.assertTrue(matcher("/health/"))
+        self.assertTrue(matcher("/static/x"))
+        self.assertTrue(matcher("/hooks/x"))
+        self.assertFalse(matcher("/"))
+
+
+class HostMatcherTests(SimpleTestCase):
+    def test_empty(self):
+        matcher = HostMatcher()
+        self.assertFalse(matcher)
+        self.assertFalse(matcher("example.com"))
+
+    def test_exact(self):
+        matcher = HostMatcher(["Example.com"])
+        self.assertTrue(matcher("example.com"))
+        self.assertTrue(matcher("EXAMPLE.COM:8000"))
+        self.assertFalse(matcher("www.example.com"))
+        self.assertFalse(matcher("example.org"))
+
+    def test_subdomains(self):
+        matcher = HostMatcher([".example.com"])
+        self.assertTrue(matcher("example.com"))
+        self.assertTrue(matcher("www.example.com:443"))
+        self.assertTrue(matcher("a.b.example.com"))
+        self.assertFalse(matcher("badexample.com"))
+
+    def test_match_all(self):
+        matcher = HostMatcher(["*"])
+        self.assertTrue(matcher)
+        self.assertTrue(matcher("anything.example.org"))
+
+
+class TokenScopeTests(SimpleTestCase):
+    def test_unrestricted(self):
+        scope = TokenScope()
+        self.assertTrue(scope("example.com", "/"))
+
+    def test_hosts(self):
+        scope = TokenScope(hosts=["staging.example.com"])
+        self.assertTrue(scope("staging.example.com", "/x/"))
+        self.assertFalse(scope("example.com", "/x/"))
+
+    def test_paths(self):
+        scope = TokenScope(paths=["/reports/"])
+        self.assertTrue(scope("example.com", "/reports/2024/"))
+        self.assertFalse(scope("example.com", "/admin/"))
+
+    def test_hosts_and_paths(self):
+        scope = TokenScope(hosts=[".example.com"], paths=["/reports/"])
+        self.assertTrue(scope("www.example.com", "/reports/"))
+        self.assertFalse(scope("www.example.com", "/"))
+        self.assertFalse(scope("example.org", "/reports/"))
+
+    def test_compile_scope(self):
+        scope = compile_scope(("example.com",), ("/reports/",))
+        self.assertIs(compile_scope(("example.com",), ("/reports/",)), scope)
+        self.assertIsNot(compile_scope(("example.com",), ()), scope)
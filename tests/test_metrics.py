@@ -0,0 +1,132 @@
+import math
+from datetime import date
+from unittest import mock
+
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+
+from perimeter.metrics import InMemoryRegistry, MetricsSink
+from perimeter.middleware import PERIMETER_SESSION_KEY, PerimeterAccessMiddleware
+from perimeter.models import AccessToken
+from perimeter.settings import get_gateway_path
+
+
+class MetricsSinkTests(SimpleTestCase):
+    def test_noop(self):
+        sink = MetricsSink()
+        self.assertFalse(sink.enabled)
+        sink.increment("foo")
+        sink.observe("bar", 1.0)
+
+
+class InMemoryRegistryTests(SimpleTestCase):
+    def test_increment(self):
+        registry = InMemoryRegistry()
+        self.assertTrue(registry.enabled)
+        registry.increment("foo")
+        registry.increment("foo", 2)
+        registry.increment("bar")
+        self.assertEqual(registry.collect()["counters"], {"foo": 3, "bar": 1})
+
+    def test_observe(self):
+        registry = InMemoryRegistry(buckets=(0.1, 1))
+        self.assertEqual(registry.buckets, (0.1, 1, math.inf))
+        registry.observe("foo", 0.05)
+        registry.observe("foo", 0.1)
+        registry.observe("foo", 0.5)
+        registry.observe("foo", 5)
+        histogram = registry.collect()["histograms"]["foo"]
+        self.assertEqual(histogram["buckets"], {0.1: 2, 1: 3, math.inf: 4})
+        self.assertEqual(histogram["sum"], 5.65)
+        self.assertEqual(histogram["count"], 4)
+
+    def test_reset(self):
+        registry = InMemoryRegistry()
+        registry.increment("foo")
+        registry.observe("bar", 1)
+        registry.reset()
+        self.assertEqual(registry.collect(), {"counters": {}, "histograms": {}})
+
+    def test_render(self):
+        registry = InMemoryRegistry(buckets=(0.1,))
+        registry.increment("redirect")
+        registry.observe("validation_seconds", 0.05)
+        self.assertEqual(
+            registry.render(),
+            "# TYPE perimeter_redirect_total counter\n"
+            "perimeter_redirect_total 1\n"
+            "# TYPE perimeter_validation_seconds histogram\n"
+            'perimeter_validation_seconds_bucket{le="0.1"} 1\n'
+            'perimeter_validation_seconds_bucket{le="+Inf"} 1\n'
+            "perimeter_validation_seconds_sum 0.05\n"
+            "perimeter_validation_seconds_count 1\n",
+        )
+
+
+@override_settings(PERIMETER_ENABLED=True)
+class MiddlewareMetricsTests(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.middleware = PerimeterAccessMiddleware(get_response=mock.MagicMock)
+        self.registry = InMemoryRegistry()
+        patcher = mock.patch("perimeter.metrics.sink", self.registry)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def request(self, token_value=None, path="/"):
+        request = self.factory.get(path)
+        request.session = {PERIMETER_SESSION_KEY: token_value}
+        self.middleware(request)
+
+    def assertCounters(self, **counters):
+        self.assertEqual(self.registry.collect()["counters"], counters)
+
+    def test_bypass(self):
+        self.request(path=get_gateway_path())
+        self.assertCounters(bypass=1)
+
+    def test_valid_token(self):
+        token = AccessToken.objects.create_access_token()
+        self.request(token.token)
+        self.assertCounters(cache_hit=1)
+        histogram = self.registry.collect()["histograms"]["validation_seconds"]
+        self.assertEqual(histogram["count"], 1)
+
+    def test_cache_miss(self):
+        self.request("foo")
+        self.assertCounters(cache_miss=1, db_miss=1, redirect=1)
+
+    def test_missing_token(self):
+        self.request()
+        self.assertCounters(redirect=1)
+
+    def test_expired_token(self):
+        token = AccessToken.objects.create_access_token(expires_on=date(2000, 1, 1))
+        self.request(token.token)
+        self.assertCounters(cache_hit=1, expired=1, redirect=1)
+
+    def test_inactive_token(self):
+        token = AccessToken.objects.create_access_token(is_active=False)
+        self.request(token.token)
+        self.assertCounters(cache_hit=1, inactive=1, redirect=1)
+
+    def test_out_of_scope(self):
+        token = AccessToken.objects.create_access_token(scope_paths="/reports/")
+        self.request(token.token)
+        self.assertCounters(cache_hit=1, out_of_scope=1, redirect=1)
+
+    @mock.patch("perimeter.middleware.PERIMETER_SIGNED_GRANTS", True)
+    def test_grant(self):
+        token = AccessToken.objects.create_access_token()
+        request = self.factory.get("/")
+        request.session = {PERIMETER_SESSION_KEY: token.token}
+        self.middleware(request)
+        self.middleware(request)
+        self.assertCounters(cache_hit=1, grant=1)
+
+    def test_disabled(self):
+        """Validation is not timed if the sink is not enabled."""
+        with mock.patch("perimeter.metrics.sink", MetricsSink()), mock.patch(
+            "perimeter.middleware.time.perf_counter"
+        ) as mock_perf_counter:
+            self.request("foo")
+        mock_perf_counter.assert_not_called()
@@ -1,21 +1,29 @@
 from unittest import mock
 from urllib.parse import urlparse
 
+from asgiref.sync import sync_to_async
 from django.contrib.auth.models import AnonymousUser, User
+from django.contrib.sessions.middleware import SessionMiddleware
 from django.core.exceptions import ImproperlyConfigured, MiddlewareNotUsed
+from django.http import HttpResponse
 from django.test import RequestFactory, TestCase, override_settings
 from django.urls import resolve, reverse
 
 from perimeter.middleware import (
+    PERIMETER_GRANT_SESSION_KEY,
     PERIMETER_SESSION_KEY,
     PerimeterAccessMiddleware,
+    aget_access_token,
+    aget_request_token,
     bypass_perimeter,
     check_middleware,
     get_access_token,
     get_request_token,
+    has_request_grant,
+    set_request_grant,
     set_request_token,
 )
-from perimeter.models import AccessToken, EmptyToken
+from perimeter.models import AccessToken, CachedToken, EmptyToken
 
 
 @override_settings(PERIMETER_ENABLED=True)
@@ -51,6 +59,22 @@ class PerimeterMiddlewareTests(TestCase):
         request = self.factory.get(reverse("perimeter:gateway"))
         self.assertTrue(bypass_perimeter(request))
 
+    @mock.patch("perimeter.middleware.PERIMETER_BYPASS_PATHS", ["/health/"])
+    @mock.patch("perimeter.middleware.PERIMETER_BYPASS_PREFIXES", ["/static/"])
+    @mock.patch("perimeter.middleware.PERIMETER_BYPASS_PATTERNS", [r"/hooks/\w+/$"])
+    def test_bypass_paths(self):
+        middleware = PerimeterAccessMiddleware(get_response=mock.MagicMock)
+        for path in ("/health/", "/static/site.css", "/hooks/stripe/"):
+            request = self.factory.get(path)
+            # bypass is checked before the session is used
+            with mock.patch("perimeter.middleware.bypass_perimeter") as mock_bypass:
+                response = middleware(request)
+            mock_bypass.assert_not_called()
+            self.assertNotEqual(getattr(response, "status_code", None), 302)
+        request = self.factory.get("/hooks/stripe/x")
+        request.session = {}
+        self.assertEqual(middleware(request).status_code, 302)
+
     def test_get_request_token_session(self):
         at = AccessToken.objects.create_access_token()
         self.request.session[PERIMETER_SESSION_KEY] = at.token
@@ -74,7 +98,7 @@ class PerimeterMiddlewareTests(TestCase):
     def test_get_access_token(self):
         at = AccessToken.objects.create_access_token()
         self.request.session[PERIMETER_SESSION_KEY] = at.token
-        self.assertEqual(get_access_token(self.request), at)
+        self.assertEqual(get_access_token(self.request), CachedToken.from_token(at))
 
     def test_access_token_empty(self):
         token = get_access_token(self.request)
@@ -136,3 +160,251 @@ class PerimeterMiddlewareTests(TestCase):
         self._assertRedirectsToGateway(
             request, query="next=%2Fsomepath%2F%3Fimportant%3Dparam"
         )
+
+
+@override_settings(PERIMETER_ENABLED=True, ALLOWED_HOSTS=["*"])
+class TokenScopeMiddlewareTests(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.middleware = PerimeterAccessMiddleware(get_response=mock.MagicMock)
+        self.token = AccessToken.objects.create_access_token(
+            scope_hosts="staging.example.com", scope_paths="/reports/\n/exports/"
+        )
+
+    def get_response(self, path="/reports/", host="staging.example.com"):
+        request = self.factory.get(path, HTTP_HOST=host)
+        request.session = {PERIMETER_SESSION_KEY: self.token.token}
+        return self.middleware(request)
+
+    def test_in_scope(self):
+        self.assertNotEqual(getattr(self.get_response(), "status_code", None), 302)
+        response = self.get_response("/exports/1/", host="staging.example.com:8000")
+        self.assertNotEqual(getattr(response, "status_code", None), 302)
+
+    def test_out_of_scope_path(self):
+        self.assertEqual(self.get_response("/admin/").status_code, 302)
+
+    def test_out_of_scope_host(self):
+        self.assertEqual(self.get_response(host="example.com").status_code, 302)
+
+    def test_no_extra_queries(self):
+        self.get_response()
+        with self.assertNumQueries(0):
+            self.get_response()
+            self.get_response("/admin/")
+
+    @mock.patch("perimeter.middleware.PERIMETER_SIGNED_GRANTS", True)
+    def test_no_grant(self):
+        request = self.factory.get("/reports/", HTTP_HOST="staging.example.com")
+        request.session = {PERIMETER_SESSION_KEY: self.token.token}
+        self.middleware(request)
+        self.assertFalse(has_request_grant(request))
+
+
+@override_settings(PERIMETER_ENABLED=True)
+@mock.patch("perimeter.middleware.PERIMETER_SIGNED_GRANTS", True)
+class SignedGrantMiddlewareTests(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.request = self.factory.get("/")
+        self.request.session = {}
+        self.middleware = PerimeterAccessMiddleware(get_response=mock.MagicMock)
+        self.token = AccessToken.objects.create_access_token()
+
+    def test_set_request_grant(self):
+        self.assertFalse(has_request_grant(self.request))
+        set_request_grant(self.request, CachedToken.from_token(self.token))
+        self.assertTrue(has_request_grant(self.request))
+
+    def test_set_request_token_clears_grant(self):
+        set_request_grant(self.request, CachedToken.from_token(self.token))
+        set_request_token(self.request, "foo")
+        self.assertFalse(has_request_grant(self.request))
+
+    def test_grant_issued(self):
+        self.request.session[PERIMETER_SESSION_KEY] = self.token.token
+        self.middleware(self.request)
+        self.assertTrue(has_request_grant(self.request))
+
+    def test_grant_not_issued_for_invalid_token(self):
+        self.request.session[PERIMETER_SESSION_KEY] = "foo"
+        self.middleware(self.request)
+        self.assertNotIn(PERIMETER_GRANT_SESSION_KEY, self.request.session)
+
+    @mock.patch("perimeter.middleware.get_access_token")
+    def test_grant_skips_token_lookup(self, mock_get_access_token):
+        set_request_grant(self.request, CachedToken.from_token(self.token))
+        response = self.middleware(self.request)
+        self.assertNotEqual(getattr(response, "status_code", None), 302)
+        mock_get_access_token.assert_not_called()
+
+    def test_stale_grant_rechecks_token(self):
+        self.request.session[PERIMETER_SESSION_KEY] = self.token.token
+        set_request_grant(self.request, CachedToken.from_token(self.token))
+        self.token.is_active = False
+        self.token.save()
+        # grant is trusted until the refresh interval has passed
+        self.assertNotEqual(
+            getattr(self.middleware(self.request), "status_code", None), 302
+        )
+        with mock.patch("perimeter.grants.PERIMETER_GRANT_REFRESH_INTERVAL", -1):
+            response = self.middleware(self.request)
+        self.assertEqual(response.status_code, 302)
+
+    def test_http_header_ignores_grant(self):
+        request = self.factory.get("/", HTTP_X_PERIMETER_TOKEN="foo")
+        request.session = {}
+        set_request_grant(request, CachedToken.from_token(self.token))
+        self.assertEqual(request.session, {})
+        request.session[PERIMETER_GRANT_SESSION_KEY] = self.request.session.get(
+            PERIMETER_GRANT_SESSION_KEY
+        )
+        self.assertFalse(has_request_grant(request))
+        self.assertEqual(self.middleware(request).status_code, 302)
+
+    async def test_grant_async(self):
+        async def get_response(request):
+            return HttpResponse("OK")
+
+        middleware = PerimeterAccessMiddleware(get_response=get_response)
+        self.request.session[PERIMETER_SESSION_KEY] = self.token.token
+        response = await middleware(self.request)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(has_request_grant(self.request))
+        with mock.patch("perimeter.middleware.aget_access_token") as mock_get:
+            response = await middleware(self.request)
+        self.assertEqual(response.status_code, 200)
+        mock_get.assert_not_called()
+
+
+@override_settings(PERIMETER_ENABLED=True)
+class SessionLoadingTests(TestCase):
+    """Check that the session is only loaded if it has to be."""
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.middleware = PerimeterAccessMiddleware(get_response=mock.MagicMock)
+        self.token = AccessToken.objects.create_access_token()
+
+    def get_request(self, **extra):
+        request = self.factory.get("/", **extra)
+        SessionMiddleware(get_response=mock.MagicMock).process_request(request)
+        return request
+
+    def test_header_token(self):
+        request = self.get_request(HTTP_X_PERIMETER_TOKEN=self.token.token)
+        with self.assertNumQueries(0):
+            response = self.middleware(request)
+        self.assertNotEqual(getattr(response, "status_code", None), 302)
+        self.assertFalse(request.session.accessed)
+
+    def test_invalid_header_token(self):
+        request = self.get_request(HTTP_X_PERIMETER_TOKEN="foo")
+        self.assertEqual(self.middleware(request).status_code, 302)
+        self.assertFalse(request.session.accessed)
+
+    @mock.patch("perimeter.middleware.PERIMETER_SIGNED_GRANTS", True)
+    def test_header_token_signed_grants(self):
+        request = self.get_request(HTTP_X_PERIMETER_TOKEN=self.token.token)
+        self.middleware(request)
+        self.assertFalse(request.session.accessed)
+        self.assertFalse(request.session.modified)
+
+    def test_header_token_no_session_middleware(self):
+        """Header tokens work without the session middleware installed."""
+        request = self.factory.get("/", HTTP_X_PERIMETER_TOKEN=self.token.token)
+        response = self.middleware(request)
+        self.assertNotEqual(getattr(response, "status_code", None), 302)
+        self.assertEqual(get_request_token(request), self.token.token)
+
+    def test_session_token(self):
+        request = self.get_request()
+        self.assertFalse(request.session.accessed)
+        self.assertEqual(self.middleware(request).status_code, 302)
+        self.assertTrue(request.session.accessed)
+
+    async def test_header_token_async(self):
+        async def get_response(request):
+            return HttpResponse("OK")
+
+        middleware = PerimeterAccessMiddleware(get_response=get_response)
+        request = self.get_request(HTTP_X_PERIMETER_TOKEN=self.token.token)
+        response = await middleware(request)
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(request.session.accessed)
+
+
+@override_settings(PERIMETER_ENABLED=True)
+class AsyncPerimeterMiddlewareTests(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.request = self.factory.get("/")
+        self.request.session = {}
+
+        async def get_response(request):
+            return HttpResponse("OK")
+
+        self.middleware = PerimeterAccessMiddleware(get_response=get_response)
+
+    async def test_get_request_token_http_header(self):
+        request = self.factory.get("/", HTTP_X_PERIMETER_TOKEN="foo")
+        request.session = {PERIMETER_SESSION_KEY: "bar"}
+        self.assertEqual(await aget_request_token(request), "foo")
+
+    async def test_get_request_token_session(self):
+        self.request.session[PERIMETER_SESSION_KEY] = "foo"
+        self.assertEqual(await aget_request_token(self.request), "foo")
+
+    async def test_get_request_token_async_session(self):
+        """Sessions that support the async API are used directly."""
+        self.request.session = mock.Mock()
+        self.request.session.aget = mock.AsyncMock(return_value="foo")
+        self.assertEqual(await aget_request_token(self.request), "foo")
+        self.request.session.aget.assert_awaited_once_with(PERIMETER_SESSION_KEY, None)
+        self.request.session.get.assert_not_called()
+
+    async def test_get_access_token(self):
+        at = await sync_to_async(AccessToken.objects.create_access_token)()
+        self.request.session[PERIMETER_SESSION_KEY] = at.token
+        self.assertEqual(
+            await aget_access_token(self.request), CachedToken.from_token(at)
+        )
+
+    async def test_access_token_empty(self):
+        token = await aget_access_token(self.request)
+        self.assertIsInstance(token, EmptyToken)
+
+    async def test_missing_session(self):
+        del self.request.session
+        with self.assertRaises(ImproperlyConfigured):
+            await self.middleware(self.request)
+
+    async def test_missing_token(self):
+        response = await self.middleware(self.request)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(resolve(response.url).url_name, "gateway")
+
+    async def test_valid_token(self):
+        at = await sync_to_async(AccessToken.objects.create_access_token)()
+        self.request.session[PERIMETER_SESSION_KEY] = at.token
+        response = await self.middleware(self.request)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, b"OK")
+
+    async def test_perimeter_token_header(self):
+        at = await sync_to_async(AccessToken.objects.create_access_token)()
+        request = self.factory.get("/", HTTP_X_PERIMETER_TOKEN=at.token)
+        request.session = {}
+        response = await self.middleware(request)
+        self.assertEqual(response.status_code, 200)
+
+    async def test_bypass_perimeter(self):
+        request = self.factory.get(reverse("perimeter:gateway"))
+        request.session = {}
+        response = await self.middleware(request)
+        self.assertEqual(response.status_code, 200)
+
+    @mock.patch.object(PerimeterAccessMiddleware, "process_request")
+    async def test_sync_path_not_used(self, mock_process_request):
+        await self.middleware(self.request)
+        mock_process_request.assert_not_called()
@@ -1,9 +1,15 @@
+from datetime import date, timedelta
+
 from django.apps import apps
 from django.db import connection
 from django.db.migrations.autodetector import MigrationAutodetector
 from django.db.migrations.executor import MigrationExecutor
 from django.db.migrations.state import ProjectState
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
+from django.utils.timezone import now
+
+from perimeter.hashing import hash_token_value
+from perimeter.models import AccessToken, AccessTokenUse
 
 
 class MigrationsTests(TestCase):
@@ -19,3 +25,76 @@ class MigrationsTests(TestCase):
                 "Your models have changes that are not yet reflected "
                 "in a migration. You should add them now."
             )
+
+
+class HashTokensMigrationTests(TransactionTestCase):
+    def migrate(self, name):
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate([("perimeter", name)])
+        return executor.loader.project_state([("perimeter", name)]).apps
+
+    def test_hash_tokens(self):
+        latest = MigrationExecutor(connection).loader.graph.leaf_nodes("perimeter")[0]
+        old_apps = self.migrate("0008_token_hash")
+        try:
+            OldAccessToken = old_apps.get_model("perimeter", "AccessToken")
+            OldAccessToken.objects.create(token="x", created_at=now(), updated_at=now())
+        finally:
+            self.migrate(latest[1])
+        self.assertEqual(AccessToken.objects.get().token_hash, hash_token_value("x"))
+
+
+class QueryPlanTests(TestCase):
+    """Check that the common token / audit queries use an index."""
+
+    def setUp(self):
+        today = date.today()
+        new_tokens = [
+            AccessToken(
+                token=f"token-{i}",
+                is_active=bool(i % 2),
+                expires_on=today + timedelta(days=i - 50),
+                created_at=now(),
+                updated_at=now(),
+            )
+            for i in range(100)
+        ]
+        tokens = AccessToken.objects.bulk_create(new_tokens)
+        AccessTokenUse.objects.bulk_create(
+            AccessTokenUse(token=token, timestamp=now()) for token in tokens
+        )
+        if connection.vendor == "sqlite":
+            # give the planner some statistics to work with
+            with connection.cursor() as cursor:
+                cursor.execute("ANALYZE")
+
+    def assertUsesIndex(self, queryset, index_name):
+        if connection.vendor == "postgresql":
+            # tiny tables are always cheaper to scan, so rule that out
+            with connection.cursor() as cursor:
+                cursor.execute("SET LOCAL enable_seqscan = off")
+        elif connection.vendor != "sqlite":
+            self.skipTest(f"Query plan not checked on {connection.vendor}")
+        self.assertIn(index_name, queryset.explain())
+
+    def test_live_tokens(self):
+        queryset = AccessToken.objects.filter(
+            is_active=True, expires_on__gte=date.today()
+        )
+        self.assertUsesIndex(queryset, "perimeter_token_expiry_idx")
+
+    def test_expired_tokens(self):
+        queryset = AccessToken.objects.filter(expires_on__lt=date.today())
+        self.assertUsesIndex(queryset, "perimeter_token_expiry_idx")
+
+    def test_token_uses(self):
+        token = AccessToken.objects.first()
+        queryset = AccessTokenUse.objects.filter(token=token).order_by("-timestamp")
+        self.assertUsesIndex(queryset, "perimeter_use_token_ts_idx")
+
+    def test_recent_uses(self):
+        queryset = AccessTokenUse.objects.filter(
+            timestamp__gte=now() - timedelta(days=1)
+        )
+        self.assertUsesIndex(queryset, "perimeter_use_ts_idx")
@@ -1,7 +1,17 @@
+import asyncio
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date, datetime, time, timedelta
+from time import sleep
+from unittest import mock
 
+from asgiref.sync import sync_to_async
 from django.core.cache import cache
-from django.test import TestCase
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ValidationError
+from django.test import TestCase, override_settings
 from django.utils.timezone import (
     get_current_timezone,
     is_aware,
@@ -10,7 +20,17 @@ from django.utils.timezone import (
     now,
 )
 
-from perimeter.models import AccessToken, AccessTokenUse, EmptyToken, default_expiry
+from perimeter.cache import LocalCache, fill_locks
+from perimeter.hashing import hash_token_value
+from perimeter.models import (
+    TOKEN_NOT_FOUND,
+    AccessToken,
+    AccessTokenUse,
+    CachedToken,
+    EmptyToken,
+    default_expiry,
+    get_cache_timeout,
+)
 from perimeter.settings import PERIMETER_DEFAULT_EXPIRY
 
 TODAY = now().date()
@@ -26,6 +46,9 @@ class EmptyTokenTests(TestCase):
 
 
 class AccessTokenManagerTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
     def test_create_with_token(self):
         """If a token is passed in to create_access_token, it's used."""
         token = AccessToken.objects.create_access_token(token="x")
@@ -45,14 +68,437 @@ class AccessTokenManagerTests(TestCase):
         self.assertEqual(token, AccessToken.objects.get())
         self.assertTrue(len(token.token), 10)
 
+    def test_bulk_create_tokens(self):
+        # one insert per batch (each wrapped in a savepoint)
+        with self.assertNumQueries(9):
+            tokens = AccessToken.objects.bulk_create_tokens(
+                5, expires_on=TOMORROW, batch_size=2
+            )
+        self.assertEqual(len(tokens), 5)
+        self.assertEqual(AccessToken.objects.filter(expires_on=TOMORROW).count(), 5)
+        self.assertEqual(len({t.token for t in tokens}), 5)
+        token = AccessToken.objects.get(pk=tokens[0].pk)
+        self.assertIsNotNone(token.created_at)
+        self.assertEqual(token.created_at, token.updated_at)
+        # not cached unless asked
+        self.assertIsNone(cache.get(token.cache_key))
+
+    def test_bulk_create_tokens_warm_cache(self):
+        tokens = AccessToken.objects.bulk_create_tokens(3, warm_cache=True)
+        with self.assertNumQueries(0):
+            for token in tokens:
+                self.assertEqual(
+                    AccessToken.objects.get_access_token(token.token),
+                    CachedToken.from_token(token),
+                )
+
+    def test_bulk_create_tokens_clash(self):
+        """Test a batch that clashes with an existing token is retried."""
+        AccessToken.objects.create_access_token(token="x")
+        values = iter(["x", "y", "z"])
+        with mock.patch.object(AccessToken, "random_token_value", lambda: next(values)):
+            tokens = AccessToken.objects.bulk_create_tokens(1)
+        self.assertEqual([t.token for t in tokens], ["y"])
+
     def test_get_access_token(self):
         """Test the caching works."""
         token = AccessToken.objects.create_access_token()
         cache.clear()
         self.assertIsNone(cache.get(token.cache_key))
         token2 = AccessToken.objects.get_access_token(token.token)
-        self.assertEqual(token, token2)
-        self.assertIsNotNone(cache.get(token.cache_key))
+        self.assertEqual(token2, CachedToken.from_token(token))
+        self.assertEqual(cache.get(token.cache_key), token2.to_payload())
+
+    def test_get_access_token_local_cache(self):
+        """Test the in-process cache is used in front of the Django cache."""
+        local_cache = LocalCache(max_size=10, timeout=60)
+        token = AccessToken.objects.create_access_token()
+        with mock.patch("perimeter.models.local_cache", local_cache):
+            AccessToken.objects.get_access_token(token.token)
+            self.assertEqual(local_cache.stats()["misses"], 1)
+            with mock.patch("perimeter.models.cache") as mock_cache:
+                token2 = AccessToken.objects.get_access_token(token.token)
+                mock_cache.get.assert_not_called()
+            self.assertEqual(token2, CachedToken.from_token(token))
+            self.assertEqual(local_cache.stats()["hits"], 1)
+            # saving / deleting the token invalidates the local entry
+            token.save()
+            self.assertIsNone(local_cache.get(token.cache_key))
+            AccessToken.objects.get_access_token(token.token)
+            token.delete()
+            self.assertIsNone(local_cache.get(token.cache_key))
+
+    @mock.patch("perimeter.models.PERIMETER_CACHE_TIMEOUT_JITTER", 0)
+    @mock.patch("perimeter.models.PERIMETER_CACHE_INVALID_TIMEOUT", 5)
+    @mock.patch("perimeter.cache.time.monotonic")
+    def test_get_access_token_local_cache_expired(self, mock_monotonic):
+        """Test that expired tokens are held in the in-process cache briefly."""
+        mock_monotonic.return_value = 1000
+        local_cache = LocalCache(max_size=10, timeout=60)
+        token = AccessToken.objects.create_access_token(expires_on=YESTERDAY)
+        with mock.patch("perimeter.models.local_cache", local_cache):
+            AccessToken.objects.get_access_token(token.token)
+        self.assertIsNotNone(local_cache.get(token.cache_key))
+        mock_monotonic.return_value = 1005
+        self.assertIsNone(local_cache.get(token.cache_key))
+
+    def test_get_access_token_not_found(self):
+        """Test unknown tokens are not cached by default."""
+        self.assertIsInstance(AccessToken.objects.get_access_token("x"), EmptyToken)
+        self.assertIsNone(cache.get(AccessToken.get_cache_key("x")))
+        with self.assertNumQueries(1):
+            AccessToken.objects.get_access_token("x")
+
+    @mock.patch("perimeter.models.PERIMETER_NEGATIVE_CACHE_TIMEOUT", 60)
+    def test_get_access_token_negative_cache(self):
+        """Test unknown tokens are cached if negative caching is enabled."""
+        cache_key = AccessToken.get_cache_key("x")
+        with self.assertNumQueries(1):
+            token = AccessToken.objects.get_access_token("x")
+        self.assertIsInstance(token, EmptyToken)
+        self.assertEqual(cache.get(cache_key), TOKEN_NOT_FOUND)
+        with self.assertNumQueries(0):
+            token = AccessToken.objects.get_access_token("x")
+        self.assertIsInstance(token, EmptyToken)
+        # creating the token replaces the negative entry
+        at = AccessToken.objects.create_access_token(token="x")
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                AccessToken.objects.get_access_token("x"), CachedToken.from_token(at)
+            )
+
+    async def test_aget_access_token(self):
+        """Test the async version of get_access_token."""
+        token = await sync_to_async(AccessToken.objects.create_access_token)()
+        await cache.aclear()
+        token2 = await AccessToken.objects.aget_access_token(token.token)
+        self.assertEqual(token2, CachedToken.from_token(token))
+        self.assertEqual(await cache.aget(token.cache_key), token2.to_payload())
+        self.assertIsInstance(
+            await AccessToken.objects.aget_access_token("x"), EmptyToken
+        )
+        self.assertIsInstance(
+            await AccessToken.objects.aget_access_token(""), EmptyToken
+        )
+
+    @mock.patch("perimeter.models.cache_keys.interval", 0)
+    async def test_aget_access_token_no_sync_cache_calls(self):
+        """Test the async version never blocks on the cache (to build keys)."""
+        token = await sync_to_async(AccessToken.objects.create_access_token)()
+        await cache.aclear()
+        with mock.patch("perimeter.cache.get_generation") as mock_get_generation:
+            token2 = await AccessToken.objects.aget_access_token(token.token)
+            await AccessToken.objects.aget_access_token("x")
+        mock_get_generation.assert_not_called()
+        self.assertEqual(token2, CachedToken.from_token(token))
+        self.assertEqual(await cache.aget(token.cache_key), token2.to_payload())
+
+    @mock.patch("perimeter.models.PERIMETER_NEGATIVE_CACHE_TIMEOUT", 60)
+    async def test_aget_access_token_negative_cache(self):
+        token = await AccessToken.objects.aget_access_token("x")
+        self.assertIsInstance(token, EmptyToken)
+        self.assertEqual(
+            await cache.aget(AccessToken.get_cache_key("x")), TOKEN_NOT_FOUND
+        )
+
+
+class CacheStampedeTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.token = AccessToken.objects.create_access_token()
+        self.cached_token = CachedToken.from_token(self.token)
+        cache.clear()
+
+    def slow_fetch(self, token_value, cache_key):
+        """Stand-in for _fetch_access_token that gives other threads a chance."""
+        sleep(0.1)
+        AccessToken.objects._cache_set(self.token.cache_key, self.cached_token)
+        return self.cached_token
+
+    def test_single_flight(self):
+        """Test only one thread reloads a token missing from the cache."""
+        with mock.patch.object(
+            AccessToken.objects, "_fetch_access_token", side_effect=self.slow_fetch
+        ) as mock_fetch:
+            with ThreadPoolExecutor(max_workers=5) as executor:
+                tokens = list(
+                    executor.map(
+                        AccessToken.objects.get_access_token, [self.token.token] * 5
+                    )
+                )
+        self.assertEqual(mock_fetch.call_count, 1)
+        self.assertEqual(tokens, [self.cached_token] * 5)
+
+    def test_unknown_token_not_serialised(self):
+        """Test misses for an unknown token (not cached) are not queued up."""
+        in_flight = []
+        peak = []
+
+        def slow_fetch(token_value, cache_key):
+            in_flight.append(token_value)
+            peak.append(len(in_flight))
+            sleep(0.1)
+            in_flight.remove(token_value)
+            return TOKEN_NOT_FOUND
+
+        with mock.patch.object(
+            AccessToken.objects, "_fetch_access_token", side_effect=slow_fetch
+        ) as mock_fetch:
+            with ThreadPoolExecutor(max_workers=5) as executor:
+                tokens = list(
+                    executor.map(AccessToken.objects.get_access_token, ["x"] * 5)
+                )
+        self.assertTrue(all(isinstance(token, EmptyToken) for token in tokens))
+        self.assertEqual(mock_fetch.call_count, 5)
+        # one thread fetches, then the others (which waited for it) together
+        self.assertGreater(max(peak), 1)
+
+    @mock.patch("perimeter.models.FILL_WAIT_TIMEOUT", 0.01)
+    def test_fill_wait_timeout(self):
+        """Test threads do not wait for ever on another thread's refill."""
+        with fill_locks(self.token.cache_key), self.assertNumQueries(1):
+            token = AccessToken.objects.get_access_token(self.token.token)
+        self.assertEqual(token, self.cached_token)
+
+    async def test_async_single_flight(self):
+        """Test only one coroutine reloads a token missing from the cache."""
+
+        async def slow_afetch(token_value, cache_key):
+            await asyncio.sleep(0.1)
+            return self.cached_token
+
+        with mock.patch.object(
+            AccessToken.objects, "_afetch_access_token", side_effect=slow_afetch
+        ) as mock_afetch:
+            tokens = await asyncio.gather(
+                *[AccessToken.objects.aget_access_token(self.token.token)] * 5
+            )
+        self.assertEqual(mock_afetch.call_count, 1)
+        self.assertEqual(list(tokens), [self.cached_token] * 5)
+
+    async def test_async_single_flight_cancelled(self):
+        """Test cancelling the coroutine doing the reload does not affect others."""
+
+        async def slow_afetch(token_value, cache_key):
+            await asyncio.sleep(0.1)
+            return self.cached_token
+
+        with mock.patch.object(
+            AccessToken.objects, "_afetch_access_token", side_effect=slow_afetch
+        ) as mock_afetch:
+            first = asyncio.ensure_future(
+                AccessToken.objects.aget_access_token(self.token.token)
+            )
+            await asyncio.sleep(0.01)
+            second = asyncio.ensure_future(
+                AccessToken.objects.aget_access_token(self.token.token)
+            )
+            await asyncio.sleep(0.01)
+            first.cancel()
+            self.assertEqual(await second, self.cached_token)
+        self.assertTrue(first.cancelled())
+        self.assertEqual(mock_afetch.call_count, 1)
+
+    @mock.patch("perimeter.models.random.random", lambda: 0.99)
+    @mock.patch("perimeter.models.PERIMETER_CACHE_EARLY_REFRESH", 60)
+    def test_early_refresh(self):
+        # a long way from going stale - no refresh
+        self.cached_token.stale_at = int(now().timestamp()) + 3600
+        cache.set(self.token.cache_key, self.cached_token.to_payload())
+        with self.assertNumQueries(0):
+            AccessToken.objects.get_access_token(self.token.token)
+        # nearly stale - refresh
+        self.cached_token.stale_at = int(now().timestamp()) + 1
+        cache.set(self.token.cache_key, self.cached_token.to_payload())
+        with self.assertNumQueries(1):
+            AccessToken.objects.get_access_token(self.token.token)
+        self.assertGreater(
+            CachedToken.from_payload(cache.get(self.token.cache_key)).stale_at,
+            self.cached_token.stale_at,
+        )
+
+    @mock.patch("perimeter.models.random.random", lambda: 0.99)
+    @mock.patch("perimeter.models.PERIMETER_CACHE_EARLY_REFRESH", 60)
+    def test_early_refresh_in_progress(self):
+        """Test the stale token is used if another thread is refreshing it."""
+        self.cached_token.stale_at = int(now().timestamp()) + 1
+        cache.set(self.token.cache_key, self.cached_token.to_payload())
+        with fill_locks(self.token.cache_key), self.assertNumQueries(0):
+            token = AccessToken.objects.get_access_token(self.token.token)
+        self.assertEqual(token, self.cached_token)
+
+    @mock.patch("perimeter.models.PERIMETER_CACHE_LOCK_TIMEOUT", 1)
+    def test_distributed_lock(self):
+        """Test processes wait for the process holding the lock to fill the cache."""
+        lock_key = f"{self.token.cache_key}.lock"
+        cache.add(lock_key, 1)
+
+        def fill_cache(seconds):
+            AccessToken.objects._cache_set(self.token.cache_key, self.cached_token)
+
+        with mock.patch("perimeter.models.time.sleep", side_effect=fill_cache):
+            with self.assertNumQueries(0):
+                token = AccessToken.objects.get_access_token(self.token.token)
+        self.assertEqual(token, self.cached_token)
+
+    @mock.patch("perimeter.models.PERIMETER_CACHE_LOCK_TIMEOUT", 1)
+    def test_distributed_lock_released(self):
+        """Test the database is used if the lock is released with no value."""
+        lock_key = f"{self.token.cache_key}.lock"
+        cache.add(lock_key, 1)
+        with mock.patch(
+            "perimeter.models.time.sleep", side_effect=lambda s: cache.delete(lock_key)
+        ):
+            with self.assertNumQueries(1):
+                token = AccessToken.objects.get_access_token(self.token.token)
+        self.assertEqual(token, self.cached_token)
+        # our own lock is released once the cache has been filled
+        cache.delete(self.token.cache_key)
+        AccessToken.objects.get_access_token(self.token.token)
+        self.assertIsNone(cache.get(lock_key))
+
+
+class RedisLikeCache(LocMemCache):
+    """
+    Stand-in for a Redis cache backend.
+
+    Like Redis SETEX, setting a key with a timeout that is not a positive
+    number of seconds is an error (where other backends might store the
+    value forever, or not at all).
+
+    """
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        if timeout is not DEFAULT_TIMEOUT and (timeout is None or timeout <= 0):
+            raise ValueError("invalid expire time in 'setex' command")
+        super().set(key, value, timeout, version)
+
+
+TEST_CACHES = {
+    "locmem": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+    "file": {
+        "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+        "LOCATION": os.path.join(tempfile.gettempdir(), "perimeter-test-cache"),
+    },
+    "redis": {"BACKEND": "tests.test_models.RedisLikeCache"},
+}
+
+
+@mock.patch("perimeter.models.PERIMETER_CACHE_TIMEOUT_JITTER", 0)
+@mock.patch("perimeter.models.PERIMETER_CACHE_INVALID_TIMEOUT", 30)
+@mock.patch("perimeter.models.PERIMETER_CACHE_MAX_TIMEOUT", 3600)
+@mock.patch("perimeter.models.PERIMETER_CACHE_MIN_TIMEOUT", 60)
+class CacheTimeoutTests(TestCase):
+    def test_valid_token(self):
+        # cached until it expires (midnight, in a few days)...
+        token = CachedToken(1, True, TODAY + timedelta(days=3))
+        with mock.patch.object(CachedToken, "seconds_to_expiry", 600):
+            self.assertEqual(get_cache_timeout(token), 600)
+        # ...but for no less than the minimum
+        with mock.patch.object(CachedToken, "seconds_to_expiry", -600):
+            self.assertEqual(get_cache_timeout(token), 60)
+        # ...and no more than the maximum
+        self.assertEqual(get_cache_timeout(token), 3600)
+
+    def test_invalid_token(self):
+        self.assertEqual(get_cache_timeout(CachedToken(1, True, YESTERDAY)), 30)
+        self.assertEqual(get_cache_timeout(CachedToken(1, False, TOMORROW)), 30)
+
+    def test_jitter(self):
+        token = CachedToken(1, True, TODAY + timedelta(days=3))
+        with mock.patch("perimeter.models.PERIMETER_CACHE_TIMEOUT_JITTER", 10):
+            with mock.patch("perimeter.models.random.random", lambda: 0.5):
+                self.assertEqual(get_cache_timeout(token), 3420)
+            timeouts = {get_cache_timeout(token) for _ in range(100)}
+        self.assertTrue(all(3240 <= t <= 3600 for t in timeouts))
+        self.assertGreater(len(timeouts), 1)
+
+    def test_minimum(self):
+        """Test the timeout is always positive."""
+        token = CachedToken(1, False, TOMORROW)
+        with mock.patch("perimeter.models.PERIMETER_CACHE_INVALID_TIMEOUT", 0):
+            self.assertEqual(get_cache_timeout(token), 1)
+
+    def test_backends(self):
+        """Test expired, inactive and far-future tokens on each backend."""
+        for name, config in TEST_CACHES.items():
+            with self.subTest(name), override_settings(CACHES={"default": config}):
+                cache.clear()
+                tokens = [
+                    AccessToken.objects.create_access_token(expires_on=YESTERDAY),
+                    AccessToken.objects.create_access_token(is_active=False),
+                    AccessToken.objects.create_access_token(
+                        expires_on=TODAY + timedelta(days=3650)
+                    ),
+                ]
+                # all three are cached, so none needs a query
+                with self.assertNumQueries(0):
+                    results = [
+                        AccessToken.objects.get_access_token(t.token) for t in tokens
+                    ]
+                self.assertEqual([t.is_valid for t in results], [False, False, True])
+                cache.clear()
+
+
+class CachedTokenTests(TestCase):
+    def test_from_token(self):
+        at = AccessToken(pk=1, token="foo", is_active=False, expires_on=TOMORROW)
+        token = CachedToken.from_token(at)
+        self.assertEqual(token.pk, 1)
+        self.assertFalse(token.is_active)
+        self.assertEqual(token.expires_on, TOMORROW)
+        self.assertEqual(token.seconds_to_expiry, at.seconds_to_expiry)
+
+    def test_payload(self):
+        token = CachedToken(1, True, TOMORROW, stale_at=1000)
+        payload = token.to_payload()
+        self.assertEqual(
+            payload, (CachedToken.VERSION, 1, True, TOMORROW.toordinal(), 1000, (), ())
+        )
+        self.assertEqual(CachedToken.from_payload(payload), token)
+        self.assertEqual(CachedToken.from_payload(payload).stale_at, 1000)
+
+    def test_scope(self):
+        at = AccessToken(
+            pk=1,
+            expires_on=TOMORROW,
+            scope_hosts="acme.example.com\n",
+            scope_paths=" /previews/acme/ \n\n/static/",
+        )
+        token = CachedToken.from_token(at)
+        self.assertTrue(token.is_scoped)
+        self.assertEqual(token.hosts, ("acme.example.com",))
+        self.assertEqual(token.paths, ("/previews/acme/", "/static/"))
+        self.assertEqual(CachedToken.from_payload(token.to_payload()), token)
+        # compiled once, and shared between tokens with the same scope
+        self.assertIs(token.scope, token.scope)
+        self.assertIs(token.scope, CachedToken.from_token(at).scope)
+        self.assertTrue(token.scope("acme.example.com", "/previews/acme/1"))
+        self.assertFalse(token.scope("acme.example.com", "/"))
+        # unscoped
+        token = CachedToken(1, True, TOMORROW)
+        self.assertFalse(token.is_scoped)
+        self.assertIsNone(token.scope)
+
+    def test_from_payload_invalid(self):
+        token = CachedToken(1, True, TOMORROW)
+        self.assertIsNone(CachedToken.from_payload(None))
+        self.assertIsNone(CachedToken.from_payload(TOKEN_NOT_FOUND))
+        # previous versions of the payload are ignored
+        self.assertIsNone(CachedToken.from_payload((0,) + token.to_payload()[1:]))
+        # as are model instances cached by previous versions of the app
+        self.assertIsNone(CachedToken.from_payload(AccessToken(token="foo")))
+
+    def test_is_valid(self):
+        self.assertTrue(CachedToken(1, True, TODAY).is_valid)
+        self.assertTrue(CachedToken(1, True, TOMORROW).is_valid)
+        self.assertFalse(CachedToken(1, True, YESTERDAY).is_valid)
+        self.assertFalse(CachedToken(1, False, TOMORROW).is_valid)
+        self.assertTrue(CachedToken(1, True, YESTERDAY).has_expired)
+
+    def test_get_access_token(self):
+        at = AccessToken.objects.create_access_token()
+        self.assertEqual(CachedToken.from_token(at).get_access_token(), at)
 
 
 class AccessTokenTests(TestCase):
@@ -64,7 +510,7 @@ class AccessTokenTests(TestCase):
     def test_attrs(self):
         # start with the defaults
         at = AccessToken()
-        self.assertEqual(at.token, "")
+        self.assertIsNone(at.token)
         self.assertEqual(at.is_active, True)
         self.assertEqual(at.expires_on, default_expiry())
         self.assertEqual(at.created_at, None)
@@ -96,13 +542,32 @@ class AccessTokenTests(TestCase):
         token = AccessToken(token="test")
         self.assertIsNotNone(token.cache_key)
         self.assertEqual(token.cache_key, AccessToken.get_cache_key("test"))
+        # the cache never holds token values
+        self.assertNotIn("test", token.cache_key)
 
     def test_cache_management(self):
         token = AccessToken.objects.create_access_token()
-        self.assertEqual(cache.get(token.cache_key), token)
+        self.assertEqual(
+            CachedToken.from_payload(cache.get(token.cache_key)),
+            CachedToken.from_token(token),
+        )
         token.delete()
         self.assertIsNone(cache.get(token.cache_key))
 
+    def test_cache_management_changed_value(self):
+        token = AccessToken.objects.create_access_token(token="oldvalue")
+        cache_key = token.cache_key
+        token.token = "newvalue"
+        token.save()
+        self.assertIsNone(cache.get(cache_key))
+        self.assertIsInstance(
+            AccessToken.objects.get_access_token("oldvalue"), EmptyToken
+        )
+        self.assertEqual(
+            AccessToken.objects.get_access_token("newvalue"),
+            CachedToken.from_token(token),
+        )
+
     def test_generate_random_token(self):
         f = AccessToken._meta.get_field("token").max_length
         t1 = AccessToken.random_token_value()
@@ -162,6 +627,172 @@ class AccessTokenTests(TestCase):
         self.assertIsNotNone(atu.timestamp, "Hugo")
         self.assertEqual(atu.client_ip, "unknown")
         self.assertEqual(atu.client_user_agent, "unknown")
+        at.refresh_from_db()
+        self.assertEqual(at.use_count, 1)
+        self.assertEqual(at.last_used_at, atu.timestamp)
+
+    def test_save_usage_stats(self):
+        """Test saving a token does not overwrite its usage stats."""
+        at = AccessToken(token="test_token").save()
+        stale = AccessToken.objects.get()
+        at.record("hugo@yunojuno.com", "Hugo")
+        at.record("hugo@yunojuno.com", "Hugo")
+        stale.is_active = False
+        stale.save()
+        at.refresh_from_db()
+        self.assertFalse(at.is_active)
+        self.assertEqual(at.use_count, 2)
+        self.assertIsNotNone(at.last_used_at)
+
+
+class WarmCacheTests(TestCase):
+    def setUp(self):
+        self.valid = [
+            AccessToken.objects.create_access_token(expires_on=expires_on)
+            for expires_on in (TODAY, TOMORROW, TOMORROW)
+        ]
+        AccessToken.objects.create_access_token(expires_on=YESTERDAY)
+        AccessToken.objects.create_access_token(is_active=False)
+        cache.clear()
+
+    def test_warm_cache(self):
+        with mock.patch.object(cache, "set_many", wraps=cache.set_many) as set_many:
+            self.assertEqual(AccessToken.objects.warm_cache(chunk_size=10), (3, 3))
+        # one call per expiry date
+        self.assertEqual(set_many.call_count, 2)
+        for token in self.valid:
+            cached = CachedToken.from_payload(cache.get(token.cache_key))
+            self.assertEqual(cached, CachedToken.from_token(token))
+            self.assertGreater(cached.stale_at, 0)
+        # the cache lock is released
+        self.assertEqual(AccessToken.objects.warm_cache(), (3, 0))
+
+    def test_chunks(self):
+        cache.set(self.valid[0].cache_key, TOKEN_NOT_FOUND)
+        with mock.patch.object(cache, "get_many", wraps=cache.get_many) as get_many:
+            self.assertEqual(AccessToken.objects.warm_cache(chunk_size=2), (3, 2))
+        self.assertEqual(get_many.call_count, 2)
+        # entries already in the cache are not overwritten
+        self.assertEqual(cache.get(self.valid[0].cache_key), TOKEN_NOT_FOUND)
+
+    def test_changed_while_warming(self):
+        """Test tokens deleted / deactivated after being read are not cached."""
+        warm_chunk = AccessToken.objects._warm_chunk
+
+        def _warm_chunk(pks):
+            self.valid[1].delete()
+            AccessToken.objects.filter(pk=self.valid[2].pk).update(is_active=False)
+            return warm_chunk(pks)
+
+        with mock.patch.object(
+            AccessToken.objects, "_warm_chunk", side_effect=_warm_chunk
+        ):
+            self.assertEqual(AccessToken.objects.warm_cache(chunk_size=10), (1, 1))
+        self.assertIsNotNone(cache.get(self.valid[0].cache_key))
+        self.assertIsNone(cache.get(self.valid[1].cache_key))
+        self.assertIsNone(cache.get(self.valid[2].cache_key))
+
+    def test_locked(self):
+        """Test only one process warms the cache at a time."""
+        cache.add("perimeter:warm.lock", 1)
+        with self.assertNumQueries(0):
+            self.assertIsNone(AccessToken.objects.warm_cache())
+        self.assertIsNone(cache.get(self.valid[0].cache_key))
+
+
+class TokenStorageTests(TestCase):
+    """Test the PERIMETER_TOKEN_STORAGE modes."""
+
+    def setUp(self):
+        cache.clear()
+
+    def create_unhashed_token(self, value):
+        """Create a token as it was before hashing was added."""
+        return AccessToken.objects.bulk_create(
+            [AccessToken(token=value, created_at=now(), updated_at=now())]
+        )[0]
+
+    def get_access_token(self, value):
+        cache.clear()
+        with self.assertNumQueries(1):
+            return AccessToken.objects.get_access_token(value)
+
+    def test_plain(self):
+        token = AccessToken.objects.create_access_token(token="x")
+        self.assertEqual(token.token_hash, hash_token_value("x"))
+        self.assertEqual(AccessToken.objects.get().token, "x")
+        self.assertEqual(self.get_access_token("x").pk, token.pk)
+        unhashed = self.create_unhashed_token("y")
+        self.assertEqual(self.get_access_token("y").pk, unhashed.pk)
+
+    @mock.patch("perimeter.models.PERIMETER_TOKEN_STORAGE", "dual")
+    def test_dual(self):
+        token = AccessToken.objects.create_access_token(token="x")
+        self.assertEqual(AccessToken.objects.get().token, "x")
+        self.assertEqual(self.get_access_token("x").pk, token.pk)
+        # tokens without a hash are found by value
+        unhashed = self.create_unhashed_token("y")
+        self.assertEqual(self.get_access_token("y").pk, unhashed.pk)
+        self.assertIsInstance(self.get_access_token("z"), EmptyToken)
+
+    @mock.patch("perimeter.models.PERIMETER_TOKEN_STORAGE", "hashed")
+    def test_hashed(self):
+        token = AccessToken.objects.create_access_token(token="x")
+        # the value is available once, from the new instance
+        self.assertEqual(token.token, "x")
+        stored = AccessToken.objects.get()
+        self.assertIsNone(stored.token)
+        self.assertEqual(stored.token_hash, hash_token_value("x"))
+        self.assertEqual(str(stored), "hashed:%s" % stored.token_hash[:12])
+        self.assertEqual(self.get_access_token("x").pk, token.pk)
+        # saving again does not lose the hash
+        stored.is_active = False
+        stored.save()
+        self.assertFalse(self.get_access_token("x").is_active)
+        # tokens without a hash cannot be found
+        self.create_unhashed_token("y")
+        self.assertIsInstance(self.get_access_token("y"), EmptyToken)
+
+    def test_update_fields(self):
+        """Test the hash is saved along with the value, in every mode."""
+        for mode in ("plain", "dual", "hashed"):
+            with self.subTest(mode), mock.patch(
+                "perimeter.models.PERIMETER_TOKEN_STORAGE", mode
+            ):
+                token = AccessToken.objects.create_access_token(token=f"{mode}-old")
+                token.token = f"{mode}-new"
+                token.save(update_fields=["token"])
+                self.assertEqual(
+                    AccessToken.objects.get(pk=token.pk).token_hash,
+                    hash_token_value(f"{mode}-new"),
+                )
+                self.assertEqual(self.get_access_token(f"{mode}-new").pk, token.pk)
+                self.assertIsInstance(self.get_access_token(f"{mode}-old"), EmptyToken)
+
+    @mock.patch("perimeter.models.PERIMETER_TOKEN_STORAGE", "hashed")
+    def test_hashed_bulk_create(self):
+        tokens = AccessToken.objects.bulk_create_tokens(3)
+        self.assertTrue(all(t.token for t in tokens))
+        self.assertFalse(AccessToken.objects.filter(token__isnull=False).exists())
+        for token in tokens:
+            self.assertEqual(self.get_access_token(token.token).pk, token.pk)
+
+    def test_clean(self):
+        with self.assertRaises(ValidationError):
+            AccessToken().clean()
+        AccessToken(token="x").clean()
+        AccessToken(token_hash=hash_token_value("x")).clean()
+
+    def test_clean_scope(self):
+        with self.assertRaises(ValidationError):
+            AccessToken(token="x", scope_paths="previews/").clean()
+        AccessToken(token="x", scope_paths="/previews/").clean()
+
+    def test_blank_token(self):
+        """Test blank tokens are stored as NULL, so that they don't clash."""
+        AccessToken(token="").save()
+        AccessToken(token="").save()
+        self.assertEqual(AccessToken.objects.filter(token__isnull=True).count(), 2)
 
 
 class AccesTokenUseTests(TestCase):
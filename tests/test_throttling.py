@@ -0,0 +1,74 @@
+from unittest import mock
+
+from django.contrib.sessions.backends.cache import SessionStore
+from django.core.cache import cache
+from django.test import RequestFactory, TestCase
+
+from perimeter.models import AccessToken
+from perimeter.settings import get_gateway_path
+from perimeter.throttling import get_throttle_keys, throttle
+from perimeter.views import gateway
+
+
+@mock.patch("perimeter.throttling.PERIMETER_GATEWAY_RATE_WINDOW", 60)
+@mock.patch("perimeter.throttling.PERIMETER_GATEWAY_RATE_LIMIT", 2)
+class ThrottleTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.factory = RequestFactory()
+
+    def get_request(self, ip="127.0.0.1"):
+        request = self.factory.post(get_gateway_path(), REMOTE_ADDR=ip)
+        request.session = SessionStore()
+        return request
+
+    def test_disabled(self):
+        request = self.get_request()
+        with mock.patch("perimeter.throttling.PERIMETER_GATEWAY_RATE_LIMIT", 0):
+            for _ in range(5):
+                self.assertEqual(throttle(request), 0)
+
+    @mock.patch("perimeter.throttling.time.time")
+    def test_throttle(self, mock_time):
+        mock_time.return_value = 6030
+        request = self.get_request()
+        self.assertEqual(throttle(request), 0)
+        self.assertEqual(throttle(request), 0)
+        # limit exceeded - wait until the window ends, at 6060
+        self.assertEqual(throttle(request), 30)
+        # other clients are unaffected
+        self.assertEqual(throttle(self.get_request("10.0.0.1")), 0)
+        # next window
+        mock_time.return_value = 6060
+        self.assertEqual(throttle(request), 0)
+
+    @mock.patch("perimeter.throttling.PERIMETER_GATEWAY_RATE_LIMIT_SESSION", True)
+    def test_throttle_session(self):
+        request = self.get_request()
+        # new sessions have no key, so are only throttled by IP
+        self.assertEqual(len(get_throttle_keys(request, 0)), 1)
+        request.session.save()
+        self.assertEqual(len(get_throttle_keys(request, 0)), 2)
+        # session is throttled, even if the IP changes
+        self.assertEqual(throttle(request), 0)
+        self.assertEqual(throttle(request), 0)
+        request.META["REMOTE_ADDR"] = "10.0.0.1"
+        self.assertGreater(throttle(request), 0)
+
+    def test_gateway_429(self):
+        token = AccessToken.objects.create_access_token()
+        payload = {"token": token.token}
+        for _ in range(2):
+            request = self.factory.post(get_gateway_path(), payload)
+            request.session = {}
+            self.assertEqual(gateway(request).status_code, 302)
+        request = self.factory.post(get_gateway_path(), payload)
+        request.session = {}
+        # throttled before the token is looked up
+        with self.assertNumQueries(0):
+            response = gateway(request)
+        self.assertEqual(response.status_code, 429)
+        self.assertGreater(int(response["Retry-After"]), 0)
+        # GETs are not throttled
+        request = self.factory.get(get_gateway_path())
+        self.assertEqual(gateway(request).status_code, 200)